@@ -68,7 +68,7 @@ def parse_args():
     
 
 def reprocess(input_fname='trajectories.csv'):
-    fname = os.path.join(git_dir, input_fname)
+    fname = input_fname if os.path.isabs(input_fname) else os.path.join(git_dir, input_fname)
     row_df = pd.read_csv(fname, skiprows=1)
     df = row_df.set_index('sampletimes').transpose()
     run_time = len([x for x in df.columns.values if '{0}' in x])
@@ -125,21 +125,31 @@ def trim_trajectories(df, fname,sample_param_to_keep, time_start=1, time_stop=10
     df.to_csv(os.path.join(exp_path, fname + '_trim.csv'), index=False, date_format='%Y-%m-%d')
 
 
+def combine_scenario(sampledf, scen_i, trajectories_path):
+    """Trajectories of a single scenario in long format, with its sample parameters"""
+    input_name = "trajectories_scen" + str(scen_i) + ".csv"
+    df_i = reprocess(os.path.join(trajectories_path, input_name))
+    df_i['scen_num'] = scen_i
+    return df_i.merge(sampledf, on=['scen_num'])
+
+
 def combine_trajectories(sampledf, Nscenarios_start=0, Nscenarios_stop=1000, fname='trajectoriesDat.csv',SAVE=True):
 
     df_list = []
     n_errors = 0
+    failed = []
     for scen_i in range(Nscenarios_start, Nscenarios_stop):
-        input_name = "trajectories_scen" + str(scen_i) + ".csv"
         try:
-            df_i = reprocess(os.path.join(trajectories_path, input_name))
-            df_i['scen_num'] = scen_i
-            df_i = df_i.merge(sampledf, on=['scen_num'])
-            df_list.append(df_i)
-        except:
+            df_list.append(combine_scenario(sampledf, scen_i, trajectories_path))
+        except Exception as e:
             n_errors += 1
+            if scen_i in sampledf['scen_num'].values:
+                failed.append(f'{scen_i} ({type(e).__name__})')
             continue
     print("Number of errors:" + str(n_errors))
+    if failed:
+        """see verify_scenarios.py to rerun incomplete scenarios"""
+        print("Scenarios not combined: " + ", ".join(failed))
     try:
         dfc = pd.concat(df_list)
         dfc = dfc.dropna()
@@ -198,6 +208,53 @@ def combine_trajectories_chunks(grp_list, useTrim=True):
             write_report(nscenarios_processed= len(df_all['scen_num'].unique()))
     [os.unlink(os.path.join(exp_path,file)) for file in files]
 
+def load_sampled_parameters(exp_path, additional_sample_param=''):
+    """Sample parameters to keep in the combined trajectories
+
+    Returns
+    -------
+    sampledf : pd.DataFrame
+    sample_param_to_keep : list
+    grp_list : list
+        Groups of the outcome channels, None if not region or age specific
+    """
+    """Define model type and grp suffix of parameters and outcome channels"""
+    sampledf = pd.read_csv(os.path.join(exp_path, "sampled_parameters.csv"))
+    N_cols = [col for col in sampledf.columns if 'N_' in col]
+    if len(N_cols)!=0:
+        grp_list = ['All'] + [col.replace('N_','') for col in N_cols]
+    else:
+        grp_list = None
+        N_cols = ['speciesS', 'initialAs']
+
+    """Define parameters to keep"""
+    sample_param_to_keep = ['startdate', 'scen_num', 'sample_num'] + N_cols
+    if isinstance(additional_sample_param, list): sample_param_to_keep = sample_param_to_keep + additional_sample_param
+
+    try:
+        sampledf = pd.read_csv(os.path.join(exp_path, "sampled_parameters.csv"), usecols= sample_param_to_keep)
+    except:
+        """when running from input csv sample_num might be missing"""
+        sample_param_to_keep = ['startdate', 'scen_num'] + N_cols
+        if isinstance(additional_sample_param, list): sample_param_to_keep = sample_param_to_keep + additional_sample_param
+        sampledf = pd.read_csv(os.path.join(exp_path, "sampled_parameters.csv"), usecols= sample_param_to_keep)
+        sample_param_to_keep = sample_param_to_keep + ['sample_num']
+        sampledf['sample_num'] = 0
+    return sampledf, sample_param_to_keep, grp_list
+
+
+def get_combined_fnames(Nscenario, Scenario_save_limit=700):
+    """File names of the combined trajectories, with the range of scenarios (start, stop) of each file"""
+    if Nscenario <= Scenario_save_limit:
+        return [("trajectoriesDat.csv", 0, Nscenario + 1)]
+    n_subsets = int(Nscenario/Scenario_save_limit)
+    fnames = []
+    for i in range(1, n_subsets+2):
+        Nscenario_stop = i * Scenario_save_limit
+        fnames.append(('trajectoriesDat_'+str(Nscenario_stop)+'.csv', Nscenario_stop-Scenario_save_limit, Nscenario_stop))
+    return fnames
+
+
 def write_report(nscenarios_processed):
     trackScen = f'Number of scenarios processed n= {str(nscenarios_processed)} out of total ' \
                 f'N= {str(Nscenario)} ({str(nscenarios_processed / Nscenario)} %)'
@@ -224,29 +281,7 @@ if __name__ == '__main__':
     exp_path = os.path.join(sim_out_dir, exp_name)
     trajectories_path = os.path.join(exp_path, 'trajectories')
 
-    """Define model type and grp suffix of parameters and outcome channels"""
-    sampledf = pd.read_csv(os.path.join(exp_path, "sampled_parameters.csv"))
-    N_cols = [col for col in sampledf.columns if 'N_' in col]
-    if len(N_cols)!=0:
-        grp_list = ['All'] + [col.replace('N_','') for col in N_cols]
-        grp_suffix = grp_list[0][:3]
-    else:
-        grp_list = None
-        N_cols = ['speciesS', 'initialAs']
-
-    """Define parameters to keep"""
-    sample_param_to_keep = ['startdate', 'scen_num', 'sample_num'] + N_cols
-    if isinstance(additional_sample_param, list): sample_param_to_keep = sample_param_to_keep + additional_sample_param
-
-    try:
-        sampledf = pd.read_csv(os.path.join(exp_path, "sampled_parameters.csv"), usecols= sample_param_to_keep)
-    except:
-        """when running from input csv sample_num might be missing"""
-        sample_param_to_keep = ['startdate', 'scen_num'] + N_cols
-        if isinstance(additional_sample_param, list): sample_param_to_keep = sample_param_to_keep + additional_sample_param
-        sampledf = pd.read_csv(os.path.join(exp_path, "sampled_parameters.csv"), usecols= sample_param_to_keep)
-        sample_param_to_keep = sample_param_to_keep + ['sample_num']
-        sampledf['sample_num'] = 0
+    sampledf, sample_param_to_keep, grp_list = load_sampled_parameters(exp_path, additional_sample_param)
     Nscenario = max(sampledf['scen_num'])
 
     if Nscenario <= Scenario_save_limit:
@@ -271,15 +306,9 @@ if __name__ == '__main__':
         write_report(nscenarios_processed= len(dfc['scen_num'].unique()))
 
     if Nscenario > Scenario_save_limit:
-        n_subsets = int(Nscenario/Scenario_save_limit)
-
         """Combine trajectories in specified chunks for n subsets"""
-        for i in range(1,n_subsets+2):
-            if i ==1 : Nscenario_stop=Scenario_save_limit
-            if i > 1 : Nscenario_stop = Nscenario_stop + Scenario_save_limit
+        for fname, Nscenarios_start, Nscenario_stop in get_combined_fnames(Nscenario, Scenario_save_limit):
             print(Nscenario_stop)
-            Nscenarios_start = Nscenario_stop-Scenario_save_limit
-            fname = 'trajectoriesDat_'+str(Nscenario_stop)+'.csv'
             if not os.path.exists(os.path.join(exp_path, fname)):
                 dfc = combine_trajectories(sampledf=sampledf,
                                            Nscenarios_start=Nscenarios_start,
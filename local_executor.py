@@ -0,0 +1,168 @@
+"""
+Run the scenarios of a local experiment concurrently instead of one after the other.
+
+Each scenario is one process (compartments.exe via wine/docker, or a native solver, see simulation_helpers.py),
+at most n_workers processes run at the same time. The output of each process is streamed into
+<log_dir>/scen<scen_num>.txt, progress and the expected remaining time are logged after each scenario and
+the exit codes are written to <log_dir>/exit_codes.csv.
+With max_writers at most that many scenarios write their trajectories at the same time, the others wait for a write
+slot (see solvers/trajectories.write_slot, native solvers only, compartments.exe writes on its own).
+CMSWorkerPool starts wine (and the docker container) once for all CMS scenarios instead of once per scenario.
+"""
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+from solvers.trajectories import WRITE_SLOTS_ENV
+
+log = logging.getLogger(__name__)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+
+class Progress:
+    """Counts finished scenarios and logs the progress with an ETA"""
+
+    def __init__(self, n_total):
+        self.n_total = n_total
+        self.n_done = 0
+        self.n_failed = 0
+        self.start = time.monotonic()
+
+    def update(self, scen_num, returncode):
+        self.n_done += 1
+        if returncode != 0:
+            self.n_failed += 1
+            log.warning(f"Scenario {scen_num} failed with exit code {returncode}")
+        elapsed = time.monotonic() - self.start
+        eta = elapsed / self.n_done * (self.n_total - self.n_done)
+        log.info(f"{self.n_done}/{self.n_total} scenarios done ({self.n_failed} failed), "
+                 f"elapsed {format_duration(elapsed)}, ETA {format_duration(eta)}")
+
+
+async def _run_scenario(scen_num, cmd, log_dir, semaphore, progress, cwd=None, env=None):
+    async with semaphore:
+        with open(os.path.join(log_dir, f'scen{scen_num}.txt'), 'wb') as log_file:
+            process = await asyncio.create_subprocess_shell(cmd, stdout=log_file, stderr=asyncio.subprocess.STDOUT,
+                                                            cwd=cwd, env=env)
+            try:
+                returncode = await process.wait()
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+    progress.update(scen_num, returncode)
+    return returncode
+
+
+async def run_scenarios_async(scenario_cmds, log_dir, n_workers, cwd=None, env=None):
+    semaphore = asyncio.Semaphore(n_workers)
+    progress = Progress(len(scenario_cmds))
+    returncodes = await asyncio.gather(*[_run_scenario(scen_num, cmd, log_dir, semaphore, progress, cwd, env)
+                                         for scen_num, cmd in scenario_cmds.items()])
+    return dict(zip(scenario_cmds.keys(), returncodes))
+
+
+def run_scenarios(scenario_cmds, log_dir, n_workers=None, cwd=None, max_writers=None):
+    """Run the scenario commands with at most n_workers processes at a time
+
+    Parameters
+    ----------
+    scenario_cmds : dict
+        Shell command per scen_num
+    log_dir : str
+        Folder of the scen<scen_num>.txt logs and exit_codes.csv
+    n_workers : int, optional
+        Number of concurrent processes, the number of cores if None
+    cwd : str, optional
+        Working directory of the processes
+    max_writers : int, optional
+        Number of processes writing their trajectories at the same time, all if None
+
+    Returns
+    -------
+    returncodes : dict
+        Exit code per scen_num
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    os.makedirs(log_dir, exist_ok=True)
+    env = None
+    if max_writers is not None and max_writers < n_workers:
+        slot_dir = os.path.join(log_dir, 'write_slots')
+        os.makedirs(slot_dir, exist_ok=True)
+        env = {**os.environ, WRITE_SLOTS_ENV: f'{max_writers}:{slot_dir}'}
+    log.info(f"Running {len(scenario_cmds)} scenarios with {n_workers} workers, logs in {log_dir}")
+    returncodes = asyncio.run(run_scenarios_async(scenario_cmds, log_dir, n_workers, cwd, env))
+    pd.DataFrame({'scen_num': list(returncodes.keys()), 'exit_code': list(returncodes.values())}).to_csv(
+        os.path.join(log_dir, 'exit_codes.csv'), index=False)
+    failed = [scen_num for scen_num, returncode in returncodes.items() if returncode != 0]
+    if failed:
+        log.warning(f"{len(failed)} of {len(returncodes)} scenarios failed: {failed}")
+    return returncodes
+
+
+class CMSWorkerPool:
+    """Start wine once for all CMS scenarios of an experiment instead of once per scenario
+
+    With a docker image, a single container is started with a persistent wineserver and the scenarios run in it
+    via docker exec, otherwise a persistent wineserver is started on the host (wineserver -p), which the wine
+    process of each scenario attaches to. On Windows compartments.exe is run directly.
+
+    Use as context manager, cms_cmd replaces simulation_helpers.get_cms_cmd:
+
+    with CMSWorkerPool(temp_exp_dir, exe_dir, docker_image) as pool:
+        scenario_cmds = get_scenario_cmds(..., cms_cmd=pool.cms_cmd)
+    """
+
+    def __init__(self, workdir, exe_dir, docker_image=None, linger=60):
+        self.workdir = workdir
+        self.exe_dir = exe_dir
+        self.docker_image = docker_image
+        self.linger = linger
+        self.container = None
+
+    def start(self):
+        if sys.platform in ['win32', 'cygwin']:
+            return self
+        if self.docker_image:
+            # the wineserver keeps the container (and wine) alive until stop
+            self.container = subprocess.run(
+                ['docker', 'run', '-d', '--rm', f'-v={self.workdir}:{self.workdir}', '--entrypoint', 'wineserver',
+                 self.docker_image, '-p', '-f'], check=True, capture_output=True, text=True).stdout.strip()
+            log.info(f"Started CMS worker container {self.container[:12]} from {self.docker_image}")
+        else:
+            # stays up while scenarios are running and exits linger seconds after the last one
+            subprocess.run(['wineserver', f'-p{self.linger}'], check=True)
+            log.info("Started persistent wineserver for CMS workers")
+        return self
+
+    def stop(self):
+        if self.container is not None:
+            subprocess.run(['docker', 'stop', self.container], capture_output=True)
+            log.info(f"Stopped CMS worker container {self.container[:12]}")
+            self.container = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def cms_cmd(self):
+        if sys.platform in ['win32', 'cygwin']:
+            return f'"{os.path.join(self.exe_dir, "compartments.exe")}"'
+        if self.docker_image:
+            if self.container is None:
+                raise RuntimeError("CMSWorkerPool has not been started")
+            # compartments.exe is unpacked in the working directory of the image, see Dockerfile
+            return f"docker exec {self.container} wine compartments.exe -d {self.workdir}"
+        return f"wine {os.path.join(self.exe_dir, 'compartments.exe')} -d {self.workdir}"
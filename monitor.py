@@ -0,0 +1,193 @@
+"""
+Progress of a running experiment: completed, running, failed and pending scenarios, throughput and expected end.
+
+The state of each scenario is read from the experiment folder, the same for Local and NUCLUSTER runs:
+- done: complete trajectories_scen<scen_num>.csv (see verify_scenarios.check_trajectories), finished at the end
+  time in the manifest (--manifest) or the modification time of the file
+- failed: non-zero exit code in the manifest, log/exit_codes.csv (local executor) or the work queue (--queue_workers)
+- running: trajectories being written, a log/scen<scen_num>.txt of the local executor or claimed in the work queue
+- pending: all other scenarios
+The throughput is that of the scenarios finished in the last window minutes (of all scenarios finished since the
+experiment was set up if fewer), the expected end assumes the remaining scenarios run at the same throughput.
+
+python monitor.py -d _temp/<exp_name> [--watch]
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+from local_executor import format_duration
+from run_manifest import MANIFEST_FNAME
+from stage_pipeline import STAGES_DIR
+from verify_scenarios import check_trajectories, get_scenario_settings
+from work_queue import QUEUE_FNAME
+
+STATES = ['done', 'running', 'failed', 'pending']
+
+
+def read_sqlite(exp_dir, fname, query):
+    """Rows of a query on a database of the experiment, empty if it does not exist (yet)"""
+    path = os.path.join(exp_dir, fname)
+    if not os.path.exists(path):
+        return []
+    con = sqlite3.connect(path, timeout=60)
+    try:
+        return con.execute(query).fetchall()
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        con.close()
+
+
+def get_exit_codes(exp_dir):
+    """Last exit code per scen_num of the manifest and the local executor"""
+    exit_codes = {}
+    fname = os.path.join(exp_dir, 'log', 'exit_codes.csv')
+    if os.path.exists(fname):
+        exit_codes.update(pd.read_csv(fname).set_index('scen_num')['exit_code'].to_dict())
+    exit_codes.update({scen_num: exit_code for scen_num, exit_code in read_sqlite(
+        exp_dir, MANIFEST_FNAME, "SELECT scen_num, exit_code FROM runs WHERE step = 'simulation' ORDER BY end")})
+    return exit_codes
+
+
+def get_scenario_states(exp_dir):
+    """State and finish time of each scenario
+
+    Returns
+    -------
+    states : pd.DataFrame
+        scen_num, state (see STATES) and finished (timestamp of done scenarios)
+    """
+    ends = dict(read_sqlite(exp_dir, MANIFEST_FNAME,
+                            "SELECT scen_num, MAX(end) FROM runs WHERE step = 'simulation' AND exit_code = 0 "
+                            "GROUP BY scen_num"))
+    exit_codes = get_exit_codes(exp_dir)
+    queue = dict(read_sqlite(exp_dir, QUEUE_FNAME, "SELECT scen_num, state FROM scenarios"))
+    rows = []
+    for _, row in get_scenario_settings(exp_dir).iterrows():
+        scen_num = int(row['scen_num'])
+        nruns = int(row['nruns']) if 'nruns' in row else None
+        fname = os.path.join(exp_dir, 'trajectories', f'trajectories_scen{scen_num}.csv')
+        finished = None
+        reason = check_trajectories(fname, nruns)
+        if reason is None:
+            state = 'done'
+            finished = ends.get(scen_num, os.path.getmtime(fname))
+        elif queue.get(scen_num) in ['running', 'failed']:
+            state = queue[scen_num]
+        elif exit_codes.get(scen_num, 0) != 0:
+            state = 'failed'
+        elif reason != 'missing' or os.path.exists(os.path.join(exp_dir, 'log', f'scen{scen_num}.txt')):
+            state = 'running'
+        else:
+            state = 'pending'
+        rows.append({'scen_num': scen_num, 'state': state, 'finished': finished})
+    return pd.DataFrame(rows, columns=['scen_num', 'state', 'finished'])
+
+
+def get_start(exp_dir):
+    """Time the experiment was set up, or of the first run in the manifest"""
+    starts = [os.path.getmtime(os.path.join(exp_dir, 'sampled_parameters.csv'))]
+    starts += [start for start, in read_sqlite(exp_dir, MANIFEST_FNAME, "SELECT MIN(start) FROM runs") if start]
+    return min(starts)
+
+
+def get_progress(exp_dir, window=30, now=None):
+    """Number of scenarios per state, throughput (scenarios per hour) and expected remaining seconds"""
+    now = now or time.time()
+    states = get_scenario_states(exp_dir)
+    progress = {state: int((states['state'] == state).sum()) for state in STATES}
+    progress['total'] = len(states)
+
+    start = get_start(exp_dir)
+    # scenarios finished before the experiment was set up are linked from the simulation cache
+    finished = states['finished'].dropna()
+    finished = finished[finished >= start]
+    recent = finished[finished >= now - window * 60]
+    if len(recent) >= 2:
+        rate = len(recent) / (window * 60)
+    else:
+        rate = len(finished) / max(now - start, 1)
+    remaining = progress['running'] + progress['pending']
+    progress['per_hour'] = rate * 3600
+    progress['eta'] = remaining / rate if rate > 0 else None
+    return progress
+
+
+def get_stages(exp_dir):
+    """Completed stages of a local run (stage_pipeline.py)"""
+    stages_dir = os.path.join(exp_dir, STAGES_DIR)
+    if not os.path.exists(stages_dir):
+        return []
+    return sorted(fname[:-len('.json')] for fname in os.listdir(stages_dir) if fname.endswith('.json'))
+
+
+def format_progress(progress, now=None):
+    now = now or time.time()
+    line = (f"{progress['done']}/{progress['total']} scenarios done, {progress['running']} running, "
+            f"{progress['failed']} failed, {progress['pending']} pending, {progress['per_hour']:.1f} scenarios/h")
+    if progress['running'] + progress['pending'] == 0:
+        return line
+    if progress['eta'] is None:
+        return line + ", ETA unknown"
+    end = datetime.datetime.fromtimestamp(now + progress['eta']).strftime('%Y-%m-%d %H:%M')
+    return line + f", ETA {format_duration(progress['eta'])} ({end})"
+
+
+def watch(exp_dir, interval=60, window=30):
+    """Print the progress every interval seconds until no scenario is running or pending"""
+    while True:
+        progress = get_progress(exp_dir, window=window)
+        print(f"{datetime.datetime.now().strftime('%H:%M:%S')} {format_progress(progress)}", flush=True)
+        if progress['running'] + progress['pending'] == 0:
+            return progress
+        time.sleep(interval)
+
+
+def parse_args():
+    description = "Progress and expected end of the simulations of an experiment"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-d",
+        "--exp_dir",
+        type=str,
+        help="Experiment folder with trajectories/, i.e. _temp/<exp_name>",
+        required=True
+    )
+    parser.add_argument(
+        "--watch",
+        action='store_true',
+        help="Print the progress every interval seconds until all scenarios have finished",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        help="Seconds between updates with --watch",
+        default=60
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        help="Minutes of recently finished scenarios the throughput is computed from",
+        default=30
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    stages = get_stages(args.exp_dir)
+    if stages:
+        print(f"Completed stages: {', '.join(stages)}")
+    if args.watch:
+        watch(args.exp_dir, interval=args.interval, window=args.window)
+    else:
+        progress = get_progress(args.exp_dir, window=args.window)
+        print(format_progress(progress))
+        failed = get_scenario_states(args.exp_dir).query("state == 'failed'")['scen_num'].tolist()
+        if failed:
+            print(f"Failed scenarios: {failed}")
@@ -11,6 +11,7 @@ import matplotlib.dates as mdates
 import shutil
 sys.path.append('../')
 from load_paths import load_box_paths
+from simulation_helpers import move_tree
 
   
 def parse_args():
@@ -46,12 +47,8 @@ def cleanup(temp_dir, temp_exp_dir, sim_output_path, delete_temp_dir=True) :
     if delete_temp_dir:
         shutil.rmtree(temp_dir, ignore_errors=True)
         print('temp_dir folder deleted')
-    shutil.copytree(temp_exp_dir, sim_output_path)
-    # Delete files after being copied to the project folder
-    if os.path.exists(sim_output_path):
-        shutil.rmtree(temp_exp_dir, ignore_errors=True)
-    elif not os.path.exists(sim_output_path):
-        print('Sim_output_path does not exists')
+    # renamed on the same filesystem, otherwise copied and verified before temp_exp_dir is deleted
+    move_tree(temp_exp_dir, sim_output_path)
 
     
 if __name__ == '__main__':
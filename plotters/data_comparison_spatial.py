@@ -35,6 +35,12 @@ def parse_args():
         help="Local or NUCLUSTER",
         default = "Local"
     )
+    parser.add_argument(
+        "--region",
+        type=int,
+        help="Only process this covid region (0 for All), i.e. as task of the postprocessing array",
+        default=None
+    )
 
     return parser.parse_args()
     
@@ -123,6 +129,7 @@ if __name__ == '__main__':
         plot_path = os.path.join(sim_output_path, '_plots')
         """Get group names"""
         grp_list, grp_suffix,grp_numbers = get_group_names(exp_path=sim_output_path)
+        grp_list, grp_numbers = select_region(grp_list, grp_numbers, args.region)
         for grp_nr in grp_numbers:
             print("Start processing region " + str(grp_nr))
             compare_ems(exp_name, ems_nr=int(grp_nr),first_day=first_plot_day,last_day=last_plot_day,plot_path=plot_path)
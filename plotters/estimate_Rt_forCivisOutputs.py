@@ -44,6 +44,18 @@ def parse_args():
         action='store_true',
         help="If specified only Rt plots will be generated, given Rt was already estimated",
     )
+    parser.add_argument(
+        "--region",
+        type=int,
+        help="Only estimate Rt of this covid region (0 for All), i.e. as task of the postprocessing array, "
+             "using the outputs of process_for_civis_EMSgrp.py --region",
+        default=None
+    )
+    parser.add_argument(
+        "--combine_regions",
+        action='store_true',
+        help="Combine the Rt estimates of the regions estimated with --region",
+    )
     return parser.parse_args()
 
 
@@ -105,16 +117,25 @@ def rt_plot(df, plotname,first_day=None, last_day=None):
     plt.savefig(os.path.join(plot_path, 'pdf', f'{plotname}.pdf'), format='PDF')
 
 
-def run_Rt_estimation(grp_numbers,smoothing_window, r_window_size):
+def load_civis_outputs(fname):
+    df = pd.read_csv(os.path.join(exp_dir, fname))
+    df['date'] = pd.to_datetime(df['date'])
+    return df[(df['date'] > pd.Timestamp('2020-03-01'))]
+
+
+def run_Rt_estimation(grp_numbers,smoothing_window, r_window_size, grp=None):
     """Code following online example:
     https://github.com/lo-hfk/epyestim/blob/main/notebooks/covid_tutorial.ipynb
     smoothing_window of 28 days was found to be most comparable to EpiEstim in this case
     r_window_size default is 3 if not specified, increasing r_window_size narrows the uncertainity bounds
+    If grp is specified, Rt is estimated from the outputs of this region (process_for_civis_EMSgrp.py --region)
+    and saved per region, to be combined by combine_Rt_estimates
     """
     simdate = exp_name.split("_")[0]
-    df = pd.read_csv(os.path.join(exp_dir, f'nu_{simdate}.csv'))
-    df['date'] = pd.to_datetime(df['date'])
-    df = df[(df['date'] > pd.Timestamp('2020-03-01'))]
+    if grp is not None:
+        df = load_civis_outputs(f'nu_{simdate}_{grp}.csv')
+    else:
+        df = load_civis_outputs(f'nu_{simdate}.csv')
 
     df_rt_all = pd.DataFrame()
     for ems_nr in grp_numbers:
@@ -145,6 +166,29 @@ def run_Rt_estimation(grp_numbers,smoothing_window, r_window_size):
         # df_rt['r_window_size'] = r_window_size
         df_rt_all = df_rt_all.append(df_rt)
 
+    if grp is not None:
+        if not df_rt_all.empty:
+            df_rt_all.to_csv(os.path.join(exp_dir, f'rtNU_region_{grp_numbers[0]}.csv'), index=False)
+        return df_rt_all
+    save_Rt_estimates(df, df_rt_all)
+
+    return df_rt
+
+
+def combine_Rt_estimates(grp_numbers):
+    """Combine the Rt estimates of the postprocessing array tasks (--region) and add them to nu_{simdate}.csv"""
+    df_rt_all = pd.DataFrame()
+    for ems_nr in grp_numbers:
+        fname = os.path.join(exp_dir, f'rtNU_region_{ems_nr}.csv')
+        if not os.path.exists(fname):
+            print(f'Warning: Rt estimates of region {ems_nr} not found')
+            continue
+        df_rt_all = pd.concat([df_rt_all, pd.read_csv(fname, parse_dates=['model_date', 'date'])])
+    save_Rt_estimates(load_civis_outputs(f'nu_{exp_name.split("_")[0]}.csv'), df_rt_all)
+
+
+def save_Rt_estimates(df, df_rt_all):
+    simdate = exp_name.split("_")[0]
     df_rt_all.to_csv(os.path.join(exp_dir, 'rtNU.csv'), index=False)
 
     if not 'rt_median' in df.columns:
@@ -161,9 +205,6 @@ def run_Rt_estimation(grp_numbers,smoothing_window, r_window_size):
         df_with_rt.to_csv(os.path.join(exp_dir, f'nu_{simdate}.csv'), index=False)
 
 
-    return df_rt
-
-
 if __name__ == '__main__':
 
     test_mode = False
@@ -187,7 +228,15 @@ if __name__ == '__main__':
         plot_path = os.path.join(exp_dir, '_plots')
         """Get group names"""
         grp_list, grp_suffix, grp_numbers = get_group_names(exp_path=exp_dir)
-        if args.plot_only==False:
+        if args.region is not None:
+            # the regions are combined and plotted with --combine_regions
+            grp_list, grp_numbers = select_region(grp_list, grp_numbers, args.region)
+            if grp_numbers:
+                run_Rt_estimation(grp_numbers, smoothing_window=28, r_window_size=3, grp=grp_list[0])
+            continue
+        if args.combine_regions:
+            combine_Rt_estimates(grp_numbers)
+        elif args.plot_only==False:
             run_Rt_estimation(grp_numbers,smoothing_window=28, r_window_size=3)
 
         df_rt_all = pd.read_csv(os.path.join(exp_dir, f'nu_{exp_name.split("_")[0]}.csv'))
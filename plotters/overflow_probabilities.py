@@ -43,6 +43,17 @@ def parse_args():
         help="Calculate probability for specified percent of capacity limit",
         default=99
     )
+    parser.add_argument(
+        "--region",
+        type=int,
+        help="Only process this covid region (0 for All), i.e. as task of the postprocessing array",
+        default=None
+    )
+    parser.add_argument(
+        "--combine_regions",
+        action='store_true',
+        help="Combine the probabilities of the regions processed with --region",
+    )
     return parser.parse_args()
 
 
@@ -132,6 +143,18 @@ def get_probs(ems_nr, channels=['total_hosp_census', 'crit_det', 'ventilators'],
     return df_all
 
 
+def load_region_probs(grp_numbers):
+    """Combine the probabilities written per region by the postprocessing array (--region)"""
+    df_all = pd.DataFrame()
+    for grp_nr in grp_numbers:
+        fname = os.path.join(sim_output_path, f'overflow_probabilities_region_{grp_nr}.csv')
+        if not os.path.exists(fname):
+            print(f'Warning: overflow probabilities of region {grp_nr} not found')
+            continue
+        df_all = pd.concat([df_all, pd.read_csv(fname, parse_dates=['date'])])
+    return df_all
+
+
 def plot_probs(df, region_label):
     fig = plt.figure(figsize=(12, 4))
     fig.suptitle(region_label, y=0.97, fontsize=14)
@@ -264,14 +287,22 @@ if __name__ == '__main__':
         """Get group names"""
         grp_list, grp_suffix, grp_numbers = get_group_names(exp_path=sim_output_path)
 
-        df_all = pd.DataFrame()
-        for grp_nr in grp_numbers:
-            print("Start processing region " + str(grp_nr))
-            df = get_probs(grp_nr, overflow_threshold_percents=overflow_threshold_percents, save_csv=False, plot=False)
-            df = df[df['date'].between(first_plot_day, last_plot_day)]
-            if df_all.empty:
-                df_all = df
-            else:
-                df_all = pd.concat([df_all, df])
+        if args.combine_regions:
+            df_all = load_region_probs(grp_numbers)
+        else:
+            df_all = pd.DataFrame()
+            for grp_nr in select_region(grp_list, grp_numbers, args.region)[1]:
+                print("Start processing region " + str(grp_nr))
+                df = get_probs(grp_nr, overflow_threshold_percents=overflow_threshold_percents, save_csv=False, plot=False)
+                df = df[df['date'].between(first_plot_day, last_plot_day)]
+                if df_all.empty:
+                    df_all = df
+                else:
+                    df_all = pd.concat([df_all, df])
+            if args.region is not None:
+                if not df_all.empty:
+                    df_all.to_csv(os.path.join(sim_output_path, f'overflow_probabilities_region_{args.region}.csv'),
+                                  index=False)
+                continue
         df_all.to_csv(os.path.join(sim_output_path, 'overflow_probabilities.csv'), index=False)
         write_probs_to_template(df=df_all)
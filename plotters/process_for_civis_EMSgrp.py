@@ -37,6 +37,13 @@ def parse_args():
         help="Local or NUCLUSTER",
         default='Local',
     )
+    parser.add_argument(
+        "--region",
+        type=int,
+        help="Only process this covid region (0 for All), i.e. as task of the postprocessing array. "
+             "The regions are combined with --processStep combine_outputs",
+        default=None,
+    )
     return parser.parse_args()
     
 def get_scenarioName(exp_suffix) :
@@ -190,22 +197,27 @@ if __name__ == '__main__' :
     
         if processStep == 'generate_outputs' :
             dfAll = pd.DataFrame()
-            for reg in grp_list :
+            for reg in select_region(grp_list, grp_numbers, args.region)[0] :
                 print( f'Start processing {reg}')
                 tdf = load_and_plot_data(reg, savePlot=True)
                 adf = process_and_save(tdf, reg, SAVE=True)
                 dfAll = pd.concat([dfAll, adf])
                 del tdf
 
-            filename = f'nu_{simdate}.csv'
-            rename_geography_and_save(dfAll,filename=filename)
+            if args.region is None :
+                filename = f'nu_{simdate}.csv'
+                rename_geography_and_save(dfAll,filename=filename)
     
         ### Optional (might be needed for larger simulations)
         if processStep == 'combine_outputs' :
 
+            dfAll = pd.DataFrame()
             for reg in grp_list :
                 print("Start processing" + reg)
                 filename = "nu_" + simdate + "_" + reg + ".csv"
+                if not os.path.exists(os.path.join(sim_output_path, filename)):
+                    print(f'Warning: {filename} not found, {reg} is not combined')
+                    continue
                 adf = pd.read_csv(os.path.join(sim_output_path, filename))
                 dfAll = pd.concat([dfAll, adf])
     
@@ -0,0 +1,142 @@
+"""
+Prune the trajectories of the first phase of a two-phase experiment (runScenarios.py --two_phase).
+The first phase is simulated up to the last data date only. Each trajectory (scenario and run) is ranked with the
+negative log-likelihood of trace_selection.py, summed across regions, and the best fitting trajectories
+(1 / traces_to_keep_ratio) are checkpointed at the last data date, to be continued to the forecast horizon
+with runScenarios.py --warm_start.
+Outputs:
+- traces_ranked_phase_one.csv with the nll per scen_num and run_num
+- checkpoint_<YYYYMMDD>_best.csv with the species of the best trajectories (see solvers/checkpoint.py)
+"""
+import argparse
+import os
+import pandas as pd
+import sys
+sys.path.append('../')
+from load_paths import load_box_paths
+from processing_helpers import *
+from trace_selection import rank_traces_nll
+from solvers.checkpoint import write_checkpoint
+
+def parse_args():
+
+    description = "Rank and checkpoint the best trajectories of the first phase of a two-phase experiment"
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument(
+        "-exp",
+        "--exp_name",
+        type=str,
+        help="Name of the simulation experiment of the first phase"
+    )
+    parser.add_argument(
+        "-loc",
+        "--Location",
+        type=str,
+        help="Local or NUCLUSTER",
+        default = "Local"
+    )
+    parser.add_argument(
+        "--checkpoint_date",
+        type=str,
+        help="Last data date, until which the first phase was simulated (YYYY-MM-DD)",
+        required=True
+    )
+    parser.add_argument(
+        "--deaths_weight",
+        type=float,
+        help="Weight of deaths in negative log likelihood calculation.",
+        default=0.0
+    )
+    parser.add_argument(
+        "--crit_weight",
+        type=float,
+        help="Weight of ICU population in negative log likelihood calculation.",
+        default=1.0
+    )
+    parser.add_argument(
+        "--non_icu_weight",
+        type=float,
+        help="Weight of non-ICU population in negative log likelihood calculation.",
+        default=1.0
+    )
+    parser.add_argument(
+        "--cli_weight",
+        type=float,
+        help="Weight of CLI admissions in negative log likelihood calculation.",
+        default=0.5
+    )
+    parser.add_argument(
+        "--traces_to_keep_ratio",
+        type=int,
+        help="Ratio of traces to keep out of all trajectories",
+        default=4
+    )
+    parser.add_argument(
+        "--traces_to_keep_min",
+        type=int,
+        help="Minimum number of traces to keep, might overwrite traces_to_keep_ratio for small simulations",
+        default=100
+    )
+    parser.add_argument(
+        "--wt",
+        action='store_true',
+        help="If true, weights simulations differently over time, see trace_selection.py",
+    )
+    return parser.parse_args()
+
+
+def rank_trajectories(exp_name, sim_output_path, last_day, weights_array, wt=False):
+    """Negative log-likelihood per trajectory (scen_num and run_num), summed across regions"""
+    grp_list, grp_suffix, grp_numbers = get_group_names(exp_path=sim_output_path)
+    if grp_numbers is None:
+        raise ValueError(f"No region specific channels in {sim_output_path}, pruning requires the locale model")
+    ems_list = [ems_nr for ems_nr in grp_numbers if ems_nr != 0] or grp_numbers
+    outcome_channels, channels, data_channel_names, titles = get_datacomparison_channels()
+
+    nll = None
+    for ems_nr in ems_list:
+        region_suffix = "_All" if ems_nr == 0 else "_EMS-" + str(ems_nr)
+        column_list = ['time', 'startdate', 'scen_num', 'sample_num', 'run_num']
+        for channel in outcome_channels:
+            column_list.append(channel + region_suffix)
+
+        ref_df = load_ref_df(ems_nr)
+        ref_df = ref_df[ref_df['date'] <= last_day]
+        df = load_sim_data(exp_name, region_suffix=region_suffix, column_list=column_list,
+                           input_sim_output_path=sim_output_path, select_traces=False)
+        df = df[df['date'] <= last_day]
+        """rank single trajectories instead of samples"""
+        df['sample_num'] = df['scen_num']
+        rank_df = rank_traces_nll(df, ems_nr, ref_df, weights_array=weights_array, wt=wt)
+        region_nll = rank_df.set_index(['sample_num', 'run_num'])['nll']
+        nll = region_nll if nll is None else nll + region_nll
+
+    rank_df = nll.dropna().reset_index().rename(columns={'sample_num': 'scen_num'})
+    rank_df[['scen_num', 'run_num']] = rank_df[['scen_num', 'run_num']].astype(int)
+    rank_df = rank_df.sort_values(by='nll').reset_index(drop=True)
+    rank_df.to_csv(os.path.join(sim_output_path, 'traces_ranked_phase_one.csv'), index=False)
+    return rank_df
+
+
+def get_n_traces_to_keep(n_traces, traces_to_keep_ratio, traces_to_keep_min):
+    n_traces_to_keep = int(n_traces / traces_to_keep_ratio)
+    if n_traces_to_keep < traces_to_keep_min:
+        n_traces_to_keep = traces_to_keep_min
+    return min(n_traces_to_keep, n_traces)
+
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    weights_array = [args.deaths_weight, args.crit_weight, args.non_icu_weight, args.cli_weight]
+    datapath, projectpath, wdir, exe_dir, git_dir = load_box_paths(Location=args.Location)
+    sim_output_path = os.path.join(wdir, 'simulation_output', args.exp_name)
+    last_day = pd.Timestamp(args.checkpoint_date)
+
+    rank_df = rank_trajectories(args.exp_name, sim_output_path, last_day, weights_array, wt=args.wt)
+    n_traces_to_keep = get_n_traces_to_keep(len(rank_df), args.traces_to_keep_ratio, args.traces_to_keep_min)
+    print(f'Keeping {n_traces_to_keep} of {len(rank_df)} trajectories')
+    write_checkpoint(sim_output_path, last_day,
+                     fname=os.path.join(sim_output_path, f"checkpoint_{last_day.strftime('%Y%m%d')}_best.csv"),
+                     traces=rank_df[:n_traces_to_keep])
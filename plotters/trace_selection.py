@@ -18,6 +18,9 @@ import matplotlib.dates as mdates
 import seaborn as sns
 from processing_helpers import *
 
+"""Custom timelag applied to nll calculation for deaths only"""
+timelag_days = 14
+
 def parse_args():
 
     description = "Simulation run for modeling Covid-19"
@@ -83,6 +86,12 @@ def parse_args():
         help="If true, weights simulations differently over time. The weighting needs to be specified within the sum_nll function "
              "If true, it weights the deaths higher in the past than for more recent data, can be customized and also depends on --deaths_weight",
     )
+    parser.add_argument(
+        "--region",
+        type=int,
+        help="Only process this covid region (0 for All), i.e. as task of the postprocessing array",
+        default=None
+    )
     return parser.parse_args()
 
 def sum_nll(df_values, ref_df_values, wt, wt_past=False):
@@ -111,7 +120,7 @@ def sum_nll(df_values, ref_df_values, wt, wt_past=False):
 
     return np.sum(x)
 
-def rank_traces_nll(df, ems_nr, ref_df, weights_array=[1.0,1.0,1.0,1.0],wt=False):
+def rank_traces_nll(df, ems_nr, ref_df, weights_array=[1.0,1.0,1.0,1.0],wt=False, output_path=None):
     #Creation of rank_df
     [deaths_weight, crit_weight, non_icu_weight, cli_weight] = weights_array
 
@@ -142,7 +151,8 @@ def rank_traces_nll(df, ems_nr, ref_df, weights_array=[1.0,1.0,1.0,1.0],wt=False
     csv_name = 'traces_ranked_region_' + str(ems_nr) + '.csv'
     #if wt:
     #    csv_name = 'traces_ranked_region_' + str(ems_nr) + '_wt.csv'
-    rank_export_df.to_csv(os.path.join(output_path,csv_name), index=False)
+    if output_path is not None:
+        rank_export_df.to_csv(os.path.join(output_path,csv_name), index=False)
 
     return rank_export_df
 
@@ -169,7 +179,7 @@ def compare_ems(exp_name, ems_nr,first_day,last_day,weights_array,wt,
     df = load_sim_data(exp_name, region_suffix=region_suffix, column_list=column_list)
     df = df[df['date'].between(first_day, ref_df['date'].max())]
     df['critical_with_suspected'] = df['critical']
-    rank_export_df = rank_traces_nll(df, ems_nr, ref_df, weights_array=weights_array, wt=wt)
+    rank_export_df = rank_traces_nll(df, ems_nr, ref_df, weights_array=weights_array, wt=wt, output_path=output_path)
 
     #Creation of plots
     if plot_trajectories:
@@ -203,9 +213,6 @@ if __name__ == '__main__':
     traces_to_keep_ratio = args.traces_to_keep_ratio
     traces_to_keep_min = args.traces_to_keep_min
 
-    """Custom timelag applied to nll calculation for deaths only"""
-    timelag_days = 14
-
     first_plot_day = pd.Timestamp('2020-03-25')
     last_plot_day = pd.Timestamp.today()
 
@@ -217,6 +224,7 @@ if __name__ == '__main__':
         output_path = os.path.join(wdir, 'simulation_output',exp_name)
         """Get group names"""
         grp_list, grp_suffix, grp_numbers = get_group_names(exp_path=output_path)
+        grp_list, grp_numbers = select_region(grp_list, grp_numbers, args.region)
         
         for ems_nr in grp_numbers:
             print("Start processing region " + str(ems_nr))
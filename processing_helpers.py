@@ -515,3 +515,12 @@ def get_group_names(exp_path, uniquechannel ='Ki_t', fname="trajectoriesDat.csv"
         grp_suffix=None
         grp_numbers = None
     return grp_list, grp_suffix, grp_numbers
+
+
+def select_region(grp_list, grp_numbers, region=None):
+    """Restrict the groups of get_group_names to one region (0 for All), i.e. the region of a postprocessing
+    array task, empty if the experiment does not have this region"""
+    if region is None:
+        return grp_list, grp_numbers
+    selected = [(grp, grp_nr) for grp, grp_nr in zip(grp_list, grp_numbers) if grp_nr == region]
+    return [grp for grp, _ in selected], [grp_nr for _, grp_nr in selected]
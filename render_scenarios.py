@@ -0,0 +1,107 @@
+"""
+Render the emodl and cfg file of a scenario from the template emodl, the cfg template and sampled_parameters.csv.
+
+runScenarios.py renders all scenarios into <exp_dir>/simulations before submitting them. With --render_on_node only
+the templates, sampled_parameters.csv and <exp_dir>/simulations/scenario_settings.csv (duration, monitoring samples,
+runs, seed and trajectories file per scenario) are staged, and each array task renders its scenario into node-local
+scratch right before running it:
+
+python render_scenarios.py -d _temp/<exp_name> --scen_num 1 --out_dir $TMPDIR/scen1
+
+which writes model_1.cfg and simulation_1.emodl into the output folder.
+"""
+import argparse
+import os
+import re
+
+import pandas as pd
+
+from solvers.checkpoint import warm_start_emodl
+
+SETTINGS_FNAME = 'scenario_settings.csv'
+
+
+def render_emodl(template_text, row):
+    """ Replace the placeholders (bookended by '@') of the template emodl with the sampled parameters of a row,
+    rows of a checkpoint (see solvers/checkpoint.py) render a warm start from the checkpointed species.
+    """
+    if 'checkpoint_time' in row:
+        return warm_start_emodl(template_text, row)
+    data = template_text
+    for col, value in row.items():
+        data = data.replace(f'@{col}@', str(value))
+    data = data.replace('@Ki@', '%.09f' % row['Ki'])
+    remaining_placeholders = re.findall(r'@\w+@', data)
+    if remaining_placeholders:
+        raise ValueError("Not all placeholders have been replaced in the template emodl file. "
+                         f"Remaining placeholders: {remaining_placeholders}")
+    return data
+
+
+def render_cfg(cfg_text, duration, monitoring_samples, nruns, trajectories, prng_seed=None):
+    """ Fill the cfg template of a scenario, trajectories is the output prefix replacing 'trajectories' """
+    data_cfg = cfg_text.replace('@duration@', str(duration))
+    data_cfg = data_cfg.replace('@monitoring_samples@', str(monitoring_samples))
+    data_cfg = data_cfg.replace('@nruns@', str(nruns))
+    if prng_seed is not None:
+        data_cfg = data_cfg.replace('@prng_seed@', str(prng_seed))
+    return data_cfg.replace('trajectories', trajectories)
+
+
+def render_scenario(exp_dir, scen_num, out_dir):
+    """ Render model_<scen_num>.cfg and simulation_<scen_num>.emodl of an experiment into out_dir
+
+    Returns
+    -------
+    cfg_fname, emodl_fname : str
+    """
+    settings = pd.read_csv(os.path.join(exp_dir, 'simulations', SETTINGS_FNAME)).set_index('scen_num').loc[scen_num]
+    # round_trip to render the same parameter values as written by runScenarios.py
+    df = pd.read_csv(os.path.join(exp_dir, 'sampled_parameters.csv'), float_precision='round_trip')
+    row = df[df['scen_num'] == scen_num].astype(object).iloc[0]
+    os.makedirs(out_dir, exist_ok=True)
+
+    with open(os.path.join(exp_dir, settings['emodl_template'])) as fin:
+        emodl = render_emodl(fin.read(), row)
+    emodl_fname = os.path.join(out_dir, f"simulation_{scen_num}.emodl")
+    with open(emodl_fname, 'w') as fout:
+        fout.write(emodl)
+
+    with open(os.path.join(exp_dir, settings['cfg_template'])) as fin:
+        data_cfg = render_cfg(fin.read(), settings['duration'], settings['monitoring_samples'], settings['nruns'],
+                              settings['trajectories'],
+                              int(settings['prng_seed']) if pd.notna(settings['prng_seed']) else None)
+    cfg_fname = os.path.join(out_dir, f"model_{scen_num}.cfg")
+    with open(cfg_fname, 'w') as fout:
+        fout.write(data_cfg)
+    return cfg_fname, emodl_fname
+
+
+def parse_args():
+    description = "Render the emodl and cfg file of a single scenario, i.e. on the compute node"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-d",
+        "--exp_dir",
+        type=str,
+        help="Experiment folder with the templates, sampled_parameters.csv and simulations/scenario_settings.csv",
+        required=True
+    )
+    parser.add_argument(
+        "--scen_num",
+        type=int,
+        help="Scenario to render",
+        required=True
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        help="Folder of the rendered files, i.e. node-local scratch",
+        required=True
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    render_scenario(args.exp_dir, args.scen_num, args.out_dir)
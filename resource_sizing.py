@@ -0,0 +1,138 @@
+"""
+Size the Slurm time limit and memory of an experiment from the runs of previous experiments.
+
+Experiments run with runScenarios.py --manifest record the walltime and peak memory of each scenario and
+postprocessing step in simulation_output/<exp_name>/manifest.sqlite (run_manifest.py), together with the model,
+observeLevel, duration, cfg and runs of the experiment. Before submitting an experiment, the manifests of the most
+recent experiments with the same model, observeLevel, duration and cfg are read and the time limit and memory
+are set to a high quantile of the previous runs times a safety margin.
+Without (enough) history the defaults of simulation_helpers.shell_header are kept.
+
+The trajectories written per scenario (the same quantile, or estimated from the observed channels, runs and
+monitoring samples without history) cap the number of array tasks running at the same time (--array=...%N), such
+that the trajectories of all running tasks are written within WRITE_SECONDS at a filesystem bandwidth budget.
+"""
+import glob
+import logging
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from run_manifest import MANIFEST_FNAME
+
+log = logging.getLogger(__name__)
+
+QUANTILE = 0.95
+MARGIN = 1.5
+MIN_RUNS = 5
+MAX_EXPERIMENTS = 10
+WRITE_SECONDS = 60
+# bytes per value in the trajectories csv, including the separator
+VALUE_BYTES = 10
+
+
+def format_time(seconds):
+    """Slurm time limit (HH:MM:SS), rounded up to minutes"""
+    minutes = int(np.ceil(seconds / 60))
+    return f'{minutes // 60:02d}:{minutes % 60:02d}:00'
+
+
+def load_history(sim_output_dir, max_experiments=MAX_EXPERIMENTS, **settings):
+    """Successful runs recorded in the manifests of the most recent experiments with the same settings
+
+    Parameters
+    ----------
+    sim_output_dir : str
+        Folder of the experiments, i.e. simulation_output
+    settings
+        Experiment settings to match, see run_manifest.EXPERIMENT_COLUMNS
+
+    Returns
+    -------
+    runs : pd.DataFrame
+        Runs with exp_dir, step, job_id, start, end, max_rss_mb and trajectory_bytes
+    """
+    manifests = sorted(glob.glob(os.path.join(sim_output_dir, '*', MANIFEST_FNAME)), key=os.path.getmtime, reverse=True)
+    where = ' AND '.join(f'{col} = ?' for col in settings)
+    runs = []
+    for fname in manifests:
+        con = sqlite3.connect(fname)
+        try:
+            if not con.execute(f"SELECT COUNT(*) FROM experiment WHERE {where}", list(settings.values())).fetchone()[0]:
+                continue
+            df = pd.read_sql("SELECT step, job_id, start, end, max_rss_mb, trajectory_bytes FROM runs "
+                             "WHERE exit_code = 0", con)
+        except (sqlite3.DatabaseError, pd.errors.DatabaseError):
+            # manifests without experiment settings or still written
+            continue
+        finally:
+            con.close()
+        runs.append(df.assign(exp_dir=os.path.dirname(fname)))
+        if len(runs) == max_experiments:
+            break
+    if not runs:
+        return pd.DataFrame(columns=['exp_dir', 'step', 'job_id', 'start', 'end', 'max_rss_mb', 'trajectory_bytes'])
+    return pd.concat(runs, ignore_index=True)
+
+
+def predict_resources(walltimes, max_rss_mb, quantile=QUANTILE, margin=MARGIN, min_runs=MIN_RUNS):
+    """Time limit and memory (GB) covering the quantile of the previous runs with a safety margin
+
+    Returns
+    -------
+    resources : dict
+        t and memG of simulation_helpers.shell_header, None if there are less than min_runs runs
+    """
+    walltimes = pd.Series(walltimes).dropna()
+    max_rss_mb = pd.Series(max_rss_mb).dropna()
+    if len(walltimes) < min_runs or len(max_rss_mb) < min_runs:
+        return None
+    return {'t': format_time(max(walltimes.quantile(quantile) * margin, 600)),
+            'memG': int(max(np.ceil(max_rss_mb.quantile(quantile) * margin / 1024), 1))}
+
+
+def size_experiment(sim_output_dir, **settings):
+    """Resources of the simulation tasks (per scenario) and of the postprocessing job of an experiment
+
+    Returns
+    -------
+    sim_resources, post_resources : dict
+        See predict_resources, None without history
+    """
+    runs = load_history(sim_output_dir, **settings)
+    simulations = runs[runs['step'] == 'simulation']
+    sim_resources = predict_resources(simulations['end'] - simulations['start'], simulations['max_rss_mb'])
+
+    # all postprocessing steps of an experiment run in one job
+    post = runs[runs['step'] != 'simulation'].fillna({'job_id': ''}).groupby(['exp_dir', 'job_id']).agg(
+        start=('start', 'min'), end=('end', 'max'), max_rss_mb=('max_rss_mb', 'max'))
+    post_resources = predict_resources(post['end'] - post['start'], post['max_rss_mb'], min_runs=1)
+
+    for name, resources in [('simulation', sim_resources), ('postprocessing', post_resources)]:
+        if resources is not None:
+            log.info(f"Sized {name} jobs from {runs['exp_dir'].nunique()} previous experiments: "
+                     f"-t {resources['t']} --mem={resources['memG']}G")
+    return sim_resources, post_resources
+
+
+def estimate_output_mb(emodl_fname, nruns, monitoring_samples):
+    """Size of the trajectories of a scenario, one row per observed channel and run"""
+    with open(emodl_fname) as fin:
+        n_channels = fin.read().count('(observe ')
+    return n_channels * nruns * (monitoring_samples + 1) * VALUE_BYTES / 1024 ** 2
+
+
+def size_output(sim_output_dir, quantile=QUANTILE, min_runs=MIN_RUNS, **settings):
+    """Trajectories (MB) per scenario of previous experiments with the same settings, None without history"""
+    runs = load_history(sim_output_dir, **settings)
+    trajectory_bytes = runs.loc[runs['step'] == 'simulation', 'trajectory_bytes'].dropna()
+    if len(trajectory_bytes) < min_runs:
+        return None
+    return trajectory_bytes.quantile(quantile) / 1024 ** 2
+
+
+def max_concurrent_tasks(output_mb, io_budget, write_seconds=WRITE_SECONDS):
+    """Array tasks whose trajectories, if written at the same time, take at most write_seconds at io_budget MB/s"""
+    return max(int(io_budget * write_seconds / output_mb), 1)
@@ -0,0 +1,164 @@
+"""
+Content-addressed cache of simulated trajectories, to skip scenarios that have been simulated before.
+
+A scenario is identified by the sha256 hash of its rendered emodl and cfg (which includes the solver settings and the
+prng seed), with the output prefix left out so that the scenario number does not matter. runScenarios.py --cache
+records the key of each scenario in simulations/scenario_settings.csv, links the trajectories of cache hits into
+trajectories/ instead of simulating them, and stores the trajectories of the simulated scenarios afterwards.
+On NUCLUSTER the trajectories are stored by the postprocessing job:
+
+python result_cache.py -d _temp/<exp_name> --store
+
+The cache is a folder of <key>.csv files, bounded in size: the least recently used files (by modification time, which
+is updated on each hit) are evicted when the size is exceeded.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+
+import pandas as pd
+
+from load_paths import load_box_paths
+from render_scenarios import SETTINGS_FNAME, render_cfg
+
+log = logging.getLogger(__name__)
+
+CACHE_SIZE_GB = 50
+
+
+def scenario_key(emodl_text, cfg_template, duration, monitoring_samples, nruns, prng_seed=None):
+    """Hash of the rendered emodl and cfg of a scenario, independent of its output prefix"""
+    cfg_text = render_cfg(cfg_template, duration, monitoring_samples, nruns, 'trajectories', prng_seed)
+    return hashlib.sha256((emodl_text + '\0' + cfg_text).encode()).hexdigest()
+
+
+class ResultCache:
+    """Folder of trajectories files named by scenario key, with least recently used eviction
+
+    Parameters
+    ----------
+    cache_dir : str
+    max_size_gb : float
+        Size limit of the cache folder
+    """
+
+    def __init__(self, cache_dir, max_size_gb=CACHE_SIZE_GB):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_size_gb * 1024 ** 3
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.csv')
+
+    def get(self, key, fname):
+        """Link (or copy) the cached trajectories to fname, returns False if not cached"""
+        cached = self.path(key)
+        if not os.path.exists(cached):
+            return False
+        if os.path.lexists(fname):
+            os.remove(fname)
+        try:
+            os.link(cached, fname)
+        except OSError:
+            shutil.copyfile(cached, fname)
+        # the modification time marks the last use
+        os.utime(cached)
+        return True
+
+    def put(self, key, fname):
+        """Store the trajectories file fname under key, evicts the least recently used files if needed"""
+        cached = self.path(key)
+        if os.path.exists(cached):
+            os.utime(cached)
+            return
+        tmp = f'{cached}.{os.getpid()}.tmp'
+        shutil.copyfile(fname, tmp)
+        os.replace(tmp, cached)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.csv'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            log.debug(f"Evicted {os.path.basename(path)} from the simulation cache")
+
+
+def link_cached_scenarios(exp_dir, trajectories_dir, cache):
+    """Link the trajectories of all cached scenarios of an experiment, returns their scen_nums"""
+    settings = pd.read_csv(os.path.join(exp_dir, 'simulations', SETTINGS_FNAME))
+    hits = [row['scen_num'] for _, row in settings.iterrows()
+            if cache.get(row['cache_key'], os.path.join(trajectories_dir, f"trajectories_scen{row['scen_num']}.csv"))]
+    log.info(f"{len(hits)} of {len(settings)} scenarios found in the simulation cache {cache.cache_dir}")
+    return hits
+
+
+def store_scenarios(exp_dir, trajectories_dir, cache):
+    """Store the trajectories of all simulated scenarios of an experiment in the cache"""
+    settings = pd.read_csv(os.path.join(exp_dir, 'simulations', SETTINGS_FNAME))
+    n_stored = 0
+    for _, row in settings.iterrows():
+        fname = os.path.join(trajectories_dir, f"trajectories_scen{row['scen_num']}.csv")
+        if os.path.exists(fname):
+            cache.put(row['cache_key'], fname)
+            n_stored += 1
+    log.info(f"Stored {n_stored} scenarios in the simulation cache {cache.cache_dir}")
+
+
+def get_cache_dir(Location='Local'):
+    _, _, wdir, _, _ = load_box_paths(Location=Location)
+    return os.path.join(wdir, 'simulation_cache')
+
+
+def parse_args():
+    description = "Store the trajectories of an experiment in the simulation cache"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-d",
+        "--exp_dir",
+        type=str,
+        help="Experiment folder with simulations/scenario_settings.csv, written by runScenarios.py --cache",
+        required=True
+    )
+    parser.add_argument(
+        "--store",
+        action='store_true',
+        help="Store the trajectories in <exp_dir>/trajectories",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Cache folder, default simulation_cache in the working directory (see load_paths.py)",
+        default=None
+    )
+    parser.add_argument(
+        "--cache_size_gb",
+        type=float,
+        help="Size limit of the cache folder",
+        default=CACHE_SIZE_GB
+    )
+    parser.add_argument(
+        "-loc",
+        "--Location",
+        type=str,
+        help="Local or NUCLUSTER",
+        default="Local"
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="INFO")
+    args = parse_args()
+    cache = ResultCache(args.cache_dir or get_cache_dir(args.Location), args.cache_size_gb)
+    if args.store:
+        store_scenarios(args.exp_dir, os.path.join(args.exp_dir, 'trajectories'), cache)
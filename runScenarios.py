@@ -2,7 +2,7 @@ import argparse
 import datetime
 import logging
 import os
-import re
+import shutil
 import sys
 import subprocess
 import matplotlib as mpl
@@ -12,9 +12,19 @@ import yaml
 
 
 from load_paths import load_box_paths
+from local_executor import CMSWorkerPool
+from render_scenarios import SETTINGS_FNAME, render_cfg, render_emodl
+from resource_sizing import estimate_output_mb, max_concurrent_tasks, size_experiment, size_output
+from run_manifest import record, write_experiment
+from result_cache import CACHE_SIZE_GB, ResultCache, link_cached_scenarios, scenario_key, store_scenarios
+from stream_ingest import finalize
+from solvers.checkpoint import read_warm_start, species_channels, stitch_history
+from solvers.run_solver import is_batch_cfg, is_native_cfg
+from stage_pipeline import Stage, read_marker, run_stages
+from verify_scenarios import MAX_RESUBMITS, find_incomplete_scenarios, verify_scenarios
 from simulation_helpers import (DateToTimestep, cleanup, write_emodl,
-                                generateSubmissionFile, generateSubmissionFile_quest, makeExperimentFolder,
-                                runExp, runSamplePlot)
+                                generateSubmissionFile, generateSubmissionFile_quest, get_scenario_cmds,
+                                makeExperimentFolder, runExp, runSamplePlot)
 
 log = logging.getLogger(__name__)
 
@@ -285,40 +295,49 @@ def generateParameterSamples(samples, pop, start_dates, config, age_bins, Kivalu
     return result
 
 
-def replaceParameters(df, row_i, Ki_i, emodl_template, scen_num):
+def replaceParameters(row, emodl_template, scen_num):
     """ Given an emodl template file, replaces the placeholder names
     (which are bookended by '@') with the sampled parameter value.
     This is saved as a (temporary) emodl file to be used in simulation runs.
+    Rows of a checkpoint (--warm_start) start from the checkpointed species at the checkpoint date
+    (see render_scenarios.render_emodl).
 
     Parameters
     ----------
-    df: pd.DataFrame
-        DataFrame containing all the sampled parameters
-    row_i : int
-        Index of which row in df we are handling
-    Ki_i: float
+    row: pd.Series
+        Sampled parameters of the scenario
     emodl_template: str
         File name of the emodl template file
     scen_num: int
         Scenario number of the simulation run
     """
     fin = open(os.path.join(temp_exp_dir, emodl_template), "rt")
-    data = fin.read()
-    for col in df.columns:
-        data = data.replace(f'@{col}@', str(df.iloc[row_i][col]))
-    data = data.replace('@Ki@', '%.09f' % Ki_i)
-    remaining_placeholders = re.findall(r'@\w+@', data)
-    if remaining_placeholders:
-        raise ValueError("Not all placeholders have been replaced in the template emodl file. "
-                         f"Remaining placeholders: {remaining_placeholders}")
+    data = render_emodl(fin.read(), row)
     fin.close()
-    remaining_placeholders = re.findall(r'@\w+@', data)
-    if remaining_placeholders:
-        raise ValueError("Not all placeholders have been replaced in the template emodl file. "
-                         f"Remaining placeholders: {remaining_placeholders}")
     fin = open(os.path.join(temp_dir, f"simulation_{scen_num}.emodl"), "wt")
     fin.write(data)
     fin.close()
+    return data
+
+
+def screenParameterSamples(df, emodl_template, Rt_band, Rt_times):
+    """ Drop parameter samples with an implausible reproduction number before any simulation runs.
+    Rt is derived from the next-generation matrix of the template emodl (see solvers/next_generation.py)
+    at each of Rt_times (days since start, 0 for R0). The Rt columns are added, scenarios are renumbered and
+    sampled_parameters.csv is overwritten with the kept samples.
+    """
+    from solvers.emodl_parser import load_emodl
+    from solvers.next_generation import screen_parameter_samples
+
+    model = load_emodl(os.path.join(temp_exp_dir, emodl_template))
+    df, keep = screen_parameter_samples(df, model, band=Rt_band, times=Rt_times)
+    log.info(f"Rt screening kept {keep.sum()} of {len(df)} parameter samples within {Rt_band[0]}-{Rt_band[1]}")
+    if not keep.any():
+        raise ValueError(f"No parameter samples with Rt within {Rt_band[0]}-{Rt_band[1]}")
+    df = df[keep].reset_index(drop=True)
+    df["scen_num"] = range(1, len(df) + 1)
+    df.to_csv(os.path.join(temp_exp_dir, "sampled_parameters.csv"), index=False)
+    return df
 
 
 def generateScenarios(simulation_population, Kivalues, duration, monitoring_samples,
@@ -334,17 +353,29 @@ def generateScenarios(simulation_population, Kivalues, duration, monitoring_samp
     if args.sample_csv is not None :
         generateNew = False
 
-    dfparam = generateParameterSamples(samples=sub_samples,
-                                       pop=simulation_population,
-                                       start_dates=start_dates,
-                                       config=experiment_config,
-                                       age_bins=age_bins,
-                                       Kivalues=Kivalues,
-                                       region=region,
-                                       generateNew=generateNew,
-                                       use_means=use_means)
+    if args.warm_start is not None:
+        dfparam = read_warm_start(args.warm_start)
+        dfparam.to_csv(os.path.join(temp_exp_dir, "sampled_parameters.csv"), index=False)
+    else:
+        dfparam = generateParameterSamples(samples=sub_samples,
+                                           pop=simulation_population,
+                                           start_dates=start_dates,
+                                           config=experiment_config,
+                                           age_bins=age_bins,
+                                           Kivalues=Kivalues,
+                                           region=region,
+                                           generateNew=generateNew,
+                                           use_means=use_means)
+    if args.Rt_band is not None:
+        dfparam = screenParameterSamples(dfparam, modelname, args.Rt_band, args.Rt_times)
+    if args.two_phase is not None:
+        from solvers.emodl_parser import load_emodl
+        # fail before simulating if the first phase cannot be checkpointed
+        species_channels(load_emodl(os.path.join(temp_exp_dir, modelname)))
 
     if Location == 'NUCLUSTER' and cfg_file =="model_B.cfg":
+        log.info("Reducing Tau of model_B.cfg to 0.0001 on NUCLUSTER, "
+                 "use solvers/tune_step_size.py to benchmark Tau and run with -cfg model_B_tuned.cfg instead")
         fin = open(os.path.join(temp_exp_dir, cfg_file), "rt")
         cfg_txt = fin.read()
         cfg_txt = cfg_txt.replace('"Tau"  : 0.001', '"Tau"  : 0.0001')
@@ -352,37 +383,58 @@ def generateScenarios(simulation_population, Kivalues, duration, monitoring_samp
         fin = open(os.path.join(temp_exp_dir, cfg_file), "wt")
         fin.write(cfg_txt)
 
-    for row_i, row in dfparam.iterrows():
-        Ki = row['Ki']
+    settings = []
+    for _, row in dfparam.iterrows():
         scen_num = row['scen_num']
 
-        replaceParameters(df=dfparam, row_i=row_i, Ki_i=Ki,  emodl_template=modelname, scen_num=scen_num)
+        if not args.render_on_node:
+            emodl_text = replaceParameters(row=row, emodl_template=modelname, scen_num=scen_num)
+        elif args.cache:
+            fin = open(os.path.join(temp_exp_dir, modelname), "rt")
+            emodl_text = render_emodl(fin.read(), row)
+            fin.close()
+        if args.warm_start is not None:
+            # the forward window ends at the same date as the full simulation
+            scen_duration = duration - int(row['checkpoint_time'])
+        else:
+            scen_duration = duration
+        if args.two_phase is not None:
+            # the first phase ends at the last data date
+            scen_duration = (pd.Timestamp(args.two_phase) - pd.Timestamp(row['startdate'])).days + 1
+        # keep the resolution of the monitoring samples for shorter durations
+        scen_samples = max(int(round(monitoring_samples * scen_duration / duration)), 1)
 
         # adjust model.cfg
         fin = open(os.path.join(temp_exp_dir, cfg_file), "rt")
-        data_cfg = fin.read()
-        data_cfg = data_cfg.replace('@duration@', str(duration))
-        data_cfg = data_cfg.replace('@monitoring_samples@', str(monitoring_samples))
-        data_cfg = data_cfg.replace('@nruns@', str(nruns))
-
-        if 'prng_seed' in data_cfg:
-            data_cfg = data_cfg.replace('@prng_seed@', str(np.random.randint(100000000)))
+        cfg_template = fin.read()
+        fin.close()
+        prng_seed = None
+        if 'prng_seed' in cfg_template:
+            prng_seed = np.random.randint(100000000)
         if not Location == 'Local':
-            data_cfg = data_cfg.replace('trajectories', f'trajectories_scen{scen_num}')
+            traj_fname = f'trajectories_scen{scen_num}'
         elif sys.platform not in ["win32", "cygwin"]:
             # When running on Linux or OSX (and not in Quest), assume the
             # trajectories directory is in the working directory.
             traj_fname = os.path.join('trajectories', f'trajectories_scen{scen_num}')
-            data_cfg = data_cfg.replace('trajectories', traj_fname)
         elif Location == 'Local':
-            data_cfg = data_cfg.replace('trajectories',
-                                        f'./_temp/{exp_name}/trajectories/trajectories_scen{scen_num}')
+            traj_fname = f'./_temp/{exp_name}/trajectories/trajectories_scen{scen_num}'
         else:
             raise RuntimeError("Unable to decide where to put the trajectories file.")
-        fin.close()
+        settings.append({'scen_num': scen_num, 'emodl_template': modelname, 'cfg_template': cfg_file,
+                         'duration': scen_duration, 'monitoring_samples': scen_samples, 'nruns': nruns,
+                         'prng_seed': prng_seed, 'trajectories': traj_fname})
+        if args.cache:
+            settings[-1]['cache_key'] = scenario_key(emodl_text, cfg_template, scen_duration, scen_samples, nruns,
+                                                     prng_seed)
+        if args.render_on_node:
+            continue
+        data_cfg = render_cfg(cfg_template, scen_duration, scen_samples, nruns, traj_fname, prng_seed)
         fin = open(os.path.join(temp_dir, "model_"+str(scen_num)+".cfg"), "wt")
         fin.write(data_cfg)
         fin.close()
+    # the settings are needed to render the scenarios on the compute nodes (render_scenarios.py)
+    pd.DataFrame(settings).to_csv(os.path.join(temp_dir, SETTINGS_FNAME), index=False)
 
     return len(dfparam)
 
@@ -421,6 +473,85 @@ def get_fitted_parameters(experiment_config, region):
     return fitted_parameters
 
 
+def get_tuned_cfgs():
+    """Cfg templates written into cfg/ by solvers/tune_step_size.py"""
+    cfg_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cfg')
+    return sorted(f for f in os.listdir(cfg_dir) if f.endswith('_tuned.cfg'))
+
+
+def select_scenario_cmds(scenario_cmds, cached=(), incomplete=None):
+    """Commands of the scenarios not linked from the simulation cache, and of the incomplete ones if given (--resume)
+
+    scenario_cmds is None for the batch solver (see get_scenario_cmds), which simulates all scenarios in one process
+    """
+    if scenario_cmds is None:
+        if incomplete is not None:
+            log.info("The batch solver cannot resume single scenarios, simulating all scenarios again")
+        return None
+    scenario_cmds = {i: cmd for i, cmd in scenario_cmds.items() if i not in cached}
+    if incomplete is not None:
+        scenario_cmds = {i: cmd for i, cmd in scenario_cmds.items() if i in incomplete}
+    return scenario_cmds
+
+
+def get_forecast_argv(argv, emodl_template, name_suffix, checkpoint_fname, history_dir):
+    """ Command line arguments of the forecast phase of a two-phase experiment: the first phase without
+    --two_phase (and --Rt_band, the samples are screened already), warm started from the pruned checkpoint.
+    Repeated options overwrite the ones of the first phase.
+    """
+    drop = {'--two_phase': 1, '--Rt_band': 2}
+    forecast_argv = []
+    skip = 0
+    for arg in argv:
+        if skip:
+            skip -= 1
+            continue
+        option = arg.split('=')[0]
+        if option in drop:
+            skip = drop[option] if '=' not in arg else drop[option] - 1
+            continue
+        forecast_argv.append(arg)
+    return forecast_argv + ['-e', emodl_template, '-n', f'{name_suffix}_forecast',
+                            '--warm_start', checkpoint_fname, '--stitch_history', history_dir]
+
+
+def call_step(cmd, manifest_dir=None):
+    """Run a postprocessing step, recorded in the manifest of manifest_dir if given (run_manifest.py)"""
+    if manifest_dir is None:
+        return subprocess.call(cmd)
+    cmd = cmd if isinstance(cmd, list) else [cmd]
+    return record(manifest_dir, cmd, step=os.path.basename(cmd[0]))
+
+
+def get_postprocessing_stages(post_process, bat_dir, manifest_dir=None):
+    """Postprocessing steps as stages (stage_pipeline.py) after the cleanup, with the steps they depend on"""
+    steps = {}
+    if post_process == 'dataComparison':
+        steps = {'2_runDataComparison': ['cleanup']}
+    if post_process == 'processForCivis':
+        # the steps after the trace selection load the ranked traces (processing_helpers.load_sim_data),
+        # the data comparison is run before as it loads the trajectories the same way
+        steps = {'2_runDataComparison': ['cleanup'],
+                 '1_runTraceSelection': ['2_runDataComparison'],
+                 '3_runProcessTrajectories': ['1_runTraceSelection'],
+                 # adds Rt to the civis csv file
+                 '4_runRtEstimation': ['3_runProcessTrajectories'],
+                 '5_runOverflowProbabilities': ['1_runTraceSelection'],
+                 '6_runPrevalenceIFR': ['1_runTraceSelection'],
+                 '7_runICUnonICU': ['1_runTraceSelection'],
+                 '8_runHospICUDeathsForecast': ['1_runTraceSelection'],
+                 # file copy and changelog of the outputs of all steps above
+                 '9_runCopyDeliverables': ['1_runTraceSelection', '2_runDataComparison', '4_runRtEstimation',
+                                           '5_runOverflowProbabilities', '6_runPrevalenceIFR', '7_runICUnonICU',
+                                           '8_runHospICUDeathsForecast'],
+                 '10_runIterationComparison': ['9_runCopyDeliverables']}
+    stages = []
+    for name, after in steps.items():
+        p0 = os.path.join(bat_dir, f'{name}.bat')
+        stages.append(Stage(name, lambda p0=p0: call_step([p0], manifest_dir), after=after, key=f'{name}.bat'))
+    return stages
+
+
 def get_start_dates(start_date):
     if isinstance(start_date, list):
         # `start_date` is a list of exactly two datetime.date objects,
@@ -522,10 +653,17 @@ def parse_args():
         "-cfg",
         "--cfg_template",
         type=str,
-        help=("Template cfg file to use. Default solver: model_B.cfg."
-             " For more details visit https://docs.idmod.org/projects/cms/en/latest/solvers.html"),
-        choices=["model_B.cfg", "model_Tau.cfg", "model_RLeapingFast.cfg", "model_RLeaping.cfg","model_FD.cfg","model_DFSP.cfg","model_SSA.cfg"],
-        default="model_B.cfg"
+        help=("Template cfg file to use. Default solver: model_B.cfg (model_NRM.cfg for the 'nu' campus models)."
+             " For more details visit https://docs.idmod.org/projects/cms/en/latest/solvers.html"
+             " model_ODE.cfg runs the deterministic mean-field model with a native python solver instead of CMS"
+             " (recommended with -dis 'uniform_mean', see solvers/README.md)."
+             " model_TauBatch.cfg simulates all scenarios and runs at once with a native batched tau-leaping solver."
+             " model_NRM.cfg runs exact stochastic simulations with a native next-reaction method solver."
+             " model_Hybrid.cfg simulates large compartments deterministically and small ones stochastically."
+             " *_tuned.cfg files written by solvers/tune_step_size.py are accepted as well"),
+        choices=["model_B.cfg", "model_Tau.cfg", "model_RLeapingFast.cfg", "model_RLeaping.cfg","model_FD.cfg","model_DFSP.cfg","model_SSA.cfg",
+                 "model_ODE.cfg", "model_TauBatch.cfg", "model_NRM.cfg", "model_Hybrid.cfg"] + get_tuned_cfgs(),
+        default=None
     )
     parser.add_argument(
         "-n",
@@ -592,6 +730,164 @@ def parse_args():
         #         "ki_multiplier_9", "ki_multiplier_10", "ki_multiplier_11", "ki_multiplier_12", "ki_multiplier_13"],
         default= [None]
     )
+    parser.add_argument(
+        "--Rt_band",
+        type=float,
+        nargs=2,
+        metavar=("LOW", "HIGH"),
+        help=("Only simulate parameter samples with a reproduction number within LOW and HIGH, "
+              "computed analytically from the template emodl before writing the scenarios"),
+        default=None
+    )
+    parser.add_argument(
+        "--Rt_times",
+        type=float,
+        nargs='+',
+        help="Days since start at which Rt has to be within --Rt_band, 0 for R0 (default)",
+        default=[0]
+    )
+    parser.add_argument(
+        "--warm_start",
+        type=str,
+        help=("Checkpoint csv written by solvers/checkpoint.py. Each checkpointed trajectory becomes a scenario"
+              " starting at the checkpoint date from its species values, simulating only the remaining duration."
+              " The emodl template has to be the one of the checkpointed experiment"),
+        default=None
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        help=("Number of scenarios simulated at the same time when running Local, default is the number of cores."
+              " 1 runs the scenarios one by one via runSimulations.bat"),
+        default=None
+    )
+    parser.add_argument(
+        "--max_writers",
+        type=int,
+        help="Local: number of scenarios writing their trajectories at the same time (native solvers)",
+        default=None
+    )
+    parser.add_argument(
+        "--warm_workers",
+        action='store_true',
+        help=("Start wine (or the CMS docker container) once for all scenarios when running Local on Linux/OSX,"
+              " instead of once per scenario"),
+    )
+    parser.add_argument(
+        "--scenarios_per_task",
+        type=int,
+        help=("NUCLUSTER: number of consecutive scenarios simulated per array task, default 1"
+              " (500 for the batch solver, see solvers/run_batch.py)"),
+        default=None
+    )
+    parser.add_argument(
+        "--task_cores",
+        type=int,
+        help="NUCLUSTER: cores per array task, scenarios of a task (--scenarios_per_task) run that many at a time",
+        default=1
+    )
+    parser.add_argument(
+        "--render_on_node",
+        action='store_true',
+        help=("NUCLUSTER: stage only the templates and sampled_parameters.csv, each array task renders the emodl and"
+              " cfg of its scenarios in node-local scratch (render_scenarios.py) and deletes them afterwards"),
+    )
+    parser.add_argument(
+        "--io_budget",
+        type=float,
+        help=("NUCLUSTER: filesystem bandwidth (MB/s) for trajectory writes, limits the array tasks running at the"
+              " same time (--array=...%%N) to those whose trajectories are written within a minute at this bandwidth"),
+        default=None
+    )
+    parser.add_argument(
+        "--stage_scratch",
+        action='store_true',
+        help=("NUCLUSTER: run each scenario in node-local scratch ($TMPDIR) and copy back only its trajectories file,"
+              " instead of writing on the shared filesystem. Runs in place if the node has no scratch"),
+    )
+    parser.add_argument(
+        "--cache",
+        action='store_true',
+        help=("Skip scenarios whose rendered emodl and cfg (including the seed) have been simulated before, their"
+              " trajectories are linked from the simulation cache (result_cache.py)"),
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Folder of the simulation cache, default simulation_cache in the working directory",
+        default=None
+    )
+    parser.add_argument(
+        "--cache_size_gb",
+        type=float,
+        help="Size limit of the simulation cache, least recently used trajectories are evicted",
+        default=CACHE_SIZE_GB
+    )
+    parser.add_argument(
+        "--max_resubmits",
+        type=int,
+        help="Number of times incomplete (missing, empty or truncated) trajectories are simulated again "
+             "before the postprocessing, see verify_scenarios.py",
+        default=MAX_RESUBMITS
+    )
+    parser.add_argument(
+        "--stream_ingest",
+        action='store_true',
+        help="Combine the trajectories of each scenario as soon as it is simulated, so that only a short final "
+             "step remains after the simulations, see stream_ingest.py",
+    )
+    parser.add_argument(
+        "--queue_workers",
+        type=int,
+        help="NUCLUSTER: number of array tasks pulling the scenarios from a queue in the experiment folder instead "
+             "of one task per scenario, see work_queue.py",
+        default=None
+    )
+    parser.add_argument(
+        "--shard_postprocessing",
+        action='store_true',
+        help="NUCLUSTER: run the per-region steps of the postprocessing for civis as array job, one task per "
+             "covid region and All, followed by a job combining the regions",
+    )
+    parser.add_argument(
+        "--manifest",
+        action='store_true',
+        help="Record each scenario and postprocessing step (host, timings, exit code, CPU, memory, output size) "
+             "in the SQLite manifest of the experiment, see run_manifest.py",
+    )
+    parser.add_argument(
+        "--resume",
+        action='store_true',
+        help="Local: continue the experiment of the same name from the first failed or stale stage, completed "
+             "stages (markers in the stages folder of the experiment) are skipped, see stage_pipeline.py",
+    )
+    parser.add_argument(
+        "--two_phase",
+        type=str,
+        metavar="LAST_DATA_DATE",
+        help=("Two-phase execution (Local only): simulate until the last data date (YYYY-MM-DD), keep the best"
+              " fitting trajectories (plotters/prune_traces.py) and continue only these to the end of the duration"),
+        default=None
+    )
+    parser.add_argument(
+        "--traces_to_keep_ratio",
+        type=int,
+        help="Ratio of trajectories continued to the forecast in a two-phase execution",
+        default=4
+    )
+    parser.add_argument(
+        "--traces_to_keep_min",
+        type=int,
+        help="Minimum number of trajectories continued to the forecast in a two-phase execution",
+        default=100
+    )
+    parser.add_argument(
+        "--stitch_history",
+        type=str,
+        help=("Experiment folder of the checkpointed trajectories of a --warm_start, their history before the"
+              " checkpoint is prepended to the trajectories (set by --two_phase)"),
+        default=None
+    )
     return parser.parse_args()
 
 
@@ -604,6 +900,9 @@ if __name__ == '__main__':
     emodl_template = args.emodl_template
     model = args.model
     scenario = args.scenario
+    if args.cfg_template is None:
+        # small campus populations need exact stochastic simulations
+        args.cfg_template = "model_NRM.cfg" if model == "nu" else "model_B.cfg"
 
     if args.running_location is None:
         if os.name == "posix":
@@ -643,6 +942,34 @@ if __name__ == '__main__':
         if len(subregion) < 11:
             subregion_label = '_sub'
 
+    if args.render_on_node and Location == 'Local':
+        raise ValueError("--render_on_node is only supported on NUCLUSTER")
+    if args.stage_scratch and Location == 'Local':
+        raise ValueError("--stage_scratch is only supported on NUCLUSTER")
+    if args.io_budget is not None and Location == 'Local':
+        raise ValueError("--io_budget is only supported on NUCLUSTER, use --max_writers when running Local")
+    if args.queue_workers and args.scenarios_per_task is not None:
+        raise ValueError("--queue_workers and --scenarios_per_task are exclusive")
+    if args.resume and Location != 'Local':
+        raise ValueError("--resume is only supported Local, on NUCLUSTER incomplete scenarios are resubmitted by the "
+                         "postprocessing job (verify_scenarios.py)")
+    if args.two_phase is not None or args.stitch_history is not None:
+        if Location != 'Local':
+            raise ValueError("Two-phase execution is only supported Local, on NUCLUSTER run plotters/prune_traces.py "
+                             "after the first phase and submit the forecast with --warm_start")
+    if (args.warm_start is not None or args.two_phase is not None) and is_batch_cfg(os.path.join(cfg_dir, args.cfg_template)):
+        # run_batch.py simulates all scenarios with the duration of the first one from the template emodl
+        raise ValueError(f"--warm_start and --two_phase are not supported with the batch solver of {args.cfg_template}, "
+                         "use a solver simulating each scenario (i.e. model_Tau.cfg)")
+    if args.stream_ingest and args.stitch_history is not None:
+        log.info("The trajectories are stitched after the simulations, ignoring --stream_ingest")
+        args.stream_ingest = False
+    if args.two_phase is not None:
+        # the checkpoint of the first phase requires all species
+        args.observeLevel = 'all'
+        # the forecast phase runs the post processing of the full trajectories
+        args.post_process = None
+
     if emodl_template is None:
         log.debug(f"Running scenarios for {model} and {scenario}")
         emodl_template = write_emodl(model=model,
@@ -702,6 +1029,24 @@ if __name__ == '__main__':
               f"sim_output_path = {sim_output_path}\n"
               f"plot_path = {plot_path}")
 
+    experiment_settings = {'model': model, 'observe_level': args.observeLevel,
+                           'duration': experiment_setup_parameters['duration'], 'cfg_template': args.cfg_template}
+    if args.manifest:
+        write_experiment(temp_exp_dir, nruns=experiment_setup_parameters['number_of_runs'], **experiment_settings)
+
+    if args.render_on_node and is_batch_cfg(os.path.join(temp_exp_dir, args.cfg_template)):
+        log.info("The batch solver renders the scenarios from the template already, ignoring --render_on_node")
+        args.render_on_node = False
+    if args.stage_scratch and is_batch_cfg(os.path.join(temp_exp_dir, args.cfg_template)):
+        log.info("The batch solver writes one file per task already, ignoring --stage_scratch")
+        args.stage_scratch = False
+    if args.cache and is_batch_cfg(os.path.join(temp_exp_dir, args.cfg_template)):
+        log.info("The batch solver simulates all scenarios at once, ignoring --cache")
+        args.cache = False
+    if args.queue_workers and is_batch_cfg(os.path.join(temp_exp_dir, args.cfg_template)):
+        log.info("The batch solver splits the scenarios into tasks already, ignoring --queue_workers")
+        args.queue_workers = None
+
     nscen = generateScenarios(
         simulation_population, Kivalues,
         nruns=experiment_setup_parameters['number_of_runs'],
@@ -715,75 +1060,155 @@ if __name__ == '__main__':
         region=region,
         paramdistribution=args.paramdistribution)
 
+    cached = []
+    if args.cache:
+        cache_dir = args.cache_dir or os.path.join(wdir, 'simulation_cache')
+        cache = ResultCache(cache_dir, max_size_gb=args.cache_size_gb)
+        cached = link_cached_scenarios(temp_exp_dir, trajectories_dir, cache)
+
     if Location == 'NUCLUSTER':
-        generateSubmissionFile_quest(nscen, exp_name, args.experiment_config, trajectories_dir,git_dir, temp_exp_dir,exe_dir,sim_output_path,model)
+        # time limit and memory from previous experiments with the same settings, if run with --manifest
+        sim_resources, post_resources = size_experiment(os.path.dirname(sim_output_path), **experiment_settings)
+        shard_regions = None
+        if args.shard_postprocessing:
+            # region 0 is All (processing_helpers.get_group_names)
+            shard_regions = [int(reg.replace('EMS_', '')) for reg in subregion]
+            if len(shard_regions) > 1:
+                shard_regions = [0] + shard_regions
+        max_concurrent = None
+        if args.io_budget is not None:
+            # trajectories of previous experiments with the same settings, otherwise estimated from the emodl
+            output_mb = size_output(os.path.dirname(sim_output_path), **experiment_settings) or estimate_output_mb(
+                os.path.join(temp_exp_dir, emodl_template), experiment_setup_parameters['number_of_runs'],
+                experiment_setup_parameters['monitoring_samples'])
+            if args.scenarios_per_task is not None and args.scenarios_per_task > 1:
+                # scenarios of a task run task_cores at a time
+                output_mb *= min(args.task_cores, args.scenarios_per_task)
+            max_concurrent = max_concurrent_tasks(output_mb, args.io_budget)
+            log.info(f"Running at most {max_concurrent} array tasks at a time ({output_mb:.1f} MB of trajectories "
+                     f"per task, {args.io_budget} MB/s)")
+        generateSubmissionFile_quest(nscen, exp_name, args.experiment_config, trajectories_dir,git_dir, temp_exp_dir,exe_dir,sim_output_path,model,
+                                     cfg_file=args.cfg_template, scenarios_per_task=args.scenarios_per_task,
+                                     task_cores=args.task_cores, render_on_node=args.render_on_node,
+                                     cached_scenarios=cached, cache_dir=cache_dir if args.cache else None,
+                                     max_resubmits=args.max_resubmits, manifest=args.manifest,
+                                     sim_resources=sim_resources, post_resources=post_resources,
+                                     stream_ingest=args.stream_ingest, shard_regions=shard_regions,
+                                     queue_workers=args.queue_workers, stage_scratch=args.stage_scratch,
+                                     max_concurrent=max_concurrent)
         submission_script=None
         if args.post_process == 'processForCivis':
             submission_script = 'submit_runSimulations_for_civis.sh'
         runExp(trajectories_dir=temp_exp_dir, Location='NUCLUSTER',submission_script=submission_script )
+        log.info(f"Progress: python {os.path.join(git_dir, 'monitor.py')} -d {temp_exp_dir} --watch")
 
     if Location == 'Local':
         generateSubmissionFile(
             nscen, exp_name, args.experiment_config,trajectories_dir, temp_dir, temp_exp_dir,sim_output_path,
-            model=model,exe_dir=exe_dir, docker_image=docker_image)
-
-        runExp(trajectories_dir=trajectories_dir, Location='Local')
-
+            model=model,exe_dir=exe_dir, docker_image=docker_image, git_dir=git_dir, cfg_file=args.cfg_template,
+            manifest=args.manifest)
+
+        exp_dirs = [sim_output_path, temp_exp_dir]
+        # after an interrupted run only the incomplete scenarios are simulated, all if the inputs have changed
+        resume_simulations = args.resume and read_marker(exp_dirs, 'simulations') is None
+
+        def run_simulations():
+            scenario_cmds = None
+            worker_pool = None
+            ingest = None
+            try:
+                if args.warm_workers and not is_native_cfg(os.path.join(temp_exp_dir, args.cfg_template)):
+                    worker_pool = CMSWorkerPool(temp_exp_dir, exe_dir, docker_image=docker_image).start()
+                if args.n_workers != 1 or worker_pool is not None or cached or resume_simulations:
+                    scenario_cmds = get_scenario_cmds(nscen, temp_dir, temp_exp_dir, args.cfg_template, exe_dir=exe_dir,
+                                                      docker_image=docker_image, git_dir=git_dir,
+                                                      cms_cmd=worker_pool.cms_cmd if worker_pool else None, manifest=args.manifest)
+                    incomplete = None
+                    if resume_simulations:
+                        incomplete = find_incomplete_scenarios(temp_exp_dir, trajectories_dir)
+                        log.info(f"Resuming, {len(incomplete)} of {nscen} scenarios are not simulated yet")
+                    scenario_cmds = select_scenario_cmds(scenario_cmds, cached, incomplete)
+                if args.stream_ingest:
+                    ingest = subprocess.Popen([sys.executable, os.path.join(git_dir, 'stream_ingest.py'), '-d', temp_exp_dir,
+                                               '--watch', '--interval', '10'])
+                runExp(trajectories_dir=trajectories_dir, Location='Local', scenario_cmds=scenario_cmds,
+                       log_dir=os.path.join(temp_exp_dir, 'log'), n_workers=args.n_workers,
+                       max_writers=args.max_writers)
+                incomplete = verify_scenarios(temp_exp_dir, trajectories_dir)
+                rerun_cmds = get_scenario_cmds(nscen, temp_dir, temp_exp_dir, args.cfg_template, exe_dir=exe_dir,
+                                               docker_image=docker_image, git_dir=git_dir,
+                                               cms_cmd=worker_pool.cms_cmd if worker_pool else None, manifest=args.manifest)
+                for attempt in range(args.max_resubmits):
+                    # the batch solver has no commands per scenario
+                    if not incomplete or rerun_cmds is None:
+                        break
+                    log.info(f"Simulating {len(incomplete)} incomplete scenarios again ({attempt + 1}/{args.max_resubmits})")
+                    runExp(trajectories_dir=trajectories_dir, Location='Local',
+                           scenario_cmds={i: rerun_cmds[i] for i in incomplete},
+                           log_dir=os.path.join(temp_exp_dir, 'log'), n_workers=args.n_workers,
+                           max_writers=args.max_writers)
+                    incomplete = verify_scenarios(temp_exp_dir, trajectories_dir)
+            finally:
+                if worker_pool is not None:
+                    worker_pool.stop()
+                if ingest is not None:
+                    ingest.terminate()
+                    ingest.wait()
+            if ingest is not None:
+                finalize(temp_exp_dir)
+            if args.cache:
+                store_scenarios(temp_exp_dir, trajectories_dir, cache)
+            if incomplete:
+                # not marked as done, --resume simulates them again
+                log.error(f"{len(incomplete)} scenarios are incomplete, see {temp_exp_dir}/incomplete_scenarios.csv")
+                return 1
+            if args.stitch_history is not None:
+                stitch_history(temp_exp_dir, args.stitch_history, trajectories_dir=trajectories_dir)
+
+        def run_cleanup():
+            cleanup(temp_dir=temp_dir, temp_exp_dir=temp_exp_dir, sim_output_path=sim_output_path,
+                    plot_path=plot_path, delete_temp_dir=True, overwrite=args.resume)
+            log.info(f"Outputs are in {sim_output_path}")
+
+        def run_sample_plot():
+            try:
+                runSamplePlot(sim_output_path=sim_output_path, plot_path=plot_path,start_dates=start_dates,channel_list_name="master")
+                log.info("Sample plot generated")
+            except:
+                log.info("Sample plot not generated")
+
+        manifest_dir = sim_output_path if args.manifest else None
         #combineTrajectories(Nscenarios=nscen, trajectories_dir=trajectories_dir,
         #                    temp_exp_dir=temp_exp_dir, deleteFiles=False)
-        subprocess.call(os.path.join(temp_exp_dir,'bat', '0_runCombineAndTrimTrajectories.bat'))
-        cleanup(temp_dir=temp_dir, temp_exp_dir=temp_exp_dir, sim_output_path=sim_output_path,
-                plot_path=plot_path, delete_temp_dir=True)
-        log.info(f"Outputs are in {sim_output_path}")
-
-        log.info("Sample plot")
-        try:
-            runSamplePlot(sim_output_path=sim_output_path, plot_path=plot_path,start_dates=start_dates,channel_list_name="master")
-            log.info("Sample plot generated")
-        except:
-            log.info("Sample plot not generated")
-
-        if args.post_process == 'dataComparison':
-            log.info("Compare to data")
-            p0 = os.path.join(sim_output_path,'bat', '2_runDataComparison.bat')
-            subprocess.call([p0])
-
-        if args.post_process == 'processForCivis':
-
-            log.info("Compare to data")
-            p0 = os.path.join(sim_output_path, 'bat','2_runDataComparison.bat')
-            subprocess.call([p0])
-
-            log.info("Trace selection")
-            p0 = os.path.join(sim_output_path,'bat' , '1_runTraceSelection.bat')
-            subprocess.call([p0])
-
-            log.info("Process for civis - csv file")
-            p0 = os.path.join(sim_output_path, 'bat' ,'3_runProcessTrajectories.bat')
-            subprocess.call([p0])
-
-            log.info("Process for civis - Rt estimation")
-            p0 = os.path.join(sim_output_path,'bat' , '4_runRtEstimation.bat')
-            subprocess.call([p0])
-
-            log.info("Process for civis - overflow probabilities")
-            p0 = os.path.join(sim_output_path, 'bat' ,'5_runOverflowProbabilities.bat')
-            subprocess.call([p0])
-
-            log.info("Additional plots")
-            p0 = os.path.join(sim_output_path, 'bat', '6_runPrevalenceIFR.bat')
-            subprocess.call([p0])
-
-            p0 = os.path.join(sim_output_path, 'bat', '7_runICUnonICU.bat')
-            subprocess.call([p0])
-
-            p0 = os.path.join(sim_output_path, 'bat', '8_runHospICUDeathsForecast.bat')
-            subprocess.call([p0])
-
-            log.info("Process for civis - file copy and changelog")
-            p0 = os.path.join(sim_output_path,'bat' , '9_runCopyDeliverables.bat')
-            subprocess.call([p0])
-
-            log.info("Process for civis - file copy and changelog")
-            p0 = os.path.join(sim_output_path,'bat' , '10_runIterationComparison.bat')
-            subprocess.call([p0])
+        stages = [Stage('simulations', run_simulations, key=str(nscen),
+                        inputs=[emodl_template, args.cfg_template, 'sampled_parameters.csv',
+                                os.path.join('simulations', SETTINGS_FNAME)]),
+                  Stage('combine', lambda: call_step(os.path.join(temp_exp_dir, 'bat', '0_runCombineAndTrimTrajectories.bat'),
+                                                     temp_exp_dir if args.manifest else None),
+                        inputs=['trajectories'], after=['simulations'], key='0_runCombineAndTrimTrajectories.bat'),
+                  Stage('cleanup', run_cleanup, after=['combine']),
+                  Stage('sample_plot', run_sample_plot, after=['cleanup'])]
+        stages += get_postprocessing_stages(args.post_process, os.path.join(sim_output_path, 'bat'), manifest_dir)
+        status = run_stages(stages, exp_dirs, resume=args.resume)
+        if status.get('cleanup') == 'skipped' and os.path.exists(sim_output_path):
+            # the experiment folder created again for resuming
+            shutil.rmtree(temp_exp_dir, ignore_errors=True)
+        failed = [name for name, stage_status in status.items() if stage_status in ('failed', 'blocked')]
+        if failed:
+            log.error(f"Stages {failed} did not complete, continue with --resume")
+            sys.exit(1)
+
+        if args.two_phase is not None:
+            log.info("Two-phase execution - prune trajectories against data until " + args.two_phase)
+            subprocess.call([sys.executable, 'prune_traces.py', '-exp', exp_name, '-loc', Location,
+                             '--checkpoint_date', args.two_phase,
+                             '--traces_to_keep_ratio', str(args.traces_to_keep_ratio),
+                             '--traces_to_keep_min', str(args.traces_to_keep_min)],
+                            cwd=os.path.join(git_dir, 'plotters'))
+            checkpoint_fname = os.path.join(
+                sim_output_path, f"checkpoint_{pd.Timestamp(args.two_phase).strftime('%Y%m%d')}_best.csv")
+            log.info("Two-phase execution - forecast of the best trajectories")
+            subprocess.call([sys.executable, 'runScenarios.py'] +
+                            get_forecast_argv(sys.argv[1:], emodl_template, args.name_suffix,
+                                              checkpoint_fname, sim_output_path),
+                            cwd=git_dir)
@@ -0,0 +1,210 @@
+"""
+Experiment-local SQLite manifest of all simulation and postprocessing runs (runScenarios.py --manifest).
+
+Each scenario (local executor, runSimulations.bat/sh or NUCLUSTER array task) and each postprocessing step is started
+through this script, which runs the command and records a row into <exp_dir>/manifest.sqlite:
+step, scen_num, task and job id, host, start and end time, exit code, CPU seconds, peak RSS and trajectory bytes.
+The settings of the experiment (model, observeLevel, duration, cfg and runs) are recorded as well, so that the runs of
+later experiments can be sized from it (resource_sizing.py).
+
+python run_manifest.py -d _temp/<exp_name> --step simulation --scen_num 1 -- <command>
+
+Without a command the manifest is summarized:
+
+python run_manifest.py -d _temp/<exp_name> --report stragglers failures throughput
+
+CPU seconds and peak RSS are those of the command and its children (not available on Windows).
+Many array tasks write into the same manifest, writes are retried while the database is locked.
+"""
+import argparse
+import datetime
+import os
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+MANIFEST_FNAME = 'manifest.sqlite'
+REPORTS = ['stragglers', 'failures', 'throughput']
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS runs (
+    step TEXT, scen_num INTEGER, task_id TEXT, job_id TEXT, host TEXT, start REAL, end REAL, exit_code INTEGER,
+    cpu_seconds REAL, max_rss_mb REAL, trajectory_bytes INTEGER)"""
+EXPERIMENT_COLUMNS = ['model', 'observe_level', 'duration', 'cfg_template', 'nruns']
+
+
+def connect(exp_dir, timeout=300):
+    con = sqlite3.connect(os.path.join(exp_dir, MANIFEST_FNAME), timeout=timeout)
+    con.execute(SCHEMA)
+    return con
+
+
+def write_experiment(exp_dir, **settings):
+    """Settings of the experiment (EXPERIMENT_COLUMNS), to compare the runs of experiments, see resource_sizing.py"""
+    with connect(exp_dir) as con:
+        con.execute(f"CREATE TABLE IF NOT EXISTS experiment ({', '.join(EXPERIMENT_COLUMNS)})")
+        con.execute("DELETE FROM experiment")
+        con.execute(f"INSERT INTO experiment VALUES ({', '.join('?' * len(EXPERIMENT_COLUMNS))})",
+                    [settings.get(col) for col in EXPERIMENT_COLUMNS])
+    con.close()
+
+
+def insert_run(exp_dir, run, retries=10):
+    """Insert a run (dict of the manifest columns), retried if the manifest is locked by other tasks"""
+    for attempt in range(retries):
+        try:
+            with connect(exp_dir) as con:
+                con.execute(f"INSERT INTO runs ({', '.join(run)}) VALUES ({', '.join('?' * len(run))})",
+                            list(run.values()))
+            con.close()
+            return
+        except sqlite3.OperationalError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(1 + attempt)
+
+
+def wait_with_rusage(process):
+    """Exit code, CPU seconds and peak RSS (MB) of a finished process"""
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None, None
+    _, status, rusage = os.wait4(process.pid, 0)
+    # as Popen.returncode, os.waitstatus_to_exitcode needs Python 3.9
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    max_rss_mb = rusage.ru_maxrss / 1024 ** (2 if sys.platform == 'darwin' else 1)
+    return process.returncode, rusage.ru_utime + rusage.ru_stime, max_rss_mb
+
+
+def record(exp_dir, cmd, step='simulation', scen_num=None):
+    """Run cmd (list of arguments) and record it in the manifest of exp_dir, returns the exit code"""
+    start = time.time()
+    try:
+        process = subprocess.Popen(cmd)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        exit_code, cpu_seconds, max_rss_mb = 127, None, None
+    else:
+        exit_code, cpu_seconds, max_rss_mb = wait_with_rusage(process)
+    trajectory_bytes = None
+    if scen_num is not None:
+        fname = os.path.join(exp_dir, 'trajectories', f'trajectories_scen{scen_num}.csv')
+        if not os.path.exists(fname):
+            # written in node-local scratch, copied back after the command (simulation_helpers.stage_on_node)
+            fname = f'trajectories_scen{scen_num}.csv'
+        trajectory_bytes = os.path.getsize(fname) if os.path.exists(fname) else 0
+    insert_run(exp_dir, {
+        'step': step, 'scen_num': scen_num,
+        'task_id': os.environ.get('SLURM_ARRAY_TASK_ID'),
+        'job_id': os.environ.get('SLURM_ARRAY_JOB_ID', os.environ.get('SLURM_JOB_ID')),
+        'host': socket.gethostname(), 'start': start, 'end': time.time(), 'exit_code': exit_code,
+        'cpu_seconds': cpu_seconds, 'max_rss_mb': max_rss_mb, 'trajectory_bytes': trajectory_bytes})
+    return exit_code
+
+
+def get_manifest_cmd(git_dir, exp_dir, step='simulation', scen_num=None):
+    """Prefix of a shell command to record it in the manifest"""
+    cmd = f'python "{os.path.join(git_dir, "run_manifest.py")}" -d "{exp_dir}" --step {step}'
+    if scen_num is not None:
+        cmd += f' --scen_num {scen_num}'
+    return cmd + ' -- '
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+def report_stragglers(con, top=10, factor=2):
+    """Slowest simulations, compared to the median duration"""
+    rows = con.execute("SELECT scen_num, host, end - start AS duration, exit_code FROM runs "
+                       "WHERE step = 'simulation' ORDER BY duration DESC").fetchall()
+    median = statistics.median(row[2] for row in rows) if rows else 0
+    if median == 0:
+        return
+    print(f"Stragglers (median duration {median:.0f}s):")
+    for scen_num, host, duration, exit_code in rows[:top]:
+        if duration < factor * median:
+            break
+        print(f"  scen {scen_num} on {host}: {duration:.0f}s ({duration / median:.1f}x), exit code {exit_code}")
+
+
+def report_failures(con):
+    """Failed runs per step and host"""
+    rows = con.execute("SELECT step, host, SUM(exit_code != 0) AS n_failed, COUNT(*) FROM runs "
+                       "GROUP BY step, host HAVING n_failed > 0 ORDER BY n_failed DESC").fetchall()
+    print("Failures:" + ('' if rows else ' none'))
+    for step, host, n_failed, n_runs in rows:
+        print(f"  {step} on {host}: {n_failed} of {n_runs} failed")
+
+
+def report_throughput(con, minutes=10):
+    """Finished simulations and trajectory output per time interval"""
+    rows = con.execute("SELECT CAST(end / ? AS INTEGER) * ? AS bin, COUNT(*), SUM(trajectory_bytes), "
+                       "SUM(cpu_seconds) FROM runs WHERE step = 'simulation' GROUP BY bin ORDER BY bin",
+                       (minutes * 60, minutes * 60)).fetchall()
+    print(f"Throughput per {minutes} minutes:")
+    n_total = 0
+    for interval, n_runs, trajectory_bytes, cpu_seconds in rows:
+        n_total += n_runs
+        print(f"  {format_time(interval)}: {n_runs} scenarios ({n_total} total), "
+              f"{(trajectory_bytes or 0) / 1024 ** 2:.0f} MB, {(cpu_seconds or 0) / 3600:.1f} CPU hours")
+
+
+def parse_args():
+    description = "Record a run in the manifest of an experiment, or summarize the manifest"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-d",
+        "--exp_dir",
+        type=str,
+        help="Experiment folder of manifest.sqlite",
+        required=True
+    )
+    parser.add_argument(
+        "--step",
+        type=str,
+        help="Name of the recorded step, i.e. simulation or the postprocessing script",
+        default='simulation'
+    )
+    parser.add_argument(
+        "--scen_num",
+        type=int,
+        help="Scenario of the recorded simulation",
+        default=None
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        nargs='+',
+        choices=REPORTS,
+        help="Summaries to print if no command is given",
+        default=REPORTS
+    )
+    parser.add_argument(
+        "--minutes",
+        type=int,
+        help="Time interval of the throughput report",
+        default=10
+    )
+    parser.add_argument(
+        "cmd",
+        nargs=argparse.REMAINDER,
+        help="Command to run and record, after --"
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+    if cmd:
+        sys.exit(record(args.exp_dir, cmd, step=args.step, scen_num=args.scen_num))
+    con = connect(args.exp_dir)
+    if 'stragglers' in args.report:
+        report_stragglers(con)
+    if 'failures' in args.report:
+        report_failures(con)
+    if 'throughput' in args.report:
+        report_throughput(con, minutes=args.minutes)
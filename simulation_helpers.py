@@ -1,3 +1,6 @@
+import concurrent.futures
+import errno
+import hashlib
 import logging
 import os
 import subprocess
@@ -16,6 +19,10 @@ mpl.rcParams['pdf.fonttype'] = 42
 from processing_helpers import CI_50, CI_25, CI_75,CI_2pt5, CI_97pt5
 
 from load_paths import load_box_paths
+from run_manifest import get_manifest_cmd
+from work_queue import get_worker_cmd, init_queue
+from solvers.run_solver import is_native_cfg, is_batch_cfg
+from solvers.run_batch import SCENARIOS_PER_TASK, get_n_tasks
 datapath, projectpath, WDIR, EXE_DIR, GIT_DIR = load_box_paths()
 
 log = logging.getLogger(__name__)
@@ -73,9 +80,91 @@ def get_cms_cmd(exe_dir=EXE_DIR, workdir=None, docker_image=None):
         return cmd
 
 
-def runExp(trajectories_dir, Location = 'Local', submission_script=None ):
+def get_native_solver_cmd(git_dir=GIT_DIR, workdir=None):
+    """Generate the command to run a native python solver instead of CMS
+
+    Takes the same -c and -m arguments as `compartments.exe`,
+    the solver is selected via the "solver" entry of the cfg file (see solvers/run_solver.py).
+
+    Parameters
+    ----------
+    git_dir : str, optional
+        The directory of the covid-chicago repository
+    workdir : str, optional
+        The working directory, the output prefix in the cfg file is relative to it.
+        If not provided, the output is relative to the current directory.
+
+    Returns
+    -------
+    cmd : str
+        A string which can be executed to run the native solver
+    """
+    cmd = f'python "{os.path.join(git_dir, "solvers", "run_solver.py")}"'
+    if workdir:
+        cmd = f'{cmd} -d {workdir}'
+    return cmd
+
+
+def get_batch_solver_cmd(exp_dir, git_dir=GIT_DIR):
+    """Generate the command to run all scenarios of an experiment with a native batch solver
+
+    Parameters
+    ----------
+    exp_dir : str
+        The experiment folder including the template emodl, sampled_parameters.csv and rendered cfg files
+    git_dir : str, optional
+        The directory of the covid-chicago repository
+
+    Returns
+    -------
+    cmd : str
+        A string which can be executed to run the batch solver, see solvers/run_batch.py
+    """
+    return f'python "{os.path.join(git_dir, "solvers", "run_batch.py")}" -d "{exp_dir}"'
+
+
+def get_scenario_cmds(scen_num, temp_dir, temp_exp_dir, cfg_file, exe_dir=EXE_DIR, docker_image=None, git_dir=GIT_DIR,
+                      cms_cmd=None, manifest=False):
+    """Generate the command of each scenario of a local experiment, as in runSimulations.bat
+
+    Parameters
+    ----------
+    cms_cmd : str, optional
+        Command invoking CMS instead of get_cms_cmd, i.e. of a local_executor.CMSWorkerPool
+    manifest : bool
+        Record each scenario in the manifest of the experiment (run_manifest.py)
+
+    Returns
+    -------
+    scenario_cmds : dict
+        Command per scen_num, None for batch solvers which simulate all scenarios in one process
+    """
+    if is_batch_cfg(os.path.join(temp_exp_dir, cfg_file)):
+        return None
+    windows = sys.platform in ["win32", "cygwin"]
+    if is_native_cfg(os.path.join(temp_exp_dir, cfg_file)):
+        cms_cmd = get_native_solver_cmd(git_dir, None if windows else temp_exp_dir)
+    elif cms_cmd is None:
+        cms_cmd = f'"{get_cms_cmd(exe_dir, temp_exp_dir)}"' if windows else get_cms_cmd(exe_dir, temp_exp_dir, docker_image)
+    return {i: (get_manifest_cmd(git_dir, temp_exp_dir, scen_num=i) if manifest else '') +
+               f'{cms_cmd} -c "{os.path.join(temp_dir, f"model_{i}.cfg")}" '
+               f'-m "{os.path.join(temp_dir, f"simulation_{i}.emodl")}"'
+            for i in range(1, scen_num + 1)}
+
+
+def runExp(trajectories_dir, Location = 'Local', submission_script=None, scenario_cmds=None, log_dir=None,
+           n_workers=None, max_writers=None):
+    """Run the experiment, locally the scenario_cmds (see get_scenario_cmds) run concurrently
+    with n_workers processes (local_executor.py), of which max_writers write their trajectories at the same time,
+    otherwise runSimulations.bat runs the scenarios one by one.
+    Returns the exit code per scenario if run concurrently.
+    """
     if Location =='Local' :
         log.info("Starting experiment.")
+        if scenario_cmds is not None:
+            from local_executor import run_scenarios
+            return run_scenarios(scenario_cmds, log_dir=log_dir or os.path.join(trajectories_dir, 'log'),
+                                 n_workers=n_workers, max_writers=max_writers)
         p = os.path.join(trajectories_dir,  'runSimulations.bat')
         subprocess.call([p])
     if Location =='NUCLUSTER' :
@@ -141,21 +230,65 @@ def combineTrajectories(Nscenarios,trajectories_dir, temp_exp_dir, deleteFiles=F
     return dfc
 
 
-def cleanup(temp_dir, temp_exp_dir, sim_output_path,plot_path, delete_temp_dir=True) :
+def file_checksum(fname, chunk_size=1024 ** 2):
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def copy_verified(src, dst):
+    """Copy a file and compare the checksums of both copies"""
+    shutil.copy2(src, dst)
+    if file_checksum(src) != file_checksum(dst):
+        raise OSError(f"Checksum of {dst} differs from {src}")
+
+
+def move_tree(src, dst, n_workers=8):
+    """Move the folder src to dst, merged into dst if it exists already
+
+    On the same filesystem the folder (or, merging, each file) is renamed, nothing is copied. Otherwise the files are
+    copied by n_workers threads and verified by their checksums before src is deleted.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    if not os.path.exists(dst):
+        try:
+            os.rename(src, dst)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    same_filesystem = os.path.exists(dst) and os.stat(src).st_dev == os.stat(dst).st_dev
+    files = []
+    for root, dirs, fnames in os.walk(src):
+        out_dir = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(out_dir, exist_ok=True)
+        files += [(os.path.join(root, fname), os.path.join(out_dir, fname)) for fname in fnames]
+    if same_filesystem:
+        for src_fname, dst_fname in files:
+            os.replace(src_fname, dst_fname)
+    else:
+        log.info(f"Copying {len(files)} files from {src} to {dst} (different filesystem)")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # list() raises the first failed copy, src is kept then
+            list(executor.map(lambda args: copy_verified(*args), files))
+    shutil.rmtree(src, ignore_errors=True)
+
+
+def cleanup(temp_dir, temp_exp_dir, sim_output_path,plot_path, delete_temp_dir=True, overwrite=False) :
     # Delete simulation model and emodl files
     # But keeps per default the trajectories, better solution, zip folders and copy
+    # overwrite: move into an existing sim_output_path, i.e. of a resumed experiment (runScenarios.py --resume)
     if delete_temp_dir:
         shutil.rmtree(temp_dir, ignore_errors=True)
         print('temp_dir folder deleted')
+    if overwrite and os.path.exists(sim_output_path):
+        move_tree(temp_exp_dir, sim_output_path)
     if not os.path.exists(sim_output_path):
-        shutil.copytree(temp_exp_dir, sim_output_path)
+        move_tree(temp_exp_dir, sim_output_path)
         if not os.path.exists(plot_path):
             os.makedirs(plot_path)
-        # Delete files after being copied to the project folder
-        if os.path.exists(sim_output_path):
-            shutil.rmtree(temp_exp_dir, ignore_errors=True)
-        elif not os.path.exists(sim_output_path):
-            print('Sim_output_path does not exists')
 
 
 def writeTxt(txtdir, filename, textstring) :
@@ -184,36 +317,61 @@ def get_process_dict():
     return process_dict
 
 def generateSubmissionFile(scen_num, exp_name, experiment_config, trajectories_dir, temp_dir, temp_exp_dir,sim_output_path,
-                           model, exe_dir=EXE_DIR, docker_image="cms", git_dir=GIT_DIR, wdir=WDIR):
-
+                           model, exe_dir=EXE_DIR, docker_image="cms", git_dir=GIT_DIR, wdir=WDIR, cfg_file=None,
+                           manifest=False):
+    # manifest: record each scenario in the manifest of the experiment (run_manifest.py)
 
     process_dict = get_process_dict()
+    native_solver = cfg_file is not None and is_native_cfg(os.path.join(temp_exp_dir, cfg_file))
+    batch_solver = cfg_file is not None and is_batch_cfg(os.path.join(temp_exp_dir, cfg_file))
 
     fname = f'runSimulations.bat'
     log.debug(f"Generating submission file {fname}")
+    windows = sys.platform in ["win32", "cygwin"]
+    manifest_cmd = ''
+    if manifest:
+        manifest_cmd = get_manifest_cmd(git_dir, temp_exp_dir, scen_num=None if batch_solver else '%%i' if windows else '$i')
     if sys.platform not in ["win32", "cygwin"]:
         file = open(os.path.join(trajectories_dir, fname), 'w')
         # If this is OSX or Linux, mark the file as executable and
         # write a bash script
-        os.chmod(fname, stat.S_IXUSR | stat.S_IWUSR | stat.S_IRUSR)
+        os.chmod(os.path.join(trajectories_dir, fname), stat.S_IXUSR | stat.S_IWUSR | stat.S_IRUSR)
         cfg_fname = os.path.join(temp_dir, 'model_$i.cfg')
         emodl_fname = os.path.join(temp_dir, 'simulation_$i.emodl')
-        file.write(f"""#!/bin/bash
+        if batch_solver:
+            file.write(f"""#!/bin/bash
+echo start
+{manifest_cmd}{get_batch_solver_cmd(temp_exp_dir, git_dir)}
+echo end""")
+        else:
+            if native_solver:
+                cms_cmd = get_native_solver_cmd(git_dir, temp_exp_dir)
+            else:
+                cms_cmd = get_cms_cmd(exe_dir, temp_exp_dir, docker_image)
+            file.write(f"""#!/bin/bash
 echo start
 for i in {{1..{scen_num}}} 
   do
-    {get_cms_cmd(exe_dir, temp_exp_dir, docker_image)} -c "{cfg_fname}" -m "{emodl_fname}"
+    {manifest_cmd}{cms_cmd} -c "{cfg_fname}" -m "{emodl_fname}"
   done
 echo end""")
     else:
         file = open(os.path.join(trajectories_dir, fname), 'w')
-        file.write('ECHO start' + '\n' + 'FOR /L %%i IN (1,1,{}) DO ( "{}" -c "{}" -m "{}") >> "{}/log/log.txt"'.format(
-            str(scen_num),
-            get_cms_cmd(exe_dir, temp_exp_dir),
-            os.path.join(temp_dir, "model_%%i" + ".cfg"),
-            os.path.join(temp_dir, "simulation_%%i" + ".emodl"),
-            os.path.join(temp_exp_dir)
-        ) + "\n ECHO end")
+        if batch_solver:
+            file.write(f'ECHO start\n{manifest_cmd}{get_batch_solver_cmd(temp_exp_dir, git_dir)} >> "{temp_exp_dir}/log/log.txt"\n ECHO end')
+        else:
+            if native_solver:
+                cms_cmd = get_native_solver_cmd(git_dir)
+            else:
+                cms_cmd = f'"{get_cms_cmd(exe_dir, temp_exp_dir)}"'
+            cms_cmd = manifest_cmd + cms_cmd
+            file.write('ECHO start' + '\n' + 'FOR /L %%i IN (1,1,{}) DO ( {} -c "{}" -m "{}") >> "{}/log/log.txt"'.format(
+                str(scen_num),
+                cms_cmd,
+                os.path.join(temp_dir, "model_%%i" + ".cfg"),
+                os.path.join(temp_dir, "simulation_%%i" + ".emodl"),
+                os.path.join(temp_exp_dir)
+            ) + "\n ECHO end")
 
         emodl_name = str([i for i in os.listdir(temp_exp_dir) if "emodl" in i][0]).replace('.emodl','')
         emodl_from = os.path.join(sim_output_path, emodl_name + ".emodl")
@@ -289,12 +447,37 @@ echo end""")
             file = open(os.path.join(temp_exp_dir,'bat', f'{list(process_dict.keys())[15]}.bat'), 'w')
             file.write(f'cd {plotters_dir} \n python {list(process_dict.values())[15]}   --stem "{exp_name}"  --channelGrp "Vaccinated"  >> "{sim_output_path}/log/{list(process_dict.keys())[15]}.txt" \n')
 
-def shell_header(A='p30781',p='short',t='02:00:00',N=1,ntasks_per_node=1, memG=18,job_name='myjob', arrayJob=None):
+# longest time limit of the Quest partitions
+PARTITION_MAX_TIME = {'short': '04:00:00', 'normal': '48:00:00'}
+
+
+def time_seconds(t):
+    """Seconds of a slurm time limit (HH:MM:SS)"""
+    hours, minutes, seconds = [int(x) for x in t.split(':')]
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def scale_time(t, factor):
+    """Multiply a slurm time limit (HH:MM:SS) by factor"""
+    total = int(np.ceil(time_seconds(t) * factor))
+    return f'{total // 3600:02d}:{total % 3600 // 60:02d}:{total % 60:02d}'
+
+
+def shell_header(A='p30781',p='short',t='02:00:00',N=1,ntasks_per_node=1, memG=18,job_name='myjob', arrayJob=None,
+                 n_sequential=1):
+    """n_sequential: number of simulations run one after the other per (array) task, scales the time limit"""
 
     if 'b1139' in os.getcwd():
       A = 'b1139'
       p = 'b1139'
       t = '00:45:00'
+    t = scale_time(t, n_sequential)
+    if p == 'short' and time_seconds(t) > time_seconds(PARTITION_MAX_TIME['short']):
+        p = 'normal'
+    if p in PARTITION_MAX_TIME and time_seconds(t) > time_seconds(PARTITION_MAX_TIME[p]):
+        # sbatch rejects longer time limits, scenarios not simulated in time are resubmitted (verify_scenarios.py)
+        log.warning(f"Time limit {t} exceeds the {p} partition, limited to {PARTITION_MAX_TIME[p]}")
+        t = PARTITION_MAX_TIME[p]
 
     header = f'#!/bin/bash\n' \
              f'#SBATCH -A {A}\n' \
@@ -315,31 +498,200 @@ def shell_header(A='p30781',p='short',t='02:00:00',N=1,ntasks_per_node=1, memG=1
         header = header + err + out
     return header
 
-def generateSubmissionFile_quest(scen_num, exp_name, experiment_config, trajectories_dir, git_dir, temp_exp_dir,exe_dir,sim_output_path,model) :
+def pack_scenarios(cmd, scen_num, scenarios_per_task, task_cores=1):
+    """Loop of an array task over its scenarios_per_task consecutive scenarios, running task_cores at a time
+
+    Parameters
+    ----------
+    cmd : str
+        Command of a single scenario, using ${i} as scen_num
+    """
+    loop = '\n\nfirst=$(( (${SLURM_ARRAY_TASK_ID} - 1) * ' + str(scenarios_per_task) + ' + 1 ))\n' \
+           f'last=$(( first + {scenarios_per_task - 1} < {scen_num} ? first + {scenarios_per_task - 1} : {scen_num} ))\n' \
+           'for i in $(seq ${first} ${last})\n' \
+           '  do\n'
+    if task_cores > 1:
+        loop += f'    {cmd} &\n' \
+                f'    if [ $(jobs -rp | wc -l) -ge {task_cores} ]; then wait -n; fi\n' \
+                '  done\n' \
+                'wait\n'
+    else:
+        loop += f'    {cmd}\n' \
+                '  done\n'
+    return loop
+
+
+def stage_on_node(cmd, sim_dir, scratch_dir, trajectories_dir, scen, copy_inputs=True):
+    """Run the command of a scenario in node-local scratch and copy back its trajectories file at the end
+
+    The cfg and emodl are copied from sim_dir into scratch_dir (unless copy_inputs is False, i.e. rendered there),
+    the trajectories file is written in scratch (the output prefix of the cfg is relative to the working directory)
+    and moved into trajectories_dir in one piece. Without $TMPDIR, or if the inputs cannot be staged, cmd runs in
+    trajectories_dir as without staging.
+    """
+    traj = f'trajectories_scen{scen}.csv'
+    staged = cmd.replace(sim_dir, '$scratch')
+    inputs = f' && cp {sim_dir}/model_{scen}.cfg {sim_dir}/simulation_{scen}.emodl $scratch/' if copy_inputs else ''
+    return f'( scratch={scratch_dir}; ' \
+           f'if [ -n "$TMPDIR" ] && mkdir -p $scratch{inputs}; then ' \
+           f'cd $scratch && {staged} && cp {traj} {trajectories_dir}/.{traj} && ' \
+           f'mv {trajectories_dir}/.{traj} {trajectories_dir}/{traj}; ' \
+           f'status=$?; cd {trajectories_dir}; rm -rf $scratch; exit $status; fi; ' \
+           f'echo "No node-local scratch, running in {trajectories_dir}"; {cmd} )'
+
+
+def record_steps(fname, git_dir, exp_dir, sim_output_path):
+    """Record each python step of a postprocessing script in the manifest of the experiment (run_manifest.py),
+    which is moved with the experiment from exp_dir to sim_output_path by cleanup.py"""
+    with open(fname) as fin:
+        lines = fin.read().split('\n')
+    for i, line in enumerate(lines):
+        if line.startswith('python '):
+            step = os.path.basename(line.split()[1])
+            if step == 'cleanup.py':
+                exp_dir = sim_output_path
+            lines[i] = get_manifest_cmd(git_dir, exp_dir, step=step) + line
+    with open(fname, 'w') as fout:
+        fout.write('\n'.join(lines))
+
+
+def array_ranges(scen_nums):
+    """Compact Slurm --array specification of the scenarios, i.e. [1, 2, 3, 5] -> '1-3,5'"""
+    ranges = []
+    for scen in sorted(scen_nums):
+        if ranges and scen == ranges[-1][1] + 1:
+            ranges[-1][1] = scen
+        else:
+            ranges.append([scen, scen])
+    return ','.join(str(first) if first == last else f'{first}-{last}' for first, last in ranges)
+
+
+def generateSubmissionFile_quest(scen_num, exp_name, experiment_config, trajectories_dir, git_dir, temp_exp_dir,exe_dir,sim_output_path,model,
+                                 cfg_file=None, scenarios_per_task=None, task_cores=1, render_on_node=False,
+                                 cached_scenarios=(), cache_dir=None, max_resubmits=None, manifest=False,
+                                 sim_resources=None, post_resources=None, stream_ingest=False, shard_regions=None,
+                                 queue_workers=None, stage_scratch=False, max_concurrent=None) :
     # Generic shell submission script that should run for all having access to NU cluster allocation
     # submit_runSimulations.sh
+    # scenarios_per_task: consecutive scenarios per array task (default 1), run task_cores at a time within the task
+    # render_on_node: render the emodl and cfg of each scenario in node-local scratch right before running it
+    # cached_scenarios: scenarios linked from the simulation cache (result_cache.py), which are not submitted
+    # cache_dir: store the simulated trajectories in this cache before postprocessing
+    # max_resubmits: times the postprocessing resubmits incomplete scenarios (verify_scenarios.py) before combining
+    # manifest: record each scenario and postprocessing step in the manifest of the experiment (run_manifest.py)
+    # sim_resources, post_resources: time limit and memory (t, memG) per scenario and of the postprocessing,
+    # i.e. sized from previous experiments (resource_sizing.py), otherwise the defaults of shell_header
+    # stream_ingest: ingest the trajectories while the array job is running (stream_ingest.py)
+    # shard_regions: run the per-region steps of run_postprocessing_for_civis.sh as array job, one task per region
+    # (0 for All), after which a reduce job combines the regions and runs the remaining steps
+    # queue_workers: number of array tasks pulling the scenarios from the queue of the experiment (work_queue.py)
+    # instead of one task per scenario
+    # stage_scratch: run each scenario in node-local scratch ($TMPDIR) and copy back only its trajectories file
+    # max_concurrent: array tasks running at the same time (--array=...%N), i.e. sized to a filesystem bandwidth
+    # budget (resource_sizing.max_concurrent_tasks)
 
     process_dict = get_process_dict()
+    native_solver = cfg_file is not None and is_native_cfg(os.path.join(temp_exp_dir, cfg_file))
+    batch_solver = cfg_file is not None and is_batch_cfg(os.path.join(temp_exp_dir, cfg_file))
+
+    plotters_dir = os.path.join(git_dir, "plotters")
+    pymodule = '\n\nmodule purge all\nmodule load python/anaconda3.6\nsource activate /projects/p30781/anaconda3/envs/team-test-py37\n'
+    if 'b1139' in os.getcwd():
+        pymodule = '\n\nmodule purge all\nmodule load python/anaconda3.6\nsource activate /projects/b1139/anaconda3/envs/team-test-py37\n'
 
     exp_name_short = exp_name[-20:]
     array = f'#SBATCH --array=1-{str(scen_num)}\n'
-    header = shell_header(job_name=exp_name_short, arrayJob=array)
-    header_post = shell_header(t="02:00:00",memG=64, job_name=exp_name_short)
+    cached_scenarios = set(cached_scenarios) if not batch_solver else set()
+    if cached_scenarios:
+        missing = [scen for scen in range(1, scen_num + 1) if scen not in cached_scenarios]
+        # a single no-op task if all scenarios are cached
+        array = f'#SBATCH --array={array_ranges(missing) or 1}\n'
+    sim_resources = sim_resources or {}
+    header = shell_header(job_name=exp_name_short, arrayJob=array, **sim_resources)
+    if batch_solver:
+        # each task simulates a share of the scenarios as arrays, see solvers/run_batch.py
+        n_tasks = get_n_tasks(scen_num, scenarios_per_task or SCENARIOS_PER_TASK)
+        array = f'#SBATCH --array=1-{str(n_tasks)}\n'
+        header = shell_header(job_name=exp_name_short, arrayJob=array, **sim_resources)
+    elif queue_workers:
+        queued = [scen for scen in range(1, scen_num + 1) if scen not in cached_scenarios]
+        init_queue(temp_exp_dir, queued)
+        n_workers = max(min(queue_workers, len(queued)), 1)
+        # limited to the partition by shell_header, the scenarios of workers running out of time are claimed by
+        # the other workers once their heartbeat has expired, or resubmitted (verify_scenarios.py)
+        array = f'#SBATCH --array=1-{str(n_workers)}\n'
+        header = shell_header(job_name=exp_name_short, arrayJob=array, n_sequential=np.ceil(len(queued) / n_workers),
+                              **sim_resources)
+    elif scenarios_per_task is not None and scenarios_per_task > 1:
+        task_cores = min(task_cores, scenarios_per_task)
+        n_tasks = get_n_tasks(scen_num, scenarios_per_task)
+        array = f'#SBATCH --array=1-{str(n_tasks)}\n'
+        header = shell_header(t=sim_resources.get('t', '02:00:00'), ntasks_per_node=task_cores,
+                              memG=sim_resources.get('memG', 18) * task_cores, job_name=exp_name_short,
+                              arrayJob=array, n_sequential=np.ceil(scenarios_per_task / task_cores))
+    if max_concurrent is not None:
+        header = header.replace(array, f'{array.rstrip()}%{max_concurrent}\n')
+    header_post = shell_header(**{'t': "02:00:00", 'memG': 64, **(post_resources or {})}, job_name=exp_name_short)
     module = '\n\nmodule load singularity'
     slurmID = '${SLURM_ARRAY_TASK_ID}'
-    singularity = '\n\nsingularity exec -B /projects:/projects/ /software/singularity/images/singwine-v1.img wine ' \
+    if not batch_solver and scenarios_per_task is not None and scenarios_per_task > 1:
+        # the scenario of the loop below instead of one scenario per task
+        slurmID = '${i}'
+    if not batch_solver and queue_workers:
+        # the scenario claimed by the worker
+        slurmID = '${SCEN_NUM}'
+    sim_dir = f'{git_dir}/_temp/{exp_name}/simulations'
+    bind = '-B /projects:/projects/'
+    if render_on_node and not batch_solver:
+        # only the templates are staged, each scenario is rendered into node-local scratch (render_scenarios.py)
+        module = pymodule + 'module load singularity'
+        sim_dir = '${TMPDIR:-/tmp}/' + f'{exp_name}_scen{slurmID}'
+        bind = bind + ' -B ${TMPDIR:-/tmp}'
+    elif stage_scratch and not batch_solver:
+        bind = bind + ' -B ${TMPDIR:-/tmp}'
+    singularity = f'\n\nsingularity exec {bind} /software/singularity/images/singwine-v1.img wine ' \
                   f'{exe_dir}/compartments.exe ' \
-                  f'-c {git_dir}/_temp/{exp_name}/simulations/model_{slurmID}.cfg ' \
-                  f'-m {git_dir}/_temp/{exp_name}/simulations/simulation_{slurmID}.emodl'
+                  f'-c {sim_dir}/model_{slurmID}.cfg ' \
+                  f'-m {sim_dir}/simulation_{slurmID}.emodl'
+    if native_solver:
+        module = pymodule
+        singularity = f'{get_native_solver_cmd(git_dir)} ' \
+                      f'-c {sim_dir}/model_{slurmID}.cfg ' \
+                      f'-m {sim_dir}/simulation_{slurmID}.emodl'
+    if batch_solver:
+        singularity = f'{get_batch_solver_cmd(f"{git_dir}/_temp/{exp_name}", git_dir)} ' \
+                      f'--task_id {slurmID} --n_tasks {n_tasks}'
+    if manifest:
+        if pymodule not in module:
+            module = pymodule + 'module load singularity'
+        singularity = '\n\n' + get_manifest_cmd(git_dir, f'{git_dir}/_temp/{exp_name}',
+                                                scen_num=None if batch_solver else slurmID) + singularity.strip()
+    if not batch_solver:
+        if stage_scratch:
+            # the scenario rendered on the node is in scratch already
+            singularity = '\n\n' + stage_on_node(singularity.strip(), sim_dir,
+                                                 sim_dir if render_on_node else f'$TMPDIR/{exp_name}_scen{slurmID}',
+                                                 trajectories_dir, slurmID, copy_inputs=not render_on_node)
+        if render_on_node:
+            singularity = f'\n\n( python {git_dir}/render_scenarios.py -d {git_dir}/_temp/{exp_name} ' \
+                          f'--scen_num {slurmID} --out_dir {sim_dir} && {singularity.strip()}; ' \
+                          f'status=$?; rm -rf {sim_dir}; exit $status )'
+    if not batch_solver and queue_workers:
+        if pymodule not in module:
+            module = pymodule + 'module load singularity'
+        singularity = '\n\n' + get_worker_cmd(git_dir, f'{git_dir}/_temp/{exp_name}', singularity.strip())
+    elif not batch_solver and slurmID == '${i}':
+        if cached_scenarios:
+            # skip the scenarios linked from the cache
+            singularity = f'if [ -e {trajectories_dir}/trajectories_scen${{i}}.csv ]; then continue; fi; ' \
+                          f'{singularity.strip()}'
+        singularity = pack_scenarios(singularity.strip(), scen_num, scenarios_per_task, task_cores)
+    elif cached_scenarios and len(cached_scenarios) == scen_num:
+        singularity = f'\n\necho "All {scen_num} scenarios found in the simulation cache"'
     file = open(os.path.join(trajectories_dir, 'runSimulations.sh'), 'w')
     file.write(header + module + singularity)
     file.close()
 
-    plotters_dir = os.path.join(git_dir, "plotters")
-    pymodule = '\n\nmodule purge all\nmodule load python/anaconda3.6\nsource activate /projects/p30781/anaconda3/envs/team-test-py37\n'
-    if 'b1139' in os.getcwd():
-        pymodule = '\n\nmodule purge all\nmodule load python/anaconda3.6\nsource activate /projects/b1139/anaconda3/envs/team-test-py37\n'
-
     emodl_name = str([i for i in os.listdir(temp_exp_dir) if "emodl" in i][0]).replace('.emodl', '')
     emodl_from = os.path.join(sim_output_path, emodl_name + ".emodl")
     emodl_to = os.path.join(git_dir, "emodl", emodl_name + "_resim.emodl").replace("\\", "/")
@@ -362,10 +714,26 @@ def generateSubmissionFile_quest(scen_num, exp_name, experiment_config, trajecto
     fname = list(process_dict.values())[3]
     if "spatial_EMS" in experiment_config:
         fname = 'data_comparison_spatial.py'
+    def verify_cmd(postprocessing_script):
+        # resubmits the incomplete scenarios and this script after them, instead of combining incomplete trajectories
+        cmd = f'\ncd {git_dir}\npython {git_dir}/verify_scenarios.py -d {git_dir}/_temp/{exp_name} ' \
+              f'--resubmit {postprocessing_script}'
+        if max_resubmits is not None:
+            cmd += f' --max_resubmits {max_resubmits}'
+        return cmd + ' || exit $?'
+
+    store_cache = ''
+    if cache_dir is not None:
+        # before the trajectories are combined and cleaned up
+        store_cache = f'\ncd {git_dir}\npython {git_dir}/result_cache.py -d {git_dir}/_temp/{exp_name} --store ' \
+                      f'--cache_dir {cache_dir}'
+    if stream_ingest:
+        # only the scenarios not ingested yet, combine_and_trim.py then reads the combined trajectories
+        store_cache += f'\ncd {git_dir}\npython {git_dir}/stream_ingest.py -d {git_dir}/_temp/{exp_name} --finalize'
 
     pycommand = f'\ncd {git_dir}\npython {list(process_dict.values())[0]}  --exp_name "{exp_name}" --Location "NUCLUSTER" '
     file = open(os.path.join(temp_exp_dir, 'run_postprocessing.sh'), 'w')
-    file.write(header_post + pymodule + pycommand)
+    file.write(header_post + pymodule + verify_cmd('run_postprocessing.sh') + store_cache + pycommand)
     file.write(f'\n\ncd {git_dir}/nucluster \npython {git_dir}/nucluster/cleanup.py --stem "{exp_name}" --delete_simsfiles "True"')
     file.write(f'\n\ncd {plotters_dir} \npython {plotters_dir}/{fname} --stem "{exp_name}" --Location "NUCLUSTER"')
     file.write(f'\npython {plotters_dir}/{list(process_dict.values())[2]} --stem "{exp_name}" --Location "NUCLUSTER" --plot')
@@ -382,7 +750,7 @@ def generateSubmissionFile_quest(scen_num, exp_name, experiment_config, trajecto
 
     pycommand = f'\ncd {git_dir}\npython {list(process_dict.values())[0]}  --exp_name "{exp_name}" --Location "NUCLUSTER" '
     file = open(os.path.join(temp_exp_dir, f'run_postprocessing_for_civis.sh'), 'w')
-    file.write(header_post + pymodule + pycommand)
+    file.write(header_post + pymodule + verify_cmd('run_postprocessing_for_civis.sh') + store_cache + pycommand)
     file.write(f'\n\ncd {git_dir}/nucluster \npython {git_dir}/nucluster/cleanup.py --stem "{exp_name}" --delete_simsfiles "True"')
     file.write(f'\n\ncd {plotters_dir} \npython {plotters_dir}/{fname} --stem "{exp_name}" --Location "NUCLUSTER"')
     file.write(f'\npython {plotters_dir}/{list(process_dict.values())[2]} --stem "{exp_name}" --Location "NUCLUSTER" --plot')
@@ -400,9 +768,51 @@ def generateSubmissionFile_quest(scen_num, exp_name, experiment_config, trajecto
     file.write(f'\n\ncd {git_dir}/nucluster \npython {git_dir}/nucluster/{list(process_dict.values())[12]} --stem "{exp_name}" --zip_dir --Location "NUCLUSTER"')
     file.close()
 
+    if shard_regions:
+        # combine and cleanup, then the regions array and the reduce job after this job has finished,
+        # running in the experiment folder moved by cleanup.py
+        chdir = f'--chdir={sim_output_path}'.replace("\\", "/")
+        file = open(os.path.join(temp_exp_dir, f'run_postprocessing_for_civis.sh'), 'w')
+        file.write(header_post + pymodule + verify_cmd('run_postprocessing_for_civis.sh') + store_cache + pycommand)
+        file.write(f'\n\ncd {temp_exp_dir}/\n'
+                   f'jobid=$(sbatch --parsable {chdir} --dependency=afterok:$SLURM_JOB_ID run_postprocessing_regions.sh)\n'
+                   f'sbatch {chdir} --dependency=afterany:$jobid run_postprocessing_reduce.sh')
+        file.write(f'\n\ncd {git_dir}/nucluster \npython {git_dir}/nucluster/cleanup.py --stem "{exp_name}" --delete_simsfiles "True"')
+        file.close()
+
+        region = '--region ${SLURM_ARRAY_TASK_ID}'
+        file = open(os.path.join(temp_exp_dir, 'run_postprocessing_regions.sh'), 'w')
+        file.write(shell_header(memG=16, job_name=exp_name_short,
+                                arrayJob=f'#SBATCH --array={array_ranges(shard_regions)}\n') + pymodule)
+        file.write(f'\ncd {plotters_dir} ')
+        if fname != list(process_dict.values())[3]:
+            file.write(f'\npython {plotters_dir}/{fname} --stem "{exp_name}" --Location "NUCLUSTER" {region}')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[2]} --stem "{exp_name}" --Location "NUCLUSTER" --plot {region}')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[4]} --stem "{exp_name}" --Location "NUCLUSTER" {region}')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[5]} --stem "{exp_name}" --Location "NUCLUSTER" {region}')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[6]} --stem "{exp_name}" --Location "NUCLUSTER" {region}')
+        file.close()
+
+        file = open(os.path.join(temp_exp_dir, 'run_postprocessing_reduce.sh'), 'w')
+        file.write(header_post + pymodule)
+        file.write(f'\ncd {plotters_dir} ')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[4]} --stem "{exp_name}" --Location "NUCLUSTER" --processStep combine_outputs')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[5]} --stem "{exp_name}" --Location "NUCLUSTER" --combine_regions')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[6]} --stem "{exp_name}" --Location "NUCLUSTER" --combine_regions')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[3]} --stem "{exp_name}" --Location "NUCLUSTER"')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[7]} --stem "{exp_name}" --Location "NUCLUSTER"')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[8]} --exp_names "{exp_name}" --Location "NUCLUSTER"')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[9]} --stem "{exp_name}" --Location "NUCLUSTER"')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[10]} --exp_name "{exp_name}" --Location "NUCLUSTER"')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[11]} --Location "NUCLUSTER"')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[14]} --stem "{exp_name}" --Location "NUCLUSTER"')
+        file.write(f'\npython {plotters_dir}/{list(process_dict.values())[15]} --stem "{exp_name}" --channelGrp "Vaccinated" --Location "NUCLUSTER"')
+        file.write(f'\n\ncd {git_dir}/nucluster \npython {git_dir}/nucluster/{list(process_dict.values())[12]} --stem "{exp_name}" --zip_dir --Location "NUCLUSTER"')
+        file.close()
+
     pycommand = f'\ncd {git_dir}\npython {list(process_dict.values())[0]}  --exp_name "{exp_name}" --Location "NUCLUSTER" '
     file = open(os.path.join(temp_exp_dir, f'run_postprocessing_for_fitting.sh'), 'w')
-    file.write(header_post + pymodule + pycommand)
+    file.write(header_post + pymodule + verify_cmd('run_postprocessing_for_fitting.sh') + store_cache + pycommand)
     file.write(f'\n\ncd {git_dir}/nucluster \npython {git_dir}/nucluster/cleanup.py --stem "{exp_name}" --delete_simsfiles "True"')
     file.write(f'\n\ncd {plotters_dir} \npython {plotters_dir}/{fname} --stem "{exp_name}" --Location "NUCLUSTER"')
     file.write(f'\npython {plotters_dir}/{list(process_dict.values())[2]} --stem "{exp_name}" --Location "NUCLUSTER" --plot')
@@ -411,6 +821,17 @@ def generateSubmissionFile_quest(scen_num, exp_name, experiment_config, trajecto
     file.write(f'\n\ncd {git_dir}/nucluster \npython {git_dir}/nucluster/{list(process_dict.values())[12]} --stem "{exp_name}" --zip_dir --Location "NUCLUSTER"')
     file.close()
 
+    if manifest:
+        for postprocessing_script in ['run_postprocessing.sh', 'run_postprocessing_for_civis.sh',
+                                      'run_postprocessing_for_fitting.sh']:
+            record_steps(os.path.join(temp_exp_dir, postprocessing_script), git_dir, f'{git_dir}/_temp/{exp_name}',
+                         sim_output_path.replace("\\", "/"))
+        if shard_regions:
+            # both run after cleanup
+            for postprocessing_script in ['run_postprocessing_regions.sh', 'run_postprocessing_reduce.sh']:
+                record_steps(os.path.join(temp_exp_dir, postprocessing_script), git_dir,
+                             sim_output_path.replace("\\", "/"), sim_output_path.replace("\\", "/"))
+
     """
     Single shell files for single job submission 
     (to do set up dependencies)
@@ -511,6 +932,15 @@ def generateSubmissionFile_quest(scen_num, exp_name, experiment_config, trajecto
     Start postprocessing using singleton dependency
     """
     submit_runSimulations = f'cd {temp_exp_dir}/trajectories/\ndos2unix runSimulations.sh\nsbatch runSimulations.sh\n'
+    if stream_ingest:
+        # the ingest job watches the array job, the postprocessing (singleton) starts after both
+        file = open(os.path.join(temp_exp_dir, 'run_ingest.sh'), 'w')
+        file.write(shell_header(p='normal', t='12:00:00', memG=8, job_name=exp_name_short) + pymodule +
+                   f'\ncd {git_dir}\npython {git_dir}/stream_ingest.py -d {git_dir}/_temp/{exp_name} --watch --job_id $1')
+        file.close()
+        submit_runSimulations = f'cd {temp_exp_dir}/trajectories/\ndos2unix runSimulations.sh\n' \
+                                f'jobid=$(sbatch --parsable runSimulations.sh)\n' \
+                                f'cd {temp_exp_dir}/\nsbatch run_ingest.sh $jobid\n'
     submit_combineSimulations = f'cd {temp_exp_dir}/\nsbatch --dependency=singleton run_postprocessing.sh'
     submit_combineSimulations_civis = f'cd {temp_exp_dir}/\nsbatch --dependency=singleton run_postprocessing_for_civis.sh'
     file = open(os.path.join(temp_exp_dir, 'submit_runSimulations.sh'), 'w')
@@ -0,0 +1,297 @@
+"""
+Checkpoint the species of simulated trajectories at a calendar date and warm-start new experiments from them.
+
+A checkpoint is taken from the trajectories of an experiment whose emodl observes every species, i.e. generated with
+runScenarios.py -obs all, which adds (observe S_EMS_1 S::EMS_1) for all species. For each scenario and run the
+values at the checkpoint date are written, together with the sampled parameters of the scenario, into
+<exp_dir>/checkpoint_<YYYYMMDD>.csv:
+
+python solvers/checkpoint.py -d _temp/<exp_name> --date 2020-10-01
+
+An experiment started with runScenarios.py --warm_start <checkpoint csv> simulates one scenario per checkpoint row
+from the checkpoint date on, with an emodl rendered per scenario by warm_start_emodl:
+- (species X value) with the checkpointed values
+- params as values, including the changes of all time-events before the checkpoint (i.e. ki_multiplier changes),
+  the changes of species by these time-events are already part of the checkpoint
+- time-events after the checkpoint and 'time' in expressions shifted by the checkpoint time
+State-events are kept unchanged, hence one-shot state-events that fired before the checkpoint can fire again.
+
+In a two-phase execution (runScenarios.py --two_phase) only the best fitting trajectories until the last data date are
+checkpointed (plotters/prune_traces.py) and stitch_history prepends their history to the forecast trajectories.
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from solvers.emodl_parser import load_emodl, parse_emodl, to_text
+from solvers.run_batch import get_template_emodl
+from solvers.trajectories import read_trajectories, write_trajectories
+
+log = logging.getLogger(__name__)
+
+
+def species_channels(model):
+    """Observed channel of each species, for observes of a single species (i.e. (observe S_EMS_1 S::EMS_1))"""
+    channels = {}
+    for name, expr in model.observes:
+        if isinstance(expr.sexpr, str) and expr.sexpr in model.species and expr.sexpr not in channels:
+            channels[expr.sexpr] = name
+    missing = [s for s in model.species if s not in channels]
+    if missing:
+        raise ValueError(f"Species {missing[:5]} ({len(missing)} in total) are not observed, "
+                         "a checkpoint requires trajectories observing all species (runScenarios.py -obs all)")
+    return channels
+
+
+def read_experiment_trajectories(exp_dir):
+    """Trajectories of all scenarios and runs with columns time, run_num, scen_num and the channels
+
+    Uses trajectoriesDat.csv if combined already, otherwise the trajectories_scen<scen_num>.csv files
+    """
+    fname = os.path.join(exp_dir, 'trajectoriesDat.csv')
+    if os.path.exists(fname):
+        return pd.read_csv(fname)
+    trajectories_dir = os.path.join(exp_dir, 'trajectories')
+    dfs = []
+    for fname in sorted(os.listdir(trajectories_dir)):
+        match = re.match(r'trajectories_scen(\d+)\.csv$', fname)
+        if not match:
+            continue
+        sampletimes, channels, values = read_trajectories(os.path.join(trajectories_dir, fname))
+        for run_num, run_values in enumerate(values):
+            df = pd.DataFrame(run_values, columns=channels)
+            df.insert(0, 'time', sampletimes)
+            df['run_num'] = run_num
+            df['scen_num'] = int(match.group(1))
+            dfs.append(df)
+    if not dfs:
+        raise FileNotFoundError(f"No trajectoriesDat.csv or trajectories_scen<scen_num>.csv files in {exp_dir}")
+    return pd.concat(dfs, ignore_index=True)
+
+
+def take_checkpoint(df, sampled_parameters, model, checkpoint_date):
+    """Species values per scenario and run at the last sample time at or before the checkpoint date
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Trajectories with columns time, run_num, scen_num and the observed channels
+    sampled_parameters : pd.DataFrame
+        Sampled parameters including scen_num and startdate
+    model : EmodlModel
+        Emodl of the experiment, observing all species
+    checkpoint_date : str or datetime
+
+    Returns
+    -------
+    checkpoint : pd.DataFrame
+        One row per scenario and run with the sampled parameters, run_num, checkpoint_date,
+        checkpoint_time (days since startdate) and one column per species
+    """
+    channels = species_channels(model)
+    conflicts = [s for s in channels if s in sampled_parameters.columns]
+    if conflicts:
+        raise ValueError(f"Species {conflicts} are also columns of the sampled parameters")
+    checkpoint_date = pd.Timestamp(checkpoint_date)
+    params = sampled_parameters.copy()
+    params['checkpoint_time'] = (checkpoint_date - pd.to_datetime(params['startdate'])).dt.days
+    if (params['checkpoint_time'] < 0).any():
+        raise ValueError(f"Checkpoint date {checkpoint_date.date()} is before the startdate of some scenarios")
+    df = df[['scen_num', 'run_num', 'time'] + list(channels.values())]
+    df = df.merge(params[['scen_num', 'checkpoint_time']], on='scen_num')
+    df = df[df['time'] <= df['checkpoint_time']]
+    df = df.loc[df.groupby(['scen_num', 'run_num'])['time'].idxmax()]
+    if (df['time'] < df['checkpoint_time'] - 1).any():
+        log.warning("Trajectories end before the checkpoint date, using their last sample")
+    df = df.rename(columns={channel: species for species, channel in channels.items()})
+    checkpoint = params.merge(df.drop(columns=['time', 'checkpoint_time']), on='scen_num')
+    checkpoint.insert(checkpoint.columns.get_loc('checkpoint_time'), 'checkpoint_date', checkpoint_date.date())
+    return checkpoint.reset_index(drop=True)
+
+
+def write_checkpoint(exp_dir, checkpoint_date, fname=None, traces=None):
+    """Take a checkpoint of an experiment folder, written to <exp_dir>/checkpoint_<YYYYMMDD>.csv per default
+
+    Parameters
+    ----------
+    traces : pd.DataFrame, optional
+        scen_num and run_num of the trajectories to checkpoint, all if None
+    """
+    model = load_emodl(get_template_emodl(exp_dir))
+    sampled_parameters = pd.read_csv(os.path.join(exp_dir, 'sampled_parameters.csv'))
+    df = read_experiment_trajectories(exp_dir)
+    if traces is not None:
+        df = df.merge(traces[['scen_num', 'run_num']], on=['scen_num', 'run_num'])
+    checkpoint = take_checkpoint(df, sampled_parameters, model, checkpoint_date)
+    if fname is None:
+        fname = os.path.join(exp_dir, f"checkpoint_{pd.Timestamp(checkpoint_date).strftime('%Y%m%d')}.csv")
+    checkpoint.to_csv(fname, index=False)
+    log.info(f"Checkpoint of {len(checkpoint)} trajectories at {checkpoint_date} written to {fname}")
+    return fname
+
+
+def _shift_time(sexpr, t0):
+    """Replace 'time' by (+ time t0) so that expressions see the time of the original simulation"""
+    if isinstance(sexpr, list):
+        return [_shift_time(x, t0) for x in sexpr]
+    if sexpr == 'time':
+        return ['+', 'time', float(t0)]
+    return sexpr
+
+
+def _value_text(value):
+    return to_text(float(value))
+
+
+def warm_start_emodl(template_text, row, checkpoint_time=None):
+    """Render a template emodl for one checkpoint row, starting at the checkpoint
+
+    Parameters
+    ----------
+    template_text : str
+        Template emodl of the checkpointed experiment, with @placeholders@ for the sampled parameters
+    row : pd.Series or dict
+        Row of a checkpoint csv, with the sampled parameters and the species values
+    checkpoint_time : float, optional
+        Days since the start of the checkpointed simulation, row['checkpoint_time'] if None
+
+    Returns
+    -------
+    text : str
+        Rendered emodl starting at time 0 = checkpoint date
+    """
+    row = dict(row)
+    t0 = float(row['checkpoint_time'] if checkpoint_time is None else checkpoint_time)
+    text = template_text
+    for key, value in row.items():
+        text = text.replace(f'@{key}@', str(value))
+    remaining_placeholders = re.findall(r'@\w+@', text)
+    if remaining_placeholders:
+        raise ValueError("Not all placeholders have been replaced in the template emodl file. "
+                         f"Remaining placeholders: {remaining_placeholders}")
+    model = parse_emodl(text)
+    missing = [s for s in model.species if s not in row]
+    if missing:
+        raise ValueError(f"Species {missing[:5]} ({len(missing)} in total) are not in the checkpoint")
+
+    # params after all time-events before the checkpoint, species changes are part of the checkpoint
+    env = model.initial_params()
+    x = np.array([float(row[s]) for s in model.species])
+    event_times = [float(event.trigger(env)) for event in model.time_events]
+    past = sorted((t, i) for i, t in enumerate(event_times) if t <= t0)
+    for t, i in past:
+        state = model.state_env(env, x, t)
+        for target, value in model.time_events[i].actions:
+            if target in model.params:
+                state[target] = env[target] = value(state)
+
+    match = re.search(r'\(start-model\s+"([^"]*)"\)', template_text)
+    lines = [f'; warm start at day {t0:g} of {match.group(1) if match else "emodl"}', '',
+             '(import (rnrs) (emodl cmslib))', '',
+             f'(start-model "{match.group(1) if match else "warm_start.emodl"}")', '']
+    lines += [f'(species {name} {_value_text(value)})' for name, value in zip(model.species, x)] + ['']
+    lines += [f'(param {name} {_value_text(env[name])})' for name in model.params] + ['']
+    lines += [f'(func {name} {to_text(_shift_time(expr.sexpr, t0))})' for name, expr in model.funcs.items()] + ['']
+    lines += [f'(observe {name} {to_text(_shift_time(expr.sexpr, t0))})' for name, expr in model.observes] + ['']
+    for reaction in model.reactions:
+        lines.append(f'(reaction {reaction.name} ({" ".join(reaction.reactants)}) ({" ".join(reaction.products)}) '
+                     f'{to_text(_shift_time(reaction.rate.sexpr, t0))})')
+    lines.append('')
+
+    def actions_text(event):
+        return '(' + ' '.join(f'({target} {to_text(_shift_time(value.sexpr, t0))})'
+                              for target, value in event.actions) + ')'
+
+    for event, t in zip(model.time_events, event_times):
+        if t > t0:
+            lines.append(f'(time-event {event.name} {_value_text(t - t0)} {actions_text(event)})')
+    for event in model.state_events:
+        lines.append(f'(state-event {event.name} {to_text(_shift_time(event.trigger.sexpr, t0))} '
+                     f'{actions_text(event)})')
+    lines += ['', '(end-model)', '']
+    return '\n'.join(lines)
+
+
+def read_warm_start(fname):
+    """Checkpoint rows as sampled parameters of a warm start experiment, one scenario per checkpointed trajectory"""
+    df = pd.read_csv(fname)
+    df = df.rename(columns={'scen_num': 'checkpoint_scen_num', 'run_num': 'checkpoint_run_num',
+                            'startdate': 'checkpoint_startdate'})
+    df['startdate'] = df['checkpoint_date']
+    df.insert(0, 'scen_num', range(1, len(df) + 1))
+    return df
+
+
+def stitch_history(exp_dir, history_dir, trajectories_dir=None):
+    """Prepend the history before the checkpoint to the trajectories of a warm start experiment
+
+    The trajectories_scen<scen_num>.csv files of the warm start experiment are rewritten to start at the startdate
+    of the checkpointed experiment, all runs of a scenario share the history of its checkpointed trajectory.
+    The startdate in sampled_parameters.csv is reset accordingly, so that the postprocessing sees full trajectories.
+
+    Parameters
+    ----------
+    exp_dir : str
+        Warm start experiment folder with sampled_parameters.csv (see read_warm_start)
+    history_dir : str
+        Folder of the checkpointed experiment with trajectoriesDat.csv or its trajectories
+    trajectories_dir : str, optional
+        Folder of the trajectories files of the warm start experiment, <exp_dir>/trajectories if None
+    """
+    trajectories_dir = trajectories_dir or os.path.join(exp_dir, 'trajectories')
+    df = pd.read_csv(os.path.join(exp_dir, 'sampled_parameters.csv'))
+    history = read_experiment_trajectories(history_dir).set_index(['scen_num', 'run_num']).sort_index()
+    for _, row in df.iterrows():
+        fname = os.path.join(trajectories_dir, f"trajectories_scen{row['scen_num']}.csv")
+        if not os.path.exists(fname):
+            log.warning(f"No trajectories for scenario {row['scen_num']} in {trajectories_dir}")
+            continue
+        with open(fname) as fin:
+            header = fin.readline().strip()
+        sampletimes, channels, values = read_trajectories(fname)
+        t0 = row['checkpoint_time']
+        past = history.loc[(row['checkpoint_scen_num'], row['checkpoint_run_num'])]
+        past = past[past['time'] < t0].sort_values('time')
+        past_values = np.broadcast_to(past[channels].to_numpy(), (len(values), len(past), len(channels)))
+        write_trajectories(fname, np.concatenate([past['time'].to_numpy(), sampletimes + t0]), channels,
+                           np.concatenate([past_values, values], axis=1), header=header)
+    df['startdate'] = df['checkpoint_startdate']
+    df.to_csv(os.path.join(exp_dir, 'sampled_parameters.csv'), index=False)
+
+
+def parse_args():
+    description = "Checkpoint the species of an experiment at a date, to warm-start runScenarios.py --warm_start"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-d",
+        "--exp_dir",
+        type=str,
+        help="Experiment folder (i.e. _temp/<exp_name>) with trajectories observing all species",
+        required=True
+    )
+    parser.add_argument(
+        "--date",
+        type=str,
+        help="Checkpoint date (YYYY-MM-DD)",
+        required=True
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Name of the checkpoint csv, default <exp_dir>/checkpoint_<YYYYMMDD>.csv",
+        default=None
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="INFO")
+    args = parse_args()
+    write_checkpoint(args.exp_dir, args.date, fname=args.output)
@@ -0,0 +1,215 @@
+"""
+Compile a parsed emodl model into arrays and generated NumPy code.
+
+The compiled model consists of
+- a sparse (n_species x n_reactions) stoichiometry matrix
+- a parameter vector layout: the params (and @placeholders@ used at run time) in a fixed order
+- one generated python function evaluating all propensities and one evaluating all observe channels
+  for a batch of states x with shape (n_species, ...) and a parameter vector p
+
+Only the funcs needed by a kernel are evaluated, in dependency order, as local variables of the generated code.
+This avoids re-parsing s-expressions for analysis, fitting or alternative solvers, and is faster than evaluating
+the expression trees of emodl_parser.py.
+Compiled models are cached by the hash of the emodl text in memory, and optionally as pickle files in a cache
+directory shared by processes (i.e. <exp_dir>/compiled of the tasks of solvers/run_batch.py).
+"""
+import logging
+import os
+import pickle
+
+import numpy as np
+from scipy import sparse
+
+from solvers.emodl_parser import PLACEHOLDER, emodl_hash, parse_emodl
+
+log = logging.getLogger(__name__)
+
+COMPILER_VERSION = 1
+
+_BINARY = {'+': '+', 'sum': '+', '-': '-', '*': '*', '/': '/',
+           '>': '>', '<': '<', '>=': '>=', '<=': '<=', '==': '=='}
+_NESTED = {'max': 'np.maximum', 'min': 'np.minimum', 'and': 'np.logical_and', 'or': 'np.logical_or'}
+_UNARY = {'floor': 'np.floor', 'ceil': 'np.ceil', 'abs': 'np.abs', 'sqrt': 'np.sqrt', 'exp': 'np.exp',
+          'log': 'np.log', 'sin': 'np.sin', 'cos': 'np.cos', 'not': 'np.logical_not'}
+
+_memory_cache = {}
+
+
+class CompiledModel:
+    """Arrays and generated kernels of an emodl model
+
+    Attributes
+    ----------
+    model : EmodlModel
+        The parsed model, used for initial values and events
+    species : list of str
+    param_names : list of str
+        Layout of the parameter vector p, params followed by @placeholders@ used by the kernels
+    stoichiometry : scipy.sparse.csr_matrix
+        (n_species x n_reactions) net changes per reaction
+    source : str
+        Generated python code defining propensities(x, p, t) and observe(x, p, t)
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.species = model.species_names
+        self.observe_names = model.observe_names
+        self.stoichiometry = sparse.csr_matrix(model.stoichiometry())
+        kernel_expressions = [r.rate for r in model.reactions] + [expr for _, expr in model.observes] \
+                             + list(model.funcs.values())
+        placeholders = sorted({s for expr in kernel_expressions for s in expr.symbols if PLACEHOLDER.match(s)})
+        self.param_names = list(model.params) + placeholders
+        self.param_index = {name: i for i, name in enumerate(self.param_names)}
+        self.source = '\n\n'.join([
+            self._generate('propensities', [r.rate for r in model.reactions]),
+            self._generate('observe', [expr for _, expr in model.observes])
+        ])
+        self._load_kernels()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('propensities', None)
+        state.pop('observe', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_kernels()
+
+    def _load_kernels(self):
+        namespace = {'np': np}
+        exec(compile(self.source, f'<compiled {self.model.name}>', 'exec'), namespace)
+        self.propensities = namespace['propensities']
+        self.observe = namespace['observe']
+
+    @property
+    def n_species(self):
+        return len(self.species)
+
+    @property
+    def n_reactions(self):
+        return self.stoichiometry.shape[1]
+
+    def param_vector(self, env):
+        """Parameter vector p in the layout of param_names from an environment of params (and placeholders)"""
+        return [np.asarray(env[name], dtype=float) for name in self.param_names]
+
+    def apply_stoichiometry(self, k):
+        """Change of the species for k firings per reaction, k with shape (n_reactions, ...)"""
+        k = np.asarray(k, dtype=float)
+        return (self.stoichiometry @ k.reshape(self.n_reactions, -1)).reshape((self.n_species,) + k.shape[1:])
+
+    def _generate(self, name, expressions):
+        """Source code of a kernel evaluating the expressions into an array with shape (len(expressions),) + x.shape[1:]"""
+        model = self.model
+        species_index = {s: i for i, s in enumerate(self.species)}
+        funcs = model.required_funcs(expressions)
+        func_vars = {f: f'f{i}' for i, f in enumerate(funcs)}
+
+        def symbol(s):
+            if s in func_vars:
+                return func_vars[s]
+            if s in species_index:
+                return f'x[{species_index[s]}]'
+            if s in self.param_index:
+                return f'p[{self.param_index[s]}]'
+            if s == 'time':
+                return 't'
+            raise ValueError(f"Unknown name {s} in emodl {model.name}")
+
+        def code(sexpr):
+            if isinstance(sexpr, float):
+                return repr(sexpr)
+            if isinstance(sexpr, str):
+                return 'np.pi' if sexpr == 'pi' else symbol(sexpr)
+            op, args = sexpr[0], [code(arg) for arg in sexpr[1:]]
+            if op == '-' and len(args) == 1:
+                return f'(-{args[0]})'
+            if op in _BINARY:
+                return '(' + f' {_BINARY[op]} '.join(args) + ')'
+            if op in _NESTED:
+                result = args[0]
+                for arg in args[1:]:
+                    result = f'{_NESTED[op]}({result}, {arg})'
+                return result
+            if op in _UNARY:
+                return f'{_UNARY[op]}({args[0]})'
+            if op in ('pow', '^'):
+                return f'np.power({args[0]}, {args[1]})'
+            if op == 'if':
+                return f'np.where({args[0]}, {args[1]}, {args[2]})'
+            raise ValueError(f"Unknown operator '{op}' in emodl {model.name}")
+
+        lines = [f'def {name}(x, p, t):',
+                 f'    out = np.empty(({len(expressions)},) + np.shape(x)[1:])']
+        for f in funcs:
+            lines.append(f'    {func_vars[f]} = {code(model.funcs[f].sexpr)}')
+        for i, expr in enumerate(expressions):
+            lines.append(f'    out[{i}] = {code(expr.sexpr)}')
+        lines.append('    return out')
+        return '\n'.join(lines)
+
+
+def _cache_fname(key, cache_dir):
+    return os.path.join(cache_dir, f'{key}_v{COMPILER_VERSION}.pkl')
+
+
+def _read_cache(fname):
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, 'rb') as fin:
+            compiled = pickle.load(fin)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+        log.warning(f"Ignoring unreadable compiled emodl {fname}: {e}")
+        return None
+    log.debug(f"Loaded compiled emodl from {fname}")
+    return compiled
+
+
+def compile_model(model, cache_dir=None):
+    """Compile a parsed emodl model, cached by the hash of its emodl text
+
+    Parameters
+    ----------
+    model : EmodlModel
+    cache_dir : str, optional
+        Directory to store and look up pickled compiled models, only the in-memory cache is used if None
+    """
+    key = model.text_hash
+    if key is None:
+        return CompiledModel(model)
+    if key in _memory_cache:
+        return _memory_cache[key]
+    compiled = _read_cache(_cache_fname(key, cache_dir)) if cache_dir else None
+    if compiled is None:
+        compiled = CompiledModel(model)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            fname = _cache_fname(key, cache_dir)
+            # write to a temporary file first, array tasks may compile the same emodl concurrently
+            tmp_fname = f'{fname}.{os.getpid()}.tmp'
+            with open(tmp_fname, 'wb') as fout:
+                pickle.dump(compiled, fout)
+            os.replace(tmp_fname, fname)
+    _memory_cache[key] = compiled
+    return compiled
+
+
+def compile_emodl(text, name=None, cache_dir=None):
+    """Parse and compile emodl text, parsing is skipped if the compiled model is cached"""
+    key = emodl_hash(text)
+    compiled = _memory_cache.get(key)
+    if compiled is None and cache_dir:
+        compiled = _read_cache(_cache_fname(key, cache_dir))
+    if compiled is None:
+        return compile_model(parse_emodl(text, name=name), cache_dir=cache_dir)
+    _memory_cache[key] = compiled
+    return compiled
+
+
+def load_compiled(fname, cache_dir=None):
+    """Load and compile an emodl file"""
+    with open(fname) as fin:
+        return compile_emodl(fin.read(), name=fname, cache_dir=cache_dir)
@@ -0,0 +1,397 @@
+"""
+Parse CMS emodl files into python objects that can be simulated without compartments.exe.
+
+Supports the subset of the emodl language written by the emodl generators and the emodl files in ./emodl:
+species, param, func, observe, reaction, time-event and state-event (locale, set-locale, import,
+start-model and end-model are accepted and ignored).
+Placeholders in template emodl files (i.e. @Ki_EMS_1@) can be resolved at evaluation time by passing
+a dictionary of values (scalars or numpy arrays), so that a single parsed template can be evaluated
+for many rows of the sampled_parameters.csv.
+"""
+import functools
+import hashlib
+import math
+import operator
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+IGNORED_STATEMENTS = ('import', 'start-model', 'end-model', 'locale', 'set-locale')
+PLACEHOLDER = re.compile(r'^@\w+@$')
+
+
+def tokenize(text):
+    """Split emodl text into tokens, dropping ';' comments"""
+    text = re.sub(r';[^\n]*', '', text)
+    return re.findall(r'\(|\)|"[^"]*"|[^\s()]+', text)
+
+
+def parse_sexpr(text):
+    """Parse emodl text into a list of nested lists of atoms (str or float)"""
+    stack = [[]]
+    for token in tokenize(text):
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) == 1:
+                raise ValueError("Unbalanced ')' in emodl")
+            expr = stack.pop()
+            stack[-1].append(expr)
+        else:
+            try:
+                stack[-1].append(float(token))
+            except ValueError:
+                stack[-1].append(token)
+    if len(stack) != 1:
+        raise ValueError("Unbalanced '(' in emodl")
+    return stack[0]
+
+
+def _fold(func):
+    return lambda *args: functools.reduce(func, args)
+
+
+def _subtract(*args):
+    if len(args) == 1:
+        return -args[0]
+    return functools.reduce(operator.sub, args)
+
+
+def _if(condition, a, b):
+    return np.where(condition, a, b)
+
+
+OPERATORS = {
+    '+': lambda *args: sum(args[1:], args[0]),
+    '-': _subtract,
+    '*': _fold(operator.mul),
+    '/': _fold(operator.truediv),
+    'sum': lambda *args: sum(args[1:], args[0]),
+    'max': _fold(np.maximum),
+    'min': _fold(np.minimum),
+    'floor': np.floor,
+    'ceil': np.ceil,
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'sin': np.sin,
+    'cos': np.cos,
+    'pow': np.power,
+    '^': np.power,
+    '>': np.greater,
+    '<': np.less,
+    '>=': np.greater_equal,
+    '<=': np.less_equal,
+    '==': np.equal,
+    'and': _fold(np.logical_and),
+    'or': _fold(np.logical_or),
+    'not': np.logical_not,
+    'if': _if,
+}
+
+CONSTANTS = {'pi': math.pi}
+
+
+class Expression:
+    """A compiled emodl expression
+
+    Calling the expression with an environment (dictionary of species, params, funcs,
+    placeholders and 'time') returns its value. Values can be floats or numpy arrays,
+    which allows evaluating many scenarios or runs at once.
+    """
+
+    def __init__(self, sexpr):
+        self.sexpr = sexpr
+        self.symbols = set()
+        self._fn = self._compile(sexpr)
+
+    def __call__(self, env):
+        return self._fn(env)
+
+    def __repr__(self):
+        return f'Expression({to_text(self.sexpr)})'
+
+    def __getstate__(self):
+        return {'sexpr': self.sexpr}
+
+    def __setstate__(self, state):
+        self.__init__(state['sexpr'])
+
+    @property
+    def placeholders(self):
+        return {s for s in self.symbols if PLACEHOLDER.match(s)}
+
+    def _compile(self, sexpr):
+        if isinstance(sexpr, float):
+            return lambda env: sexpr
+        if isinstance(sexpr, str):
+            if sexpr in CONSTANTS:
+                value = CONSTANTS[sexpr]
+                return lambda env: value
+            self.symbols.add(sexpr)
+            return lambda env: env[sexpr]
+        if not sexpr:
+            raise ValueError("Empty expression in emodl")
+        op, args = sexpr[0], sexpr[1:]
+        if op not in OPERATORS:
+            raise ValueError(f"Unknown operator '{op}' in expression {to_text(sexpr)}")
+        func = OPERATORS[op]
+        arg_fns = [self._compile(arg) for arg in args]
+        if len(arg_fns) == 1:
+            arg_fn = arg_fns[0]
+            return lambda env: func(arg_fn(env))
+        if len(arg_fns) == 2:
+            a, b = arg_fns
+            return lambda env: func(a(env), b(env))
+        return lambda env: func(*[fn(env) for fn in arg_fns])
+
+
+def to_text(sexpr):
+    """Write a parsed s-expression back to emodl text"""
+    if isinstance(sexpr, list):
+        return '(' + ' '.join(to_text(x) for x in sexpr) + ')'
+    if isinstance(sexpr, float):
+        return repr(int(sexpr)) if sexpr.is_integer() else repr(sexpr)
+    return sexpr
+
+
+class Reaction:
+
+    def __init__(self, name, reactants, products, rate):
+        self.name = name
+        self.reactants = reactants
+        self.products = products
+        self.rate = rate
+
+
+class Event:
+    """time-event (trigger is a time) or state-event (trigger is a predicate)"""
+
+    def __init__(self, name, trigger, actions):
+        self.name = name
+        self.trigger = trigger
+        self.actions = actions
+
+    def apply(self, env):
+        """Apply the assignments in order, later assignments see earlier ones"""
+        for target, value in self.actions:
+            env[target] = value(env)
+
+
+class EmodlModel:
+    """Model structure of an emodl file
+
+    Attributes
+    ----------
+    species : OrderedDict
+        species name -> Expression of the initial value
+    params : OrderedDict
+        param name -> Expression, evaluated once in the order of definition
+    funcs : OrderedDict
+        func name -> Expression, evaluated at every time step
+    observes : list of (str, Expression)
+        output channels written to the trajectories file
+    reactions : list of Reaction
+    time_events : list of Event
+    state_events : list of Event
+    """
+
+    def __init__(self, name=None, text_hash=None):
+        self.name = name
+        self.text_hash = text_hash
+        self.species = OrderedDict()
+        self.params = OrderedDict()
+        self.funcs = OrderedDict()
+        self.observes = []
+        self.reactions = []
+        self.time_events = []
+        self.state_events = []
+        self._func_order = None
+
+    @property
+    def species_names(self):
+        return list(self.species.keys())
+
+    @property
+    def observe_names(self):
+        return [name for name, _ in self.observes]
+
+    @property
+    def placeholders(self):
+        """Names of all @placeholders@ (without the @) used in the model"""
+        expressions = list(self.species.values()) + list(self.params.values()) + list(self.funcs.values()) \
+                      + [expr for _, expr in self.observes] + [r.rate for r in self.reactions]
+        for event in self.time_events + self.state_events:
+            expressions = expressions + [event.trigger] + [value for _, value in event.actions]
+        placeholders = set()
+        for expr in expressions:
+            placeholders.update(expr.placeholders)
+        return sorted(p.strip('@') for p in placeholders)
+
+    def stoichiometry(self):
+        """Dense (n_species x n_reactions) matrix of net changes per reaction"""
+        index = {name: i for i, name in enumerate(self.species)}
+        stoich = np.zeros((len(self.species), len(self.reactions)))
+        for j, reaction in enumerate(self.reactions):
+            for name in reaction.reactants:
+                stoich[index[name], j] -= 1
+            for name in reaction.products:
+                stoich[index[name], j] += 1
+        return stoich
+
+    def func_order(self):
+        """Order funcs such that each func is evaluated after the funcs it depends on"""
+        if self._func_order is not None:
+            return self._func_order
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Circular func definition involving {name}")
+            visiting.add(name)
+            for dep in self.funcs[name].symbols:
+                if dep in self.funcs:
+                    visit(dep)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.funcs:
+            visit(name)
+        self._func_order = order
+        return order
+
+    def placeholder_env(self, values=None):
+        """Environment with @placeholder@ keys from a dictionary or a row of sampled_parameters"""
+        if values is None:
+            return {}
+        return {f'@{key}@': value for key, value in dict(values).items()}
+
+    def initial_params(self, placeholders=None):
+        """Evaluate all params in order of definition"""
+        env = self.placeholder_env(placeholders)
+        for name, expr in self.params.items():
+            env[name] = expr(env)
+        return env
+
+    def initial_state(self, env, shape=()):
+        """Initial species values, with shape (n_species,) + shape"""
+        x = np.zeros((len(self.species),) + tuple(shape))
+        for i, expr in enumerate(self.species.values()):
+            x[i] = expr(env)
+        return x
+
+    def required_funcs(self, expressions):
+        """Funcs (in evaluation order) needed to evaluate the given expressions"""
+        needed = set()
+        stack = [s for expr in expressions for s in expr.symbols if s in self.funcs]
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack.extend(s for s in self.funcs[name].symbols if s in self.funcs)
+        return [name for name in self.func_order() if name in needed]
+
+    def state_env(self, env, x, t, funcs=None):
+        """Add species values (first axis of x), time and funcs (default all) to a copy of env"""
+        env = dict(env)
+        env.update(zip(self.species, x))
+        env['time'] = t
+        for name in (self.func_order() if funcs is None else funcs):
+            env[name] = self.funcs[name](env)
+        return env
+
+    def propensities(self, env):
+        return [reaction.rate(env) for reaction in self.reactions]
+
+    def observe(self, env):
+        return [expr(env) for _, expr in self.observes]
+
+    def validate(self):
+        """Raise a ValueError if any expression uses an undefined name"""
+        known = set(self.species) | set(self.params) | set(self.funcs) | {'time'}
+        for event in self.state_events:
+            known.update(target for target, _ in event.actions)
+        expressions = [(name, expr) for name, expr in self.params.items()] \
+                      + [(name, expr) for name, expr in self.funcs.items()] \
+                      + [(name, expr) for name, expr in self.observes] \
+                      + [(r.name, r.rate) for r in self.reactions]
+        for event in self.time_events + self.state_events:
+            expressions = expressions + [(event.name, value) for _, value in event.actions]
+            for target, _ in event.actions:
+                if target not in known:
+                    raise ValueError(f"Event {event.name} assigns unknown name {target}")
+        for name, expr in expressions:
+            unknown = {s for s in expr.symbols if s not in known and not PLACEHOLDER.match(s)}
+            if unknown:
+                raise ValueError(f"{name} uses undefined names: {sorted(unknown)}")
+        for reaction in self.reactions:
+            for species in reaction.reactants + reaction.products:
+                if species not in self.species:
+                    raise ValueError(f"Reaction {reaction.name} uses unknown species {species}")
+
+
+def _parse_actions(name, actions):
+    if not isinstance(actions, list) or not all(isinstance(a, list) and len(a) == 2 for a in actions):
+        raise ValueError(f"Event {name} must have a list of (target value) assignments")
+    return [(target, Expression(value)) for target, value in actions]
+
+
+def emodl_hash(text):
+    """Content hash of an emodl file, used to cache parsed and compiled models"""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def parse_emodl(text, name=None):
+    """Parse emodl text into an EmodlModel
+
+    Parameters
+    ----------
+    text : str
+        Content of an emodl file, either a template with @placeholders@ or a rendered file.
+    name : str, optional
+        Name of the model, used in log messages.
+
+    Returns
+    -------
+    model : EmodlModel
+    """
+    model = EmodlModel(name=name, text_hash=emodl_hash(text))
+    for statement in parse_sexpr(text):
+        if not isinstance(statement, list) or not statement:
+            raise ValueError(f"Unexpected top level token in emodl: {statement}")
+        kind, args = statement[0], statement[1:]
+        if kind in IGNORED_STATEMENTS:
+            continue
+        if kind == 'species':
+            model.species[args[0]] = Expression(args[1] if len(args) > 1 else 0.0)
+        elif kind == 'param':
+            model.params[args[0]] = Expression(args[1])
+        elif kind == 'func':
+            model.funcs[args[0]] = Expression(args[1])
+        elif kind == 'observe':
+            model.observes.append((args[0], Expression(args[1])))
+        elif kind == 'reaction':
+            if len(args) != 4:
+                raise ValueError(f"Reaction {args[0]} must have a name, reactants, products and rate")
+            model.reactions.append(Reaction(args[0], list(args[1]), list(args[2]), Expression(args[3])))
+        elif kind == 'time-event':
+            if len(args) != 3:
+                raise ValueError(f"Only time-events of the form (time-event name time ((target value) ...)) "
+                                 f"are supported, got {to_text(statement)}")
+            model.time_events.append(Event(args[0], Expression(args[1]), _parse_actions(args[0], args[2])))
+        elif kind == 'state-event':
+            model.state_events.append(Event(args[0], Expression(args[1]), _parse_actions(args[0], args[2])))
+        else:
+            raise ValueError(f"Unsupported emodl statement '{kind}'")
+    model.validate()
+    return model
+
+
+def load_emodl(fname):
+    with open(fname) as fin:
+        return parse_emodl(fin.read(), name=fname)
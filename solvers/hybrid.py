@@ -0,0 +1,106 @@
+"""
+Hybrid deterministic/stochastic solver for emodl models.
+
+The locale models start with a handful of infections (i.e. As::EMS_6 set to 1 by the time_infection_import event)
+but most individuals are in compartments with millions of people. Simulating all reactions stochastically requires
+tiny leaps, while a deterministic model cannot capture importation and extinction.
+At every step (of length tau) the reactions are partitioned per scenario and run:
+- a reaction is deterministic if the species it consumes has at least `threshold` individuals and it is expected to
+  fire at least `min_firings` times during the step, it then fires its expected number of times n * (1 - exp(-a / n * tau))
+- all other reactions fire stochastically as in solvers/tau_leaping.py (binomial or Poisson)
+Species below the threshold are kept integer, fractions left by deterministic reactions are rounded stochastically
+(keeping the mean), so that small compartments can become extinct.
+The partition is updated at every step, hence reactions switch between both regimes as the epidemic grows and declines.
+"""
+import logging
+
+import numpy as np
+
+from solvers.tau_leaping import consumption_scale, simulate_batch
+
+log = logging.getLogger(__name__)
+
+
+def stochastic_round(rng, x):
+    """Round to one of the neighbouring integers with probabilities keeping the mean"""
+    floor = np.floor(x)
+    return floor + (rng.random(x.shape) < x - floor)
+
+
+def hybrid_step(threshold=1000, min_firings=10):
+    """Step function for simulate_batch (see tau_leaping.tau_leap) partitioning reactions at the threshold
+
+    Parameters
+    ----------
+    threshold : float
+        Minimum number of individuals in the consumed species for a reaction to be deterministic
+    min_firings : float
+        Minimum expected number of firings per step for a reaction to be deterministic
+    """
+
+    def step(rng, partition, compiled, a, x, tau):
+        low = x < threshold
+        if low.any():
+            x = np.where(low, stochastic_round(rng, np.maximum(x, 0)), x)
+        a = np.nan_to_num(np.maximum(a, 0))
+        k = a * tau
+        stochastic = k < min_firings
+        if len(partition.binomial):
+            n = np.maximum(x[partition.source], 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                p = np.where(n > 0, -np.expm1(-a[partition.binomial] / n * tau), 0)
+            stochastic[partition.binomial] |= n < threshold
+            k[partition.binomial] = n * p
+            draw = stochastic[partition.binomial] & (n > 0) & (p > 0)
+            k_binomial = k[partition.binomial]
+            k_binomial[draw] = rng.binomial(n[draw].astype(np.int64), p[draw])
+            k[partition.binomial] = k_binomial
+        if len(partition.poisson):
+            k_poisson = k[partition.poisson]
+            draw = stochastic[partition.poisson]
+            k_poisson[draw] = rng.poisson(k_poisson[draw])
+            k[partition.poisson] = k_poisson
+
+        scale = consumption_scale(partition, k, x)
+        if scale is not None:
+            k = np.where(stochastic, np.floor(k * scale), k * scale)
+        return x + compiled.apply_stoichiometry(k)
+
+    return step
+
+
+def simulate_hybrid(model, duration, samples, n_scenarios=1, n_runs=1, placeholders=None, tau=0.1,
+                    threshold=1000, min_firings=10, seed=None):
+    """Simulate all scenarios and runs of an emodl model with the hybrid solver
+
+    Parameters
+    ----------
+    model : EmodlModel
+    duration : float
+        Simulated time in days
+    samples : int
+        Number of monitoring samples over the duration
+    n_scenarios : int
+        Number of scenarios in the batch
+    n_runs : int
+        Number of stochastic runs per scenario
+    placeholders : dict, optional
+        Values for @placeholders@ if the model is a template
+    tau : float
+        Step size in days
+    threshold : float
+        Species with fewer individuals are simulated stochastically
+    min_firings : float
+        Reactions expected to fire fewer times per step are simulated stochastically
+    seed : int, optional
+        Seed of the random number generator
+
+    Returns
+    -------
+    sampletimes : np.ndarray
+        (n_samples,)
+    values : np.ndarray
+        Observed channels with shape (n_samples, n_channels, n_scenarios, n_runs)
+    """
+    return simulate_batch(model, duration, samples, hybrid_step(threshold, min_firings),
+                          n_scenarios=n_scenarios, n_runs=n_runs, placeholders=placeholders, tau=tau, seed=seed)
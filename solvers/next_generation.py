@@ -0,0 +1,192 @@
+"""
+Reproduction numbers of emodl models from the next-generation matrix (van den Driessche and Watmough, 2002).
+
+Transmission reactions are identified by their name (i.e. exposure_EMS_1, exposure_age0to19, campus_exposure),
+the infected species are the products of the transmission reactions and all species reachable from them through
+the other reactions, except absorbing species (i.e. recovered and deaths).
+At the disease-free state, F is the Jacobian of the new infections and V the Jacobian of the transitions between
+(and out of) the infected species, both derived numerically from the compiled propensities, which covers any
+structure written by the emodl generators (age contact matrix C{i}_{j}, locale specific Ki, migration).
+R is the spectral radius of the next-generation matrix F V^-1, evaluated for all rows of a sampled_parameters.csv at once.
+
+Rt(t) is evaluated with the parameters after all time-events up to t (i.e. ki_multiplier changes),
+at the disease-free state, hence it does not include the depletion of susceptibles.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+from solvers.compiler import compile_model
+from solvers.tau_leaping import apply_events_masked
+
+log = logging.getLogger(__name__)
+
+TRANSMISSION_PATTERN = 'exposure'
+
+
+class NextGenerationMatrix:
+    """Infected species and transmission reactions of a model, used to evaluate reproduction numbers
+
+    Attributes
+    ----------
+    transmission : list of int
+        Indices of the transmission reactions
+    infected : list of int
+        Indices of the infected species
+    entry : list of int
+        Positions (within infected) of the species receiving new infections
+    """
+
+    def __init__(self, model, pattern=TRANSMISSION_PATTERN, h=1e-3):
+        self.model = model
+        self.compiled = compile_model(model)
+        self.h = h
+        stoich = self.compiled.stoichiometry.toarray()
+        self.transmission = [j for j, reaction in enumerate(model.reactions) if pattern in reaction.name]
+        if not self.transmission:
+            raise ValueError(f"No transmission reactions matching '{pattern}' in {model.name}")
+        transitions = [j for j in range(len(model.reactions)) if j not in self.transmission]
+
+        new_infected = sorted({i for j in self.transmission for i in np.flatnonzero(stoich[:, j] > 0)})
+        infected, stack = set(new_infected), list(new_infected)
+        while stack:
+            i = stack.pop()
+            for j in transitions:
+                if stoich[i, j] < 0:
+                    for k in np.flatnonzero(stoich[:, j] > 0):
+                        if k not in infected:
+                            infected.add(k)
+                            stack.append(k)
+        has_outflow = {i for j in transitions for i in np.flatnonzero(stoich[:, j] < 0)}
+        self.infected = sorted(infected & has_outflow)
+        self.entry = [self.infected.index(i) for i in new_infected]
+        self._stoich_infected = stoich[self.infected]
+        self._transitions = transitions
+
+    @property
+    def infected_names(self):
+        return [self.model.species_names[i] for i in self.infected]
+
+    def jacobians(self, env, x, t=0.0):
+        """F and V at the disease-free state of x, with shape (n_infected, n_infected) + x.shape[1:]"""
+        compiled = self.compiled
+        p = compiled.param_vector(env)
+        x0 = np.array(x, dtype=float)
+        x0[self.infected] = 0
+        a0 = compiled.propensities(x0, p, t)
+        n = len(self.infected)
+        F = np.zeros((n, n) + x0.shape[1:])
+        V = np.zeros((n, n) + x0.shape[1:])
+        stoich_in = np.maximum(self._stoich_infected[:, self.transmission], 0)
+        stoich_transitions = self._stoich_infected[:, self._transitions]
+        for col, i in enumerate(self.infected):
+            x0[i] = self.h
+            da = (compiled.propensities(x0, p, t) - a0) / self.h
+            x0[i] = 0
+            F[:, col] = np.tensordot(stoich_in, da[self.transmission], axes=1)
+            V[:, col] = -np.tensordot(stoich_transitions, da[self._transitions], axes=1)
+        return F, V
+
+    def reproduction_number(self, env, x, t=0.0):
+        """Spectral radius of the next-generation matrix, with shape x.shape[1:]"""
+        F, V = self.jacobians(env, x, t)
+        batch_shape = F.shape[2:]
+        n = F.shape[0]
+        F = np.moveaxis(F.reshape(n, n, -1), -1, 0)
+        V = np.moveaxis(V.reshape(n, n, -1), -1, 0)
+        # only the rows of the species receiving new infections are nonzero in F
+        rhs = np.zeros((len(F), n, len(self.entry)))
+        rhs[:, self.entry, np.arange(len(self.entry))] = 1
+        K = F[:, self.entry] @ np.linalg.solve(V, rhs)
+        R = np.abs(np.linalg.eigvals(K)).max(axis=-1)
+        return R.reshape(batch_shape)
+
+
+def _apply_time_events(model, env, x, times, fired, t):
+    """Apply the time-events up to t per row in order of their time, returns the updated state"""
+    while True:
+        pending = [(~f & (times_e <= t)) for times_e, f in zip(times, fired)]
+        if not any(p.any() for p in pending):
+            return x
+        next_time = np.min([np.where(p, times_e, np.inf) for times_e, p in zip(times, pending)], axis=0)
+        for event, times_e, p, f in zip(model.time_events, times, pending, fired):
+            mask = p & (times_e == next_time)
+            if mask.any():
+                x = apply_events_masked(model, [event], mask, env, x, t)
+                f |= mask
+
+
+def compute_Rt(model, placeholders=None, times=(0,), n_rows=None, chunk_size=50, pattern=TRANSMISSION_PATTERN):
+    """Reproduction number Rt at the given times for each row of parameters
+
+    Parameters
+    ----------
+    model : EmodlModel
+    placeholders : dict, optional
+        Placeholder values, arrays with one value per row (i.e. columns of the sampled_parameters.csv)
+    times : list of float
+        Days since the start of the simulation, 0 for R0
+    n_rows : int, optional
+        Number of rows, inferred from the placeholders if not provided
+    chunk_size : int
+        Number of rows evaluated at once, limits the memory of the (n_infected x n_infected) matrices
+    pattern : str
+        Reactions with the pattern in their name are transmission reactions
+
+    Returns
+    -------
+    Rt : np.ndarray
+        (n_rows, n_times)
+    """
+    placeholders = dict(placeholders or {})
+    if n_rows is None:
+        n_rows = max([len(v) for v in placeholders.values() if np.ndim(v)] + [1])
+    ngm = NextGenerationMatrix(model, pattern=pattern)
+    Rt = np.zeros((n_rows, len(times)))
+    for start in range(0, n_rows, chunk_size):
+        rows = slice(start, min(start + chunk_size, n_rows))
+        n = rows.stop - rows.start
+        chunk = {key: np.reshape(value, (-1, 1))[rows] if np.ndim(value) else value
+                 for key, value in placeholders.items()}
+        env = model.initial_params(chunk)
+        x = model.initial_state(env, (n, 1))
+        event_times = [np.broadcast_to(event.trigger(env), (n, 1)).astype(float) for event in model.time_events]
+        fired = [np.zeros((n, 1), dtype=bool) for _ in model.time_events]
+        for i in np.argsort(times, kind='stable'):
+            x = _apply_time_events(model, env, x, event_times, fired, times[i])
+            Rt[rows, i] = ngm.reproduction_number(env, x, times[i])[:, 0]
+    return Rt
+
+
+def screen_parameter_samples(df, model, band, times=(0,), pattern=TRANSMISSION_PATTERN):
+    """Add Rt columns to the sampled parameters and flag the rows with Rt inside the band at all times
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Sampled parameters, one row per scenario
+    model : EmodlModel
+        Template emodl with @placeholders@ for the columns of df
+    band : (float, float)
+        Lower and upper limit of plausible Rt values
+    times : list of float
+        Days since the start of the simulation at which Rt has to be within the band
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Copy of df with a column Rt_<time> per time
+    keep : pd.Series
+        True for rows with Rt within the band at all times
+    """
+    missing = [p for p in model.placeholders if p not in df.columns]
+    if missing:
+        raise ValueError(f"Missing placeholders in the sampled parameters: {missing}")
+    placeholders = {p: df[p].to_numpy(dtype=float) for p in model.placeholders}
+    Rt = compute_Rt(model, placeholders, times=times, n_rows=len(df), pattern=pattern)
+    df = df.copy()
+    for i, t in enumerate(times):
+        df[f'Rt_{t:g}'] = Rt[:, i]
+    keep = pd.Series(np.all((Rt >= band[0]) & (Rt <= band[1]), axis=1), index=df.index)
+    return df, keep
@@ -0,0 +1,233 @@
+"""
+Exact stochastic simulation (SSA) of emodl models with the next-reaction method of Gibson and Bruck (2000).
+
+Every reaction keeps an absolute putative firing time in an indexed priority queue. After a reaction fires,
+only the reactions whose propensity depends on the changed species (directly or through funcs) are updated,
+as given by a dependency graph built from the emodl, and their firing times are rescaled instead of redrawn.
+This makes exact runs of small models (i.e. the campus models nu_undergrad.emodl and nu_undergrad_ct.emodl)
+cheap compared to running model_SSA.cfg through CMS.
+
+Time-events are applied exactly at their time, state-events are checked after every reaction.
+Funcs depending on 'time' are re-evaluated after every reaction, i.e. treated as constant in between.
+"""
+import logging
+
+import numpy as np
+
+from solvers.ode_solver import get_event_times
+from solvers.trajectories import get_sampletimes
+
+log = logging.getLogger(__name__)
+
+
+class IndexedPriorityQueue:
+    """Binary min-heap of putative reaction times, which keeps the heap position of each reaction
+    so that the time of any reaction can be updated in O(log n)"""
+
+    def __init__(self, times):
+        self.times = [float(t) for t in times]
+        self.heap = sorted(range(len(self.times)), key=lambda i: self.times[i])
+        self.position = [0] * len(self.times)
+        for pos, i in enumerate(self.heap):
+            self.position[i] = pos
+
+    def min(self):
+        """Index and time of the next reaction"""
+        i = self.heap[0]
+        return i, self.times[i]
+
+    def update(self, i, time):
+        old = self.times[i]
+        self.times[i] = time
+        if time < old:
+            self._sift_up(self.position[i])
+        elif time > old:
+            self._sift_down(self.position[i])
+
+    def _swap(self, a, b):
+        heap = self.heap
+        heap[a], heap[b] = heap[b], heap[a]
+        self.position[heap[a]] = a
+        self.position[heap[b]] = b
+
+    def _sift_up(self, pos):
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if self.times[self.heap[pos]] >= self.times[self.heap[parent]]:
+                break
+            self._swap(pos, parent)
+            pos = parent
+
+    def _sift_down(self, pos):
+        n = len(self.heap)
+        while True:
+            child = 2 * pos + 1
+            if child >= n:
+                break
+            if child + 1 < n and self.times[self.heap[child + 1]] < self.times[self.heap[child]]:
+                child += 1
+            if self.times[self.heap[child]] >= self.times[self.heap[pos]]:
+                break
+            self._swap(pos, child)
+            pos = child
+
+
+class DependencyGraph:
+    """Which funcs and reaction propensities have to be updated after each reaction fires
+
+    Attributes
+    ----------
+    changes : list of list of (str, float)
+        Net change of the species per reaction
+    funcs : list of list of str
+        Funcs (in evaluation order) to re-evaluate after each reaction
+    reactions : list of list of int
+        Reactions whose propensity has to be re-evaluated after each reaction, including the reaction itself
+    """
+
+    def __init__(self, model):
+        stoich = model.stoichiometry()
+        species = model.species_names
+        func_order = model.func_order()
+
+        # species (and time) each func depends on, through other funcs
+        func_deps = {}
+        for name in func_order:
+            deps = set()
+            for s in model.funcs[name].symbols:
+                deps.update(func_deps[s] if s in func_deps else {s})
+            func_deps[name] = deps
+
+        def expression_deps(expr):
+            deps = set()
+            for s in expr.symbols:
+                deps.update(func_deps.get(s, {s}))
+            return deps
+
+        rate_deps = [expression_deps(reaction.rate) for reaction in model.reactions]
+        self.changes, self.funcs, self.reactions = [], [], []
+        for j in range(len(model.reactions)):
+            changed = {species[i] for i in np.flatnonzero(stoich[:, j])} | {'time'}
+            self.changes.append([(species[i], stoich[i, j]) for i in np.flatnonzero(stoich[:, j])])
+            self.funcs.append([name for name in func_order if func_deps[name] & changed])
+            self.reactions.append(sorted({j} | {i for i, deps in enumerate(rate_deps) if deps & changed}))
+
+
+def simulate_nrm(model, duration, samples, n_runs=1, placeholders=None, seed=None):
+    """Exact stochastic simulation of an emodl model with the next-reaction method
+
+    Parameters
+    ----------
+    model : EmodlModel
+    duration : float
+        Simulated time in days
+    samples : int
+        Number of monitoring samples over the duration
+    n_runs : int
+        Number of stochastic runs
+    placeholders : dict, optional
+        Values for @placeholders@ if the model is a template
+    seed : int, optional
+        Seed of the random number generator
+
+    Returns
+    -------
+    sampletimes : np.ndarray
+        (n_samples,)
+    values : np.ndarray
+        Observed channels with shape (n_runs, n_samples, n_channels)
+    """
+    rng = np.random.default_rng(seed)
+    sampletimes = get_sampletimes(duration, samples)
+    graph = DependencyGraph(model)
+    values = np.zeros((n_runs, len(sampletimes), len(model.observes)))
+    for run in range(n_runs):
+        values[run] = _simulate_run(model, graph, duration, sampletimes, placeholders, rng)
+    return sampletimes, values
+
+
+def _simulate_run(model, graph, duration, sampletimes, placeholders, rng):
+    values = np.zeros((len(sampletimes), len(model.observes)))
+    rates = [reaction.rate for reaction in model.reactions]
+    env = model.initial_params(placeholders)
+    x = model.initial_state(env)
+    time_events = get_event_times(model, env, duration)
+    fired_state_events = set()
+
+    def propensity(i):
+        a = float(rates[i](env))
+        return a if a > 0 else 0.0
+
+    def draw(a, t):
+        return t + rng.exponential(1 / a) if a > 0 else np.inf
+
+    def refresh(t):
+        """Re-evaluate all funcs and propensities, i.e. after an event changed params or species"""
+        env.update(model.state_env(env, [env[name] for name in model.species], t))
+        for i in range(len(rates)):
+            reschedule(i, propensity(i), t)
+
+    def reschedule(i, a_new, t):
+        """Rescale the remaining waiting time of reaction i to its new propensity (Gibson and Bruck)"""
+        a_old, t_old = a[i], queue.times[i]
+        if a_new <= 0:
+            t_new = np.inf
+        elif a_old > 0 and t_old < np.inf:
+            t_new = t + a_old / a_new * (t_old - t)
+        else:
+            t_new = draw(a_new, t)
+        a[i] = a_new
+        queue.update(i, t_new)
+
+    def apply_state_events(t):
+        to_fire = [e for e in model.state_events if e.name not in fired_state_events and bool(e.trigger(env))]
+        for event in to_fire:
+            fired_state_events.add(event.name)
+            event.apply(env)
+        return bool(to_fire)
+
+    env.update(model.state_env(env, x, 0.0))
+    for event in [event for t, event in time_events if t <= 0]:
+        event.apply(env)
+    time_events = [(t, event) for t, event in time_events if t > 0]
+    env.update(model.state_env(env, [env[name] for name in model.species], 0.0))
+    a = [propensity(i) for i in range(len(rates))]
+    queue = IndexedPriorityQueue([draw(a_i, 0.0) for a_i in a])
+
+    t = 0.0
+    i_sample = 0
+    i_event = 0
+    while True:
+        j, t_next = queue.min()
+        t_event = time_events[i_event][0] if i_event < len(time_events) else np.inf
+        t_stop = min(t_next, t_event, duration)
+        while i_sample < len(sampletimes) and sampletimes[i_sample] < t_stop:
+            values[i_sample] = model.observe(env)
+            i_sample += 1
+        if t_stop >= duration:
+            break
+
+        if t_event <= t_next:
+            t = t_event
+            while i_event < len(time_events) and time_events[i_event][0] == t:
+                time_events[i_event][1].apply(env)
+                i_event += 1
+            refresh(t)
+            continue
+
+        t = t_next
+        env['time'] = t
+        for name, change in graph.changes[j]:
+            env[name] += change
+        for name in graph.funcs[j]:
+            env[name] = model.funcs[name](env)
+        for i in graph.reactions[j]:
+            if i == j:
+                a[j] = propensity(j)
+                queue.update(j, draw(a[j], t))
+            else:
+                reschedule(i, propensity(i), t)
+        if model.state_events and apply_state_events(t):
+            refresh(t)
+
+    return values
@@ -0,0 +1,117 @@
+"""
+Deterministic (mean-field) solver for emodl models.
+
+Each reaction contributes its propensity times its net stoichiometry to the rate of change of the species,
+and the resulting system of ODEs is integrated with a stiff solver from scipy.
+Time-events are applied exactly at their time, state-events are checked at every monitoring time.
+"""
+import logging
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+from solvers.compiler import compile_model
+from solvers.trajectories import get_sampletimes
+
+log = logging.getLogger(__name__)
+
+
+def get_event_times(model, env, duration):
+    """Sorted list of (time, event) for all time-events within the simulated duration"""
+    events = [(float(event.trigger(env)), i, event) for i, event in enumerate(model.time_events)]
+    events = [(t, i, event) for t, i, event in events if t <= duration]
+    return [(t, event) for t, _, event in sorted(events, key=lambda x: (x[0], x[1]))]
+
+
+def apply_events(model, events, env, x, t):
+    """Apply events to params (env) and species (x), returns the updated state"""
+    if not events:
+        return x
+    state = model.state_env(env, x, t)
+    for event in events:
+        event.apply(state)
+    env.update({name: state[name] for name in env})
+    return np.array([state[name] for name in model.species], dtype=float)
+
+
+def simulate_ode(model, duration, samples, placeholders=None, method='LSODA', rtol=1e-6, atol=1e-6):
+    """Integrate the mean-field ODEs of an emodl model
+
+    Parameters
+    ----------
+    model : EmodlModel
+    duration : float
+        Simulated time in days
+    samples : int
+        Number of monitoring samples over the duration
+    placeholders : dict, optional
+        Values for @placeholders@ if the model is a template
+    method : str
+        Integration method passed to scipy.integrate.solve_ivp, a stiff method ('LSODA', 'BDF', 'Radau')
+        is recommended for the COVID-19 models
+    rtol, atol : float
+        Tolerances passed to scipy.integrate.solve_ivp
+
+    Returns
+    -------
+    sampletimes : np.ndarray
+        (n_samples,)
+    values : np.ndarray
+        Observed channels with shape (n_samples, n_channels)
+    """
+    sampletimes = get_sampletimes(duration, samples)
+    compiled = compile_model(model)
+    env = model.initial_params(placeholders)
+    x = model.initial_state(env)
+    values = np.zeros((len(sampletimes), len(model.observes)))
+    p = compiled.param_vector(env)
+
+    def rhs(t, y):
+        return compiled.apply_stoichiometry(compiled.propensities(y, p, t))
+
+    def record(i, y, t):
+        values[i] = compiled.observe(y, p, t)
+
+    def apply(events, y, t):
+        y = apply_events(model, events, env, y, t)
+        p[:] = compiled.param_vector(env)
+        return y
+
+    fired_state_events = set()
+
+    def check_state_events(y, t):
+        state = model.state_env(env, y, t)
+        to_fire = [e for e in model.state_events if e.name not in fired_state_events and bool(e.trigger(state))]
+        fired_state_events.update(e.name for e in to_fire)
+        return apply(to_fire, y, t) if to_fire else y
+
+    time_events = get_event_times(model, env, duration)
+    breaks = sorted({t for t, _ in time_events if t > 0} | {float(duration)})
+    if model.state_events:
+        breaks = sorted(set(breaks) | {float(t) for t in sampletimes if t > 0})
+
+    t_start = 0.0
+    x = apply([event for t, event in time_events if t <= t_start], x, t_start)
+    i_sample = 0
+    for t_stop in breaks:
+        segment = [t for t in sampletimes[i_sample:] if t < t_stop or t_stop == duration]
+        if t_stop > t_start:
+            sol = solve_ivp(rhs, (t_start, t_stop), x, method=method, t_eval=segment + [t_stop],
+                            rtol=rtol, atol=atol)
+            if not sol.success:
+                raise RuntimeError(f"ODE integration failed at t={t_start}: {sol.message}")
+            for j, t in enumerate(segment):
+                record(i_sample + j, sol.y[:, j], t)
+            x = sol.y[:, -1]
+        else:
+            for j, t in enumerate(segment):
+                record(i_sample + j, x, t)
+        i_sample += len(segment)
+        t_start = t_stop
+        x = apply([event for t, event in time_events if t == t_stop], x, t_stop)
+        if model.state_events:
+            x = check_state_events(x, t_stop)
+
+    if model.state_events and fired_state_events:
+        log.debug(f"State events fired: {sorted(fired_state_events)}")
+    return sampletimes, values
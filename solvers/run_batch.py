@@ -0,0 +1,138 @@
+"""
+Run all scenarios of an experiment with the batched tau-leaping solver (solvers/tau_leaping.py).
+
+Instead of rendering and simulating one emodl per scenario, the template emodl in the experiment folder
+is parsed once and evaluated with the columns of the sampled_parameters.csv, simulating batches of
+scenarios (and all their runs) as one array. The trajectories are written per scenario to
+<exp_dir>/trajectories/trajectories_scen<scen_num>.csv, as by compartments.exe.
+
+python solvers/run_batch.py -d _temp/<exp_name> [--task_id 1 --n_tasks 1]
+
+The solver settings are read from the rendered cfg files in <exp_dir>/simulations (see cfg/model_TauBatch.cfg).
+On Quest the scenarios are split across the tasks of an array job using --task_id and --n_tasks.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from solvers.compiler import load_compiled
+from solvers.run_solver import BATCH_SOLVERS
+from solvers.tau_leaping import simulate_tau_batch
+from solvers.trajectories import read_cfg, write_trajectories
+
+log = logging.getLogger(__name__)
+
+SCENARIOS_PER_TASK = 500
+# compiled template emodl shared by the tasks of an experiment, see solvers/compiler.py
+COMPILED_DIR = 'compiled'
+
+
+def get_n_tasks(scen_num, scenarios_per_task=SCENARIOS_PER_TASK):
+    """Number of array tasks to split the scenarios of an experiment across"""
+    return int(np.ceil(scen_num / scenarios_per_task))
+
+
+def get_template_emodl(exp_dir):
+    """The template emodl copied into the experiment folder by makeExperimentFolder"""
+    emodl_files = [f for f in os.listdir(exp_dir) if f.endswith('.emodl')]
+    if len(emodl_files) != 1:
+        raise ValueError(f"Expected a single template emodl in {exp_dir}, found {emodl_files}")
+    return os.path.join(exp_dir, emodl_files[0])
+
+
+def get_batch_placeholders(model, df):
+    """Placeholder values of the template emodl as arrays with one value per scenario (row of df)"""
+    missing = [p for p in model.placeholders if p not in df.columns]
+    if missing:
+        raise ValueError("Not all placeholders of the template emodl file are in sampled_parameters.csv. "
+                         f"Missing placeholders: {missing}")
+    return {p: df[p].to_numpy(dtype=float) for p in model.placeholders}
+
+
+def run_batch(exp_dir, task_id=1, n_tasks=1):
+    """Simulate the scenarios of an experiment in batches and write their trajectories files
+
+    Parameters
+    ----------
+    exp_dir : str
+        Experiment folder including the template emodl, sampled_parameters.csv and simulations/model_<scen_num>.cfg
+    task_id : int
+        1-based index of the task (i.e. ${SLURM_ARRAY_TASK_ID}) when the experiment is split across n_tasks
+    n_tasks : int
+        Number of tasks the scenarios are split across
+
+    Returns
+    -------
+    fnames : list of str
+        Names of the trajectories files written
+    """
+    df = pd.read_csv(os.path.join(exp_dir, 'sampled_parameters.csv'))
+    df = df.iloc[np.array_split(np.arange(len(df)), n_tasks)[task_id - 1]]
+    emodl_file = get_template_emodl(exp_dir)
+    # the first task compiles the template emodl, the other tasks load the pickled kernels
+    model = load_compiled(emodl_file, cache_dir=os.path.join(exp_dir, COMPILED_DIR)).model
+    placeholders = get_batch_placeholders(model, df)
+
+    def scenario_cfg(scen_num):
+        return read_cfg(os.path.join(exp_dir, 'simulations', f'model_{scen_num}.cfg'))
+
+    cfg = scenario_cfg(df['scen_num'].iloc[0])
+    if cfg.get('solver') not in BATCH_SOLVERS:
+        raise ValueError(f"Solver {cfg.get('solver')} is not a batch solver, choose from {BATCH_SOLVERS}")
+    batch_cfg = cfg.get('tau-batch', {})
+    batch_size = batch_cfg.get('batch_size', 100)
+
+    fnames = []
+    for start in range(0, len(df), batch_size):
+        t0 = time.time()
+        scen_nums = df['scen_num'].iloc[start:start + batch_size].tolist()
+        seed = scenario_cfg(scen_nums[0]).get('prng_seed')
+        sampletimes, values = simulate_tau_batch(
+            model, duration=cfg['duration'], samples=cfg['samples'],
+            n_scenarios=len(scen_nums), n_runs=cfg.get('runs', 1),
+            placeholders={key: value[start:start + batch_size] for key, value in placeholders.items()},
+            tau=batch_cfg.get('Tau', 0.05), seed=seed)
+        for i, scen_num in enumerate(scen_nums):
+            fname = os.path.join(exp_dir, 'trajectories', f'trajectories_scen{scen_num}.csv')
+            write_trajectories(fname, sampletimes, model.observe_names, values[:, :, i, :].transpose(2, 0, 1),
+                               header=f'{os.path.basename(emodl_file)},TAU-BATCH')
+            fnames.append(fname)
+        log.info(f"Scenarios {scen_nums[0]}-{scen_nums[-1]} finished in {time.time() - t0:.1f}s")
+    return fnames
+
+
+def parse_args():
+    description = "Run all scenarios of an experiment with the batched tau-leaping solver"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-d",
+        "--exp_dir",
+        type=str,
+        help="Experiment folder (i.e. _temp/<exp_name>)",
+        required=True
+    )
+    parser.add_argument(
+        "--task_id",
+        type=int,
+        help="1-based index of this task when splitting the scenarios across tasks (i.e. ${SLURM_ARRAY_TASK_ID})",
+        default=1
+    )
+    parser.add_argument(
+        "--n_tasks",
+        type=int,
+        help="Number of tasks the scenarios are split across",
+        default=1
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="INFO")
+    args = parse_args()
+    run_batch(exp_dir=args.exp_dir, task_id=args.task_id, n_tasks=args.n_tasks)
@@ -0,0 +1,150 @@
+"""
+Run a rendered emodl and cfg file with a native python solver instead of compartments.exe.
+Uses the same command line flags as compartments.exe, so that it can replace the CMS command in the
+submission files generated by simulation_helpers.py:
+
+python solvers/run_solver.py -c model_1.cfg -m simulation_1.emodl [-d workdir]
+
+The solver is selected via the "solver" entry in the cfg file (see cfg/model_ODE.cfg).
+Batch solvers (see cfg/model_TauBatch.cfg) can also run a single scenario here, but are meant to
+simulate all scenarios of an experiment at once using solvers/run_batch.py.
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from solvers.emodl_parser import load_emodl
+from solvers.trajectories import read_cfg, get_output_fname, write_trajectories
+
+log = logging.getLogger(__name__)
+
+NATIVE_SOLVERS = ['ODE', 'NRM', 'HYBRID', 'TAU-BATCH']
+BATCH_SOLVERS = ['TAU-BATCH']
+# write a single run whatever the runs of the cfg
+DETERMINISTIC_SOLVERS = ['ODE']
+
+
+def get_cfg_solver(cfg_file):
+    """Name of the solver in a (template) cfg file, the file may still include @placeholders@"""
+    with open(cfg_file) as fin:
+        match = re.search(r'"solver"\s*:\s*"(\w[\w-]*)"', fin.read())
+    return match.group(1) if match else None
+
+
+def is_native_cfg(cfg_file):
+    return get_cfg_solver(cfg_file) in NATIVE_SOLVERS
+
+
+def is_batch_cfg(cfg_file):
+    return get_cfg_solver(cfg_file) in BATCH_SOLVERS
+
+
+def is_deterministic_cfg(cfg_file):
+    return get_cfg_solver(cfg_file) in DETERMINISTIC_SOLVERS
+
+
+def run_ode(model, cfg):
+    from solvers.ode_solver import simulate_ode
+    ode_cfg = cfg.get('ode', {})
+    if cfg.get('runs', 1) > 1:
+        log.info("ODE solver is deterministic, writing a single run")
+    sampletimes, values = simulate_ode(model, duration=cfg['duration'], samples=cfg['samples'],
+                                       method=ode_cfg.get('method', 'LSODA'),
+                                       rtol=ode_cfg.get('rtol', 1e-6), atol=ode_cfg.get('atol', 1e-6))
+    return sampletimes, values[None]
+
+
+def run_nrm(model, cfg):
+    from solvers.next_reaction import simulate_nrm
+    return simulate_nrm(model, duration=cfg['duration'], samples=cfg['samples'], n_runs=cfg.get('runs', 1),
+                        seed=cfg.get('prng_seed'))
+
+
+def run_hybrid(model, cfg):
+    from solvers.hybrid import simulate_hybrid
+    hybrid_cfg = cfg.get('hybrid', {})
+    sampletimes, values = simulate_hybrid(model, duration=cfg['duration'], samples=cfg['samples'],
+                                          n_runs=cfg.get('runs', 1), tau=hybrid_cfg.get('Tau', 0.1),
+                                          threshold=hybrid_cfg.get('threshold', 1000),
+                                          min_firings=hybrid_cfg.get('min_firings', 10), seed=cfg.get('prng_seed'))
+    return sampletimes, values[:, :, 0, :].transpose(2, 0, 1)
+
+
+def run_tau_batch(model, cfg):
+    from solvers.tau_leaping import simulate_tau_batch
+    sampletimes, values = simulate_tau_batch(model, duration=cfg['duration'], samples=cfg['samples'],
+                                             n_runs=cfg.get('runs', 1), tau=cfg.get('tau-batch', {}).get('Tau', 0.05),
+                                             seed=cfg.get('prng_seed'))
+    return sampletimes, values[:, :, 0, :].transpose(2, 0, 1)
+
+
+def run_solver(cfg_file, emodl_file, workdir=None):
+    """Simulate the emodl with the solver given in the cfg and write the trajectories file
+
+    Returns
+    -------
+    fname : str
+        Name of the trajectories file written
+    """
+    if workdir:
+        cfg_file = os.path.join(workdir, cfg_file)
+        emodl_file = os.path.join(workdir, emodl_file)
+    cfg = read_cfg(cfg_file)
+    solver = cfg.get('solver')
+    if solver not in NATIVE_SOLVERS:
+        raise ValueError(f"Solver {solver} in {cfg_file} is not a native solver, "
+                         f"choose from {NATIVE_SOLVERS} or run with compartments.exe")
+
+    t0 = time.time()
+    # the rendered emodl differs per scenario, so its compiled kernels are only cached in memory
+    model = load_emodl(emodl_file)
+    if solver == 'ODE':
+        sampletimes, values = run_ode(model, cfg)
+    elif solver == 'NRM':
+        sampletimes, values = run_nrm(model, cfg)
+    elif solver == 'HYBRID':
+        sampletimes, values = run_hybrid(model, cfg)
+    elif solver == 'TAU-BATCH':
+        sampletimes, values = run_tau_batch(model, cfg)
+
+    fname = get_output_fname(cfg, workdir)
+    write_trajectories(fname, sampletimes, model.observe_names, values, header=f'{os.path.basename(emodl_file)},{solver}')
+    log.info(f"{solver} solver finished in {time.time() - t0:.1f}s, trajectories written to {fname}")
+    return fname
+
+
+def parse_args():
+    description = "Run a single simulation with a native solver"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-c",
+        "--cfg",
+        type=str,
+        help="Rendered cfg file with the solver settings",
+        required=True
+    )
+    parser.add_argument(
+        "-m",
+        "--emodl",
+        type=str,
+        help="Rendered emodl file (all @placeholders@ replaced)",
+        required=True
+    )
+    parser.add_argument(
+        "-d",
+        "--workdir",
+        type=str,
+        help="Working directory, cfg, emodl and output prefix are relative to it if provided",
+        default=None
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="INFO")
+    args = parse_args()
+    run_solver(cfg_file=args.cfg, emodl_file=args.emodl, workdir=args.workdir)
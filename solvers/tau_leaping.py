@@ -0,0 +1,202 @@
+"""
+Batched stochastic (tau-leaping) solver for emodl models.
+
+All scenarios and runs of an experiment are simulated at once: the state is kept as an array with
+shape (n_species, n_scenarios, n_runs) and the propensities of every reaction are evaluated vectorized
+over the whole batch. Per-scenario parameters are passed as columns of the sampled_parameters.csv
+to a single parsed template emodl, so that no emodl has to be rendered or parsed per scenario.
+
+Each step of length tau draws the number of firings of every reaction:
+- reactions consuming a single species (all reactions of the emodl generators) fire
+  Binomial(n, 1 - exp(-a / n * tau)) times, with n the count of the consumed species, as in binomial
+  leaping (B-leaping), so that a single reaction can never consume more individuals than available
+- reactions without a consumed species (i.e. importations) fire Poisson(a * tau) times
+- if competing reactions consume more of a species than available, their firings are scaled down
+Time-events are applied per scenario at the first step boundary at or after their time,
+state-events are one-shot per scenario and run and are checked after every step.
+"""
+import logging
+
+import numpy as np
+
+from solvers.compiler import compile_model
+from solvers.trajectories import get_sampletimes
+
+log = logging.getLogger(__name__)
+
+
+class ReactionPartition:
+    """Split reactions by the species they consume, used to draw the number of firings per step"""
+
+    def __init__(self, stoichiometry):
+        stoich = stoichiometry.toarray()
+        consumed = [np.flatnonzero(stoich[:, j] < 0) for j in range(stoich.shape[1])]
+        self.binomial = np.array([j for j, c in enumerate(consumed)
+                                  if len(c) == 1 and stoich[c[0], j] == -1], dtype=int)
+        self.source = np.array([consumed[j][0] for j in self.binomial], dtype=int)
+        self.poisson = np.setdiff1d(np.arange(stoich.shape[1]), self.binomial)
+        self.consumption = (-stoichiometry).maximum(0).tocsr()
+
+
+def draw_firings(rng, partition, a, x, tau):
+    """Number of firings of each reaction during one step
+
+    Parameters
+    ----------
+    rng : np.random.Generator
+    partition : ReactionPartition
+    a : np.ndarray
+        Propensities with shape (n_reactions, n_scenarios, n_runs)
+    x : np.ndarray
+        Species counts with shape (n_species, n_scenarios, n_runs)
+    tau : float
+        Step size in days
+    """
+    a = np.nan_to_num(np.maximum(a, 0))
+    k = np.zeros_like(a)
+    if len(partition.binomial):
+        n = np.maximum(np.round(x[partition.source]), 0)
+        a_binomial = a[partition.binomial]
+        # only draw where the reaction can fire, most compartments are empty for most of the time
+        active = (n > 0) & (a_binomial > 0)
+        k_binomial = np.zeros_like(n)
+        k_binomial[active] = rng.binomial(n[active].astype(np.int64), -np.expm1(-a_binomial[active] / n[active] * tau))
+        k[partition.binomial] = k_binomial
+    if len(partition.poisson):
+        k[partition.poisson] = rng.poisson(a[partition.poisson] * tau)
+
+    scale = consumption_scale(partition, k, x)
+    if scale is not None:
+        k = np.floor(k * scale)
+    return k
+
+
+def consumption_scale(partition, k, x):
+    """Factors to scale down the firings k of competing reactions which consume more of a species than available
+
+    Returns None if no species is overdrawn
+    """
+    consumed = (partition.consumption @ k.reshape(len(k), -1)).reshape(x.shape)
+    over = consumed > x
+    if not over.any():
+        return None
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(over, np.maximum(x, 0) / consumed, 1)
+    scale_reaction = np.ones_like(k)
+    for i in np.flatnonzero(over.reshape(len(x), -1).any(axis=1)):
+        reactions = partition.consumption[i].indices
+        scale_reaction[reactions] = np.minimum(scale_reaction[reactions], scale[i])
+    return scale_reaction
+
+
+def tau_leap(rng, partition, compiled, a, x, tau):
+    """One tau-leaping step, returns the new state"""
+    return x + compiled.apply_stoichiometry(draw_firings(rng, partition, a, x, tau))
+
+
+def apply_events_masked(model, events, mask, env, x, t):
+    """Apply events to the scenarios (and runs) selected by a boolean mask, returns the updated state"""
+    state = model.state_env(env, x, t)
+    for event in events:
+        for target, value in event.actions:
+            state[target] = np.where(mask, value(state), state[target])
+    for name in env:
+        env[name] = state[name]
+    return np.stack([np.broadcast_to(state[name], x.shape[1:]) for name in model.species])
+
+
+def simulate_tau_batch(model, duration, samples, n_scenarios=1, n_runs=1, placeholders=None, tau=0.05, seed=None):
+    """Simulate all scenarios and runs of an emodl model with tau-leaping, see simulate_batch"""
+    return simulate_batch(model, duration, samples, tau_leap, n_scenarios=n_scenarios, n_runs=n_runs,
+                          placeholders=placeholders, tau=tau, seed=seed)
+
+
+def simulate_batch(model, duration, samples, step, n_scenarios=1, n_runs=1, placeholders=None, tau=0.05, seed=None):
+    """Simulate all scenarios and runs of an emodl model with fixed steps of length tau
+
+    Parameters
+    ----------
+    model : EmodlModel
+    duration : float
+        Simulated time in days
+    samples : int
+        Number of monitoring samples over the duration
+    step : callable
+        step(rng, partition, compiled, a, x, tau) returning the state after a step from state x with propensities a,
+        i.e. tau_leap
+    n_scenarios : int
+        Number of scenarios in the batch
+    n_runs : int
+        Number of stochastic runs per scenario
+    placeholders : dict, optional
+        Values for @placeholders@ if the model is a template, arrays with one value per scenario
+        (i.e. columns of the sampled_parameters.csv) or scalars shared by all scenarios
+    tau : float
+        Step size in days
+    seed : int, optional
+        Seed of the random number generator
+
+    Returns
+    -------
+    sampletimes : np.ndarray
+        (n_samples,)
+    values : np.ndarray
+        Observed channels with shape (n_samples, n_channels, n_scenarios, n_runs)
+    """
+    rng = np.random.default_rng(seed)
+    shape = (n_scenarios, n_runs)
+    if placeholders is not None:
+        placeholders = {key: np.reshape(value, (-1, 1)) if np.ndim(value) else value
+                        for key, value in placeholders.items()}
+    sampletimes = get_sampletimes(duration, samples)
+    compiled = compile_model(model)
+    partition = ReactionPartition(compiled.stoichiometry)
+    env = model.initial_params(placeholders)
+    x = model.initial_state(env, shape)
+    values = np.zeros((len(sampletimes), len(model.observes)) + shape, dtype=np.float32)
+
+    step_funcs = model.required_funcs([event.trigger for event in model.state_events])
+    time_events = [(np.broadcast_to(event.trigger(env), (n_scenarios, 1)).astype(float), event)
+                   for event in model.time_events]
+    fired_time = [np.zeros((n_scenarios, 1), dtype=bool) for _ in time_events]
+    fired_state = [np.zeros(shape, dtype=bool) for _ in model.state_events]
+
+    def apply_time_events(t):
+        nonlocal x, p
+        for (times, event), fired in zip(time_events, fired_time):
+            mask = ~fired & (times <= t + 1e-9)
+            if mask.any():
+                x = apply_events_masked(model, [event], mask, env, x, t)
+                p = compiled.param_vector(env)
+                fired |= mask
+
+    def apply_state_events(t):
+        nonlocal x, p
+        if not model.state_events:
+            return
+        state = model.state_env(env, x, t, funcs=step_funcs)
+        for event, fired in zip(model.state_events, fired_state):
+            mask = ~fired & np.broadcast_to(np.asarray(event.trigger(state), dtype=bool), shape)
+            if mask.any():
+                x = apply_events_masked(model, [event], mask, env, x, t)
+                p = compiled.param_vector(env)
+                fired |= mask
+
+    n_steps = int(np.ceil(duration / tau - 1e-9))
+    i_sample = 0
+    t = 0.0
+    p = compiled.param_vector(env)
+    apply_time_events(t)
+    for i_step in range(n_steps + 1):
+        while i_sample < len(sampletimes) and sampletimes[i_sample] <= t + 1e-9:
+            values[i_sample] = compiled.observe(x, p, t)
+            i_sample += 1
+        if i_step == n_steps:
+            break
+        a = compiled.propensities(x, p, t)
+        x = step(rng, partition, compiled, a, x, tau)
+        t = (i_step + 1) * tau
+        apply_time_events(t)
+        apply_state_events(t)
+
+    return sampletimes, values
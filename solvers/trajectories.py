@@ -0,0 +1,139 @@
+"""
+Read solver cfg files and write trajectories in the csv layout of CMS,
+so that the native solvers are interchangeable with compartments.exe for combine_and_trim.py and the plotters.
+
+The local executor caps the number of trajectories written at the same time (runScenarios.py --max_writers, see local_executor.py):
+the processes of the scenarios share WRITE_SLOTS_ENV=<n>:<folder>, a file lock on one of n slot files in the folder
+is held while writing (not available on Windows, where the trajectories are written without waiting).
+"""
+import contextlib
+import json
+import os
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+WRITE_SLOTS_ENV = 'WRITE_SLOTS'
+
+
+def read_cfg(cfg_file):
+    with open(cfg_file) as fin:
+        return json.load(fin)
+
+
+def get_sampletimes(duration, samples):
+    """Equally spaced monitoring times starting at 0, as sampled by CMS"""
+    return np.arange(samples) * (duration / samples)
+
+
+def get_output_fname(cfg, workdir=None):
+    """Name of the trajectories csv file written for a rendered cfg
+
+    The output prefix in the cfg is relative to the working directory (-d) if given,
+    otherwise to the current directory, as for compartments.exe.
+    """
+    prefix = cfg.get('output', {}).get('prefix', 'trajectories')
+    fname = f'{prefix}.csv'
+    if workdir and not os.path.isabs(fname):
+        fname = os.path.join(workdir, fname)
+    return fname
+
+
+@contextlib.contextmanager
+def write_slot(slots=None, poll=0.1):
+    """Hold one of the write slots (<n>:<folder>, default from WRITE_SLOTS_ENV) until the block is done"""
+    slots = slots or os.environ.get(WRITE_SLOTS_ENV)
+    if not slots or fcntl is None:
+        yield
+        return
+    n_slots, slot_dir = slots.split(':', 1)
+    while True:
+        for i in range(int(n_slots)):
+            fout = open(os.path.join(slot_dir, f'slot{i}.lock'), 'a')
+            try:
+                fcntl.flock(fout, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                fout.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(fout, fcntl.LOCK_UN)
+                fout.close()
+            return
+        time.sleep(poll)
+
+
+def write_trajectories(fname, sampletimes, channels, values, header=None):
+    """Write trajectories in the CMS csv layout
+
+    Parameters
+    ----------
+    fname : str
+        Output file name
+    sampletimes : array-like
+        Monitoring times (n_samples,)
+    channels : list of str
+        Names of the observed channels (n_channels,)
+    values : np.ndarray
+        Observed values with shape (n_runs, n_samples, n_channels)
+    header : str, optional
+        First line of the file, skipped when the file is read by combine_and_trim.reprocess
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 2:
+        values = values[np.newaxis]
+    n_runs, n_samples, n_channels = values.shape
+    if n_samples != len(sampletimes) or n_channels != len(channels):
+        raise ValueError(f"Shape of values {values.shape} does not match {len(sampletimes)} sampletimes "
+                         f"and {len(channels)} channels")
+    if header is None:
+        header = f'{n_channels},{n_runs},{n_samples}'
+    out_dir = os.path.dirname(fname)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    # replace instead of overwriting, fname may be a link to the simulation cache (see result_cache.py)
+    tmp_fname = f'{fname}.tmp'
+    with write_slot(), open(tmp_fname, 'w') as fout:
+        fout.write(header + '\n')
+        fout.write('sampletimes,' + ','.join(f'{t:g}' for t in sampletimes) + '\n')
+        for c, channel in enumerate(channels):
+            for run in range(n_runs):
+                fout.write(f'{channel}{{{run}}},' + ','.join(f'{v:.6g}' for v in values[run, :, c]) + '\n')
+    os.replace(tmp_fname, fname)
+
+
+def read_trajectories(fname):
+    """Read a trajectories csv file in the CMS layout (see write_trajectories)
+
+    Returns
+    -------
+    sampletimes : np.ndarray
+        (n_samples,)
+    channels : list of str
+        Names of the observed channels without the run number
+    values : np.ndarray
+        Observed values with shape (n_runs, n_samples, n_channels)
+    """
+    with open(fname) as fin:
+        fin.readline()
+        sampletimes = np.array([float(v) for v in fin.readline().strip().split(',')[1:]])
+        rows = {}
+        for line in fin:
+            if not line.strip():
+                continue
+            name, *row = line.strip().split(',')
+            channel, run = name[:-1].split('{')
+            rows.setdefault(channel, {})[int(run)] = [float(v) for v in row]
+    channels = list(rows)
+    n_runs = max(len(runs) for runs in rows.values())
+    values = np.zeros((n_runs, len(sampletimes), len(channels)))
+    for c, channel in enumerate(channels):
+        for run, row in rows[channel].items():
+            values[run, :, c] = row
+    return sampletimes, channels, values
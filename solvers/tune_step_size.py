@@ -0,0 +1,247 @@
+"""
+Benchmark the step size of the leaping solvers and emit the cheapest cfg meeting an error tolerance.
+
+A rendered emodl (i.e. _temp/<exp_name>/simulations/simulation_1.emodl) is simulated with a cfg template
+for each step size of a grid ("Tau" of b-leaping, "epsilon" of tau-leaping, "Tau" of the native tau-batch and hybrid
+solvers) and with a reference run (a much smaller step, or any other cfg such as model_SSA.cfg).
+For each step the wall time and the divergence of the key channels from the reference are measured:
+the largest absolute difference of the mean over runs, relative to the peak of the reference channel.
+The cfg template with the fastest step size within the tolerance is written into cfg/ (i.e. cfg/model_B_tuned.cfg),
+keeping its @placeholders@, so that it can be used via runScenarios.py -cfg.
+
+python solvers/tune_step_size.py -e simulation_1.emodl -cfg model_B.cfg --tolerance 0.05 [--grid 0.0001 0.001 0.01]
+
+CMS solvers are run with compartments.exe (via wine or docker on Linux, see simulation_helpers.get_cms_cmd),
+native solvers with solvers/run_solver.py. Errors of stochastic solvers include Monte Carlo noise of the means,
+hence use enough runs for the noise to be well below the tolerance.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from solvers.run_solver import NATIVE_SOLVERS
+from solvers.trajectories import read_trajectories
+
+log = logging.getLogger(__name__)
+
+CFG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cfg')
+
+# cfg section and key of the step size per solver
+STEP_PARAMETERS = {
+    'B': ('b-leaping', 'Tau'),
+    'TAU': ('tau-leaping', 'epsilon'),
+    'TAU-BATCH': ('tau-batch', 'Tau'),
+    'HYBRID': ('hybrid', 'Tau'),
+}
+DEFAULT_GRIDS = {
+    'B': [0.0001, 0.0005, 0.001, 0.005, 0.01],
+    'TAU': [0.0005, 0.001, 0.005, 0.01, 0.03],
+    'TAU-BATCH': [0.01, 0.02, 0.05, 0.1, 0.2],
+    'HYBRID': [0.05, 0.1, 0.2, 0.5],
+}
+KEY_CHANNELS = ['hosp_det', 'crit_det', 'deaths']
+
+
+def render_cfg(cfg_text, duration, samples, runs, prng_seed=1, step=None):
+    """Cfg dictionary from a cfg template, with the step size of its solver replaced if given"""
+    for placeholder, value in [('duration', duration), ('monitoring_samples', samples),
+                               ('nruns', runs), ('prng_seed', prng_seed)]:
+        cfg_text = cfg_text.replace(f'@{placeholder}@', str(value))
+    cfg = json.loads(cfg_text)
+    if step is not None:
+        section, key = get_step_parameter(cfg['solver'])
+        cfg.setdefault(section, {})[key] = step
+    return cfg
+
+
+def get_step_parameter(solver):
+    if solver not in STEP_PARAMETERS:
+        raise ValueError(f"No step size to tune for solver {solver}, choose from {list(STEP_PARAMETERS)}")
+    return STEP_PARAMETERS[solver]
+
+
+def get_channel_index(channels, key_channels):
+    """Position of the key channels, named i.e. hosp_det (base, age) or hosp_det_All (locale)"""
+    index = {}
+    for key in key_channels:
+        for name in [key, f'{key}_All']:
+            if name in channels:
+                index[key] = channels.index(name)
+                break
+        else:
+            raise ValueError(f"Channel {key} (or {key}_All) not observed in the emodl, observed: {channels}")
+    return index
+
+
+def trajectory_error(values, reference, index):
+    """Largest absolute difference of the run means per key channel, relative to the peak of the reference
+
+    Parameters
+    ----------
+    values, reference : np.ndarray
+        (n_runs, n_samples, n_channels), the number of runs may differ
+    index : dict
+        Position of each key channel
+    """
+    errors = {}
+    for key, c in index.items():
+        mean = values[:, :, c].mean(axis=0)
+        ref = reference[:, :, c].mean(axis=0)
+        scale = np.abs(ref).max()
+        errors[key] = np.abs(mean - ref).max() / scale if scale > 0 else np.abs(mean).max()
+    return errors
+
+
+def run_cfg(cfg, emodl_file, workdir, name, exe_dir=None, docker_image=None):
+    """Run a cfg with CMS or a native solver in workdir, returns the wall time and the trajectories file"""
+    cfg = dict(cfg, output=dict(cfg.get('output', {}), prefix=name))
+    cfg_file = os.path.join(workdir, f'{name}.cfg')
+    with open(cfg_file, 'w') as fout:
+        json.dump(cfg, fout, indent=4)
+    if cfg['solver'] in NATIVE_SOLVERS:
+        cmd = f'"{sys.executable}" "{os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_solver.py")}"'
+    else:
+        from simulation_helpers import EXE_DIR, get_cms_cmd
+        cmd = get_cms_cmd(exe_dir or EXE_DIR, workdir, docker_image)
+        if sys.platform in ['win32', 'cygwin']:
+            cmd = f'"{cmd}"'
+    t0 = time.time()
+    subprocess.run(f'{cmd} -c "{cfg_file}" -m "{os.path.abspath(emodl_file)}"', shell=True, check=True, cwd=workdir)
+    return time.time() - t0, os.path.join(workdir, f'{name}.csv')
+
+
+def tune_step_size(emodl_file, cfg_template, tolerance, grid=None, reference_step=None, reference_cfg=None,
+                   duration=200, samples=200, runs=20, channels=KEY_CHANNELS, workdir='step_size_tuning',
+                   exe_dir=None, docker_image=None):
+    """Simulate an emodl for each step size of the grid and compare the key channels to a reference run
+
+    Parameters
+    ----------
+    emodl_file : str
+        Rendered emodl (without @placeholders@)
+    cfg_template : str
+        Cfg template file (i.e. cfg/model_B.cfg) of a solver in STEP_PARAMETERS
+    tolerance : float
+        Largest accepted relative error of any key channel
+    grid : list of float, optional
+        Step sizes to benchmark, DEFAULT_GRIDS of the solver if None
+    reference_step : float, optional
+        Step size of the reference run, a tenth of the smallest step of the grid if None
+    reference_cfg : str, optional
+        Cfg template of the reference run instead of the same solver at reference_step (i.e. cfg/model_SSA.cfg)
+
+    Returns
+    -------
+    results : pd.DataFrame
+        One row per step with the wall time in seconds, the error per key channel and whether it is within tolerance
+    """
+    with open(emodl_file) as fin:
+        remaining_placeholders = re.findall(r'@\w+@', fin.read())
+    if remaining_placeholders:
+        raise ValueError(f"Emodl {emodl_file} is a template, remaining placeholders: {remaining_placeholders[:5]}")
+    with open(cfg_template) as fin:
+        cfg_text = fin.read()
+    solver = render_cfg(cfg_text, duration, samples, runs)['solver']
+    get_step_parameter(solver)
+    grid = sorted(grid or DEFAULT_GRIDS[solver])
+    workdir = os.path.abspath(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    run_kwargs = dict(workdir=workdir, exe_dir=exe_dir, docker_image=docker_image)
+
+    if reference_cfg:
+        with open(reference_cfg) as fin:
+            cfg = render_cfg(fin.read(), duration, samples, runs)
+    else:
+        cfg = render_cfg(cfg_text, duration, samples, runs, step=reference_step or grid[0] / 10)
+    seconds, fname = run_cfg(cfg, emodl_file, name='reference', **run_kwargs)
+    log.info(f"Reference run finished in {seconds:.1f}s")
+    _, observed, reference = read_trajectories(fname)
+    index = get_channel_index(observed, channels)
+
+    results = []
+    for i, step in enumerate(grid):
+        cfg = render_cfg(cfg_text, duration, samples, runs, prng_seed=i + 2, step=step)
+        seconds, fname = run_cfg(cfg, emodl_file, name=f'step_{i}', **run_kwargs)
+        errors = trajectory_error(read_trajectories(fname)[2], reference, index)
+        log.info(f"{solver} step {step:g}: {seconds:.1f}s, errors " +
+                 ', '.join(f'{key} {error:.3f}' for key, error in errors.items()))
+        results.append(dict(step=step, seconds=seconds, **{f'error_{key}': e for key, e in errors.items()},
+                            error=max(errors.values())))
+    results = pd.DataFrame(results)
+    results['within_tolerance'] = results['error'] <= tolerance
+    results.to_csv(os.path.join(workdir, 'step_size_tuning.csv'), index=False)
+    return results
+
+
+def write_tuned_cfg(cfg_template, step, fname):
+    """Copy a cfg template with a new step size, keeping its formatting and @placeholders@"""
+    with open(cfg_template) as fin:
+        cfg_text = fin.read()
+    solver = re.search(r'"solver"\s*:\s*"(\w[\w-]*)"', cfg_text).group(1)
+    section, key = get_step_parameter(solver)
+    pattern = rf'("{section}"\s*:\s*{{[^}}]*?"{key}"\s*:\s*)[-+.\deE]+'
+    if not re.search(pattern, cfg_text):
+        raise ValueError(f"No {key} in section {section} of {cfg_template}")
+    cfg_text = re.sub(pattern, rf'\g<1>{step:g}', cfg_text)
+    with open(fname, 'w') as fout:
+        fout.write(cfg_text)
+    return fname
+
+
+def parse_args():
+    description = "Benchmark step sizes of a leaping solver and write the cheapest cfg within the error tolerance"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("-e", "--emodl", type=str, required=True,
+                        help="Rendered emodl to benchmark, i.e. _temp/<exp_name>/simulations/simulation_1.emodl")
+    parser.add_argument("-cfg", "--cfg_template", type=str, default="model_B.cfg",
+                        help=f"Cfg template in cfg/ to tune, solvers: {list(STEP_PARAMETERS)}")
+    parser.add_argument("--tolerance", type=float, default=0.05,
+                        help="Largest accepted error of the key channels, relative to the peak of the reference")
+    parser.add_argument("--grid", type=float, nargs='+', default=None,
+                        help="Step sizes (Tau or epsilon) to benchmark, default depends on the solver")
+    parser.add_argument("--reference_step", type=float, default=None,
+                        help="Step size of the reference run, default a tenth of the smallest step")
+    parser.add_argument("--reference_cfg", type=str, default=None,
+                        help="Cfg template in cfg/ for the reference run instead, i.e. model_SSA.cfg")
+    parser.add_argument("--channels", type=str, nargs='+', default=KEY_CHANNELS,
+                        help="Key channels compared to the reference")
+    parser.add_argument("--duration", type=float, default=200)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=20, help="Runs per step size, errors compare the run means")
+    parser.add_argument("--workdir", type=str, default=os.path.join('_temp', 'step_size_tuning'),
+                        help="Folder for the cfg and trajectories files of the benchmark runs")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Name of the tuned cfg written into cfg/, default <cfg_template>_tuned.cfg")
+    parser.add_argument("--docker_image", type=str, default=os.getenv("DOCKER_IMAGE"),
+                        help="Docker image to run CMS on Linux, wine is used if not provided")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="INFO")
+    args = parse_args()
+    cfg_template = os.path.join(CFG_DIR, args.cfg_template)
+    results = tune_step_size(args.emodl, cfg_template, args.tolerance, grid=args.grid,
+                             reference_step=args.reference_step,
+                             reference_cfg=os.path.join(CFG_DIR, args.reference_cfg) if args.reference_cfg else None,
+                             duration=args.duration, samples=args.samples, runs=args.runs, channels=args.channels,
+                             workdir=args.workdir, docker_image=args.docker_image)
+    print(results.to_string(index=False))
+    within = results[results['within_tolerance']]
+    if within.empty:
+        log.error(f"No step size within the tolerance of {args.tolerance}, no cfg written")
+        sys.exit(1)
+    best = within.sort_values('seconds').iloc[0]
+    output = args.output or args.cfg_template.replace('.cfg', '_tuned.cfg')
+    fname = write_tuned_cfg(cfg_template, best['step'], os.path.join(CFG_DIR, output))
+    log.info(f"Step size {best['step']:g} ({best['seconds']:.1f}s, error {best['error']:.3f}) written to {fname}, "
+             f"use with runScenarios.py -cfg {output}")
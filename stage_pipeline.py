@@ -0,0 +1,191 @@
+"""
+Resumable stages of an end-to-end experiment run (runScenarios.py -rl Local [--resume]).
+
+An experiment runs in stages: simulations, combine, cleanup, sample plot and the postprocessing steps. After a
+stage has succeeded, a completion marker stages/<stage>.json is written into the experiment folder with a hash of
+its command, its input files (relative to the experiment folder) and the hashes of the stages it depends on.
+With resume a stage is skipped if its marker holds the current hash, so a run restarts at the first failed or stale
+stage, stages depending on a stage that is run again are stale as well.
+Stages run as soon as the stages they depend on have succeeded, independent stages run concurrently. Stages
+depending on a failed stage are not run.
+
+The experiment folder moves from _temp/<exp_name> to simulation_output/<exp_name> during cleanup, the markers and
+inputs are looked up in each of the folders, the first folder that exists gets the markers.
+"""
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+STAGES_DIR = 'stages'
+MAX_WORKERS = 4
+# larger files are hashed by size and modification time instead of their content
+HASH_CONTENT_BYTES = 1024 ** 2
+
+
+class Stage:
+    """A step of an experiment run
+
+    Parameters
+    ----------
+    name : str
+        Name of the marker file
+    func : callable
+        Runs the stage, returns an exit code (0 or None for success)
+    inputs : list of str
+        Files or folders read by the stage, relative to the experiment folder
+    after : list of str
+        Names of the stages that have to succeed first
+    key : str
+        Included in the hash, i.e. the command of the stage
+    """
+
+    def __init__(self, name, func, inputs=(), after=(), key=''):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.after = list(after)
+        self.key = key
+
+
+def find_path(exp_dirs, rel_path):
+    for exp_dir in exp_dirs:
+        path = os.path.join(exp_dir, rel_path)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def file_hash(fname):
+    size = os.path.getsize(fname)
+    if size > HASH_CONTENT_BYTES:
+        return f'{size}:{os.stat(fname).st_mtime_ns}'
+    with open(fname, 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+def hash_stage(stage, exp_dirs, upstream_hashes=()):
+    """Hash of the command, the inputs and the upstream stages of a stage"""
+    sha = hashlib.sha1(stage.key.encode())
+    for upstream_hash in upstream_hashes:
+        sha.update(upstream_hash.encode())
+    for rel_path in stage.inputs:
+        sha.update(rel_path.encode())
+        path = find_path(exp_dirs, rel_path)
+        if path is None:
+            sha.update(b'\0missing')
+            continue
+        fnames = [path]
+        if os.path.isdir(path):
+            fnames = sorted(os.path.join(root, fname) for root, _, files in os.walk(path) for fname in files)
+        for fname in fnames:
+            sha.update(os.path.relpath(fname, path).encode())
+            sha.update(file_hash(fname).encode())
+    return sha.hexdigest()
+
+
+def read_marker(exp_dirs, name):
+    fname = find_path(exp_dirs, os.path.join(STAGES_DIR, f'{name}.json'))
+    if fname is None:
+        return None
+    with open(fname) as fin:
+        return json.load(fin)
+
+
+def remove_marker(exp_dirs, name):
+    for exp_dir in exp_dirs:
+        fname = os.path.join(exp_dir, STAGES_DIR, f'{name}.json')
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+def write_marker(exp_dirs, name, stage_hash, seconds):
+    exp_dir = next((exp_dir for exp_dir in exp_dirs if os.path.exists(exp_dir)), None)
+    if exp_dir is None:
+        log.warning(f"No experiment folder for the marker of stage {name}")
+        return
+    os.makedirs(os.path.join(exp_dir, STAGES_DIR), exist_ok=True)
+    fname = os.path.join(exp_dir, STAGES_DIR, f'{name}.json')
+    with open(f'{fname}.tmp', 'w') as fout:
+        json.dump({'stage': name, 'hash': stage_hash, 'completed': time.time(), 'seconds': seconds}, fout)
+    os.replace(f'{fname}.tmp', fname)
+
+
+def _run_stage(stage):
+    start = time.time()
+    try:
+        returncode = stage.func()
+    except Exception:
+        log.exception(f"Stage {stage.name} failed")
+        returncode = 1
+    return returncode or 0, time.time() - start
+
+
+def run_stages(stages, exp_dirs, resume=False, max_workers=MAX_WORKERS):
+    """Run the stages in order of their dependencies
+
+    Parameters
+    ----------
+    stages : list of Stage
+        Stages, each after the stages it depends on
+    exp_dirs : list of str
+        Locations of the experiment folder, see module docstring
+    resume : bool
+        Skip the stages with an up to date marker
+
+    Returns
+    -------
+    status : dict
+        'done', 'skipped', 'failed' or 'blocked' (after a failed stage) per stage name
+    """
+    names = []
+    for stage in stages:
+        unknown = [name for name in stage.after if name not in names]
+        if unknown:
+            raise ValueError(f"Stage {stage.name} depends on {unknown}, which are not listed before it")
+        names.append(stage.name)
+
+    status = {}
+    hashes = {}
+    pending = list(stages)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for stage in list(pending):
+                if any(status.get(name) in ('failed', 'blocked') for name in stage.after):
+                    log.warning(f"Stage {stage.name} not run, depends on a failed stage")
+                    status[stage.name] = 'blocked'
+                    pending.remove(stage)
+                    continue
+                if not all(status.get(name) in ('done', 'skipped') for name in stage.after):
+                    continue
+                pending.remove(stage)
+                hashes[stage.name] = hash_stage(stage, exp_dirs, [hashes[name] for name in stage.after])
+                upstream_run = any(status[name] == 'done' for name in stage.after)
+                marker = read_marker(exp_dirs, stage.name) if resume and not upstream_run else None
+                if marker is not None and marker['hash'] == hashes[stage.name]:
+                    log.info(f"Stage {stage.name} is up to date, skipped")
+                    status[stage.name] = 'skipped'
+                    continue
+                # a stage failing now is not up to date with the marker of a previous run
+                remove_marker(exp_dirs, stage.name)
+                log.info(f"Stage {stage.name} started")
+                running[executor.submit(_run_stage, stage)] = stage
+            if not running:
+                continue
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                returncode, seconds = future.result()
+                if returncode != 0:
+                    log.error(f"Stage {stage.name} failed with exit code {returncode}")
+                    status[stage.name] = 'failed'
+                    continue
+                write_marker(exp_dirs, stage.name, hashes[stage.name], seconds)
+                log.info(f"Stage {stage.name} done in {seconds:.0f}s")
+                status[stage.name] = 'done'
+    return status
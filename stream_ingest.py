@@ -0,0 +1,183 @@
+"""
+Ingest the trajectories of each scenario while the simulations are still running (runScenarios.py --stream_ingest).
+
+Each completed trajectories_scen<scen_num>.csv (see verify_scenarios.check_trajectories, and not modified for
+settle seconds) is converted into the long format of combine_and_trim.py, with its sample parameters, and written to
+<exp_dir>/ingest/scen<scen_num>.csv. A running summary of the ingested scenarios (runs, rows, time of ingest) is kept
+in ingest/summary.csv and Simulation_report.txt.
+The final step only concatenates the ingested scenarios into trajectoriesDat.csv (or trajectoriesDat_<stop>.csv
+chunks, as combine_and_trim.py), which combine_and_trim.py then trims instead of combining all scenarios.
+
+python stream_ingest.py -d _temp/<exp_name> --watch [--job_id <array job id>]
+python stream_ingest.py -d _temp/<exp_name> --finalize
+
+--watch ingests scenarios every interval seconds until all scenarios are ingested (and finalizes) or the array job
+has finished. --finalize ingests the remaining completed scenarios and writes the combined trajectories.
+"""
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+import pandas as pd
+
+from combine_and_trim import combine_scenario, get_combined_fnames, load_sampled_parameters
+from verify_scenarios import check_trajectories, get_scenario_settings
+
+log = logging.getLogger(__name__)
+
+INGEST_DIR = 'ingest'
+SETTLE_SECONDS = 30
+
+
+def ingest_scenario(exp_dir, scen_num, sampledf):
+    """Write the combined trajectories of a scenario to ingest/scen<scen_num>.csv, returns its summary"""
+    df = combine_scenario(sampledf, scen_num, os.path.join(exp_dir, 'trajectories')).dropna()
+    fname = os.path.join(exp_dir, INGEST_DIR, f'scen{scen_num}.csv')
+    df.to_csv(f'{fname}.tmp', index=False, date_format='%Y-%m-%d')
+    os.replace(f'{fname}.tmp', fname)
+    return {'scen_num': scen_num, 'n_runs': df['run_num'].nunique(), 'n_rows': len(df), 'ingested': time.time()}
+
+
+def ingested_scenarios(exp_dir):
+    return {int(fname[len('scen'):-len('.csv')]) for fname in os.listdir(os.path.join(exp_dir, INGEST_DIR))
+            if fname.startswith('scen') and fname.endswith('.csv')}
+
+
+def ingest_completed(exp_dir, settle=SETTLE_SECONDS, additional_sample_param=''):
+    """Ingest all completed scenarios that have not been ingested yet
+
+    Returns
+    -------
+    remaining : list
+        scen_nums not ingested yet
+    """
+    os.makedirs(os.path.join(exp_dir, INGEST_DIR), exist_ok=True)
+    sampledf, _, _ = load_sampled_parameters(exp_dir, additional_sample_param)
+    settings = get_scenario_settings(exp_dir).set_index('scen_num')
+    done = ingested_scenarios(exp_dir)
+    remaining = []
+    summaries = []
+    for scen_num in settings.index:
+        if scen_num in done:
+            continue
+        fname = os.path.join(exp_dir, 'trajectories', f'trajectories_scen{scen_num}.csv')
+        nruns = int(settings.loc[scen_num, 'nruns']) if 'nruns' in settings else None
+        # skip files still being written
+        if check_trajectories(fname, nruns) is not None or time.time() - os.path.getmtime(fname) < settle:
+            remaining.append(scen_num)
+            continue
+        summaries.append(ingest_scenario(exp_dir, scen_num, sampledf))
+    if summaries:
+        write_summary(exp_dir, summaries, n_total=len(settings))
+    return remaining
+
+
+def write_summary(exp_dir, summaries, n_total):
+    fname = os.path.join(exp_dir, INGEST_DIR, 'summary.csv')
+    pd.DataFrame(summaries).to_csv(fname, mode='a', header=not os.path.exists(fname), index=False)
+    n_ingested = len(pd.read_csv(fname))
+    with open(os.path.join(exp_dir, "Simulation_report.txt"), 'w') as fout:
+        fout.write(f'Number of scenarios ingested n= {n_ingested} out of total N= {n_total} '
+                   f'({n_ingested / n_total} %)')
+    log.info(f"Ingested {len(summaries)} scenarios, {n_ingested} of {n_total}")
+
+
+def concat_csv(fnames, out_fname):
+    """Concatenate csv files with the same columns, without parsing them"""
+    with open(f'{out_fname}.tmp', 'w') as fout:
+        for i, fname in enumerate(fnames):
+            with open(fname) as fin:
+                header = fin.readline()
+                if i == 0:
+                    fout.write(header)
+                shutil.copyfileobj(fin, fout)
+    os.replace(f'{out_fname}.tmp', out_fname)
+
+
+def finalize(exp_dir, scen_limit=700, additional_sample_param=''):
+    """Ingest the remaining completed scenarios and write the combined trajectories, as combine_and_trim.py"""
+    remaining = ingest_completed(exp_dir, settle=0, additional_sample_param=additional_sample_param)
+    if remaining:
+        log.warning(f"{len(remaining)} scenarios are incomplete and not combined")
+    done = ingested_scenarios(exp_dir)
+    n_scenario = max(get_scenario_settings(exp_dir)['scen_num'])
+    for fname, start, stop in get_combined_fnames(n_scenario, scen_limit):
+        scen_nums = [scen_num for scen_num in range(start, stop) if scen_num in done]
+        if scen_nums:
+            concat_csv([os.path.join(exp_dir, INGEST_DIR, f'scen{scen_num}.csv') for scen_num in scen_nums],
+                       os.path.join(exp_dir, fname))
+    log.info(f"Combined {len(done)} scenarios")
+
+
+def job_running(job_id):
+    result = subprocess.run(['squeue', '-h', '-j', str(job_id)], capture_output=True, text=True)
+    return result.returncode == 0 and result.stdout.strip() != ''
+
+
+def watch(exp_dir, job_id=None, interval=60, scen_limit=700):
+    """Ingest completed scenarios until all are ingested or the array job has finished"""
+    while True:
+        running = job_id is None or job_running(job_id)
+        remaining = ingest_completed(exp_dir, settle=SETTLE_SECONDS if running else 0)
+        if not remaining:
+            finalize(exp_dir, scen_limit=scen_limit)
+            return
+        if not running:
+            # incomplete scenarios are resubmitted by the postprocessing (verify_scenarios.py), which finalizes
+            log.info(f"Array job {job_id} finished with {len(remaining)} scenarios not ingested")
+            return
+        time.sleep(interval)
+
+
+def parse_args():
+    description = "Ingest the trajectories of an experiment while the simulations are running"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-d",
+        "--exp_dir",
+        type=str,
+        help="Experiment folder with trajectories/ and sampled_parameters.csv",
+        required=True
+    )
+    parser.add_argument(
+        "--watch",
+        action='store_true',
+        help="Ingest scenarios as they complete until all are ingested or the array job has finished",
+    )
+    parser.add_argument(
+        "--finalize",
+        action='store_true',
+        help="Ingest the remaining scenarios and write the combined trajectories",
+    )
+    parser.add_argument(
+        "--job_id",
+        type=str,
+        help="NUCLUSTER: id of the array job to watch",
+        default=None
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        help="Seconds between ingests",
+        default=60
+    )
+    parser.add_argument(
+        "-limit",
+        "--scen_limit",
+        type=int,
+        help="Number of scenarios per combined file, as combine_and_trim.py",
+        default=700
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="INFO")
+    args = parse_args()
+    if args.watch:
+        watch(args.exp_dir, job_id=args.job_id, interval=args.interval, scen_limit=args.scen_limit)
+    if args.finalize:
+        finalize(args.exp_dir, scen_limit=args.scen_limit)
@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+from local_executor import CMSWorkerPool, run_scenarios
+
+
+def python_cmd(code):
+    return f'"{sys.executable}" -c "{code}"'
+
+
+def test_run_scenarios_exit_codes_and_logs(tmp_path):
+    scenario_cmds = {1: python_cmd('print(1)'), 2: python_cmd('import sys; print(2); sys.exit(3)'),
+                     3: python_cmd('print(3)')}
+    returncodes = run_scenarios(scenario_cmds, log_dir=str(tmp_path / 'log'), n_workers=2)
+    assert returncodes == {1: 0, 2: 3, 3: 0}
+    assert (tmp_path / 'log' / 'scen2.txt').read_text().strip() == '2'
+    exit_codes = pd.read_csv(tmp_path / 'log' / 'exit_codes.csv')
+    assert list(exit_codes['exit_code']) == [0, 3, 0]
+
+
+def test_run_scenarios_concurrently(tmp_path):
+    scenario_cmds = {i: python_cmd('import time; time.sleep(0.5)') for i in range(1, 5)}
+    start = time.monotonic()
+    run_scenarios(scenario_cmds, log_dir=str(tmp_path), n_workers=4)
+    concurrent = time.monotonic() - start
+    start = time.monotonic()
+    run_scenarios(scenario_cmds, log_dir=str(tmp_path), n_workers=1)
+    assert concurrent < (time.monotonic() - start) / 2
+
+
+def test_cms_worker_pool_docker(monkeypatch):
+    calls = []
+
+    def run(cmd, **kwargs):
+        calls.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0, stdout='abc123\n')
+
+    monkeypatch.setattr(sys, 'platform', 'linux')
+    monkeypatch.setattr(subprocess, 'run', run)
+    with CMSWorkerPool('/exp', '/cms', docker_image='cms') as pool:
+        assert pool.cms_cmd == 'docker exec abc123 wine compartments.exe -d /exp'
+    assert calls[0][:4] == ['docker', 'run', '-d', '--rm']
+    assert calls[-1] == ['docker', 'stop', 'abc123']
+
+
+def test_run_scenarios_max_writers(tmp_path):
+    script = tmp_path / 'write.py'
+    script.write_text(f'import sys, time\nsys.path.insert(0, {os.getcwd()!r})\n'
+                      'from solvers.trajectories import write_slot\n'
+                      'with write_slot():\n'
+                      '    start = time.time()\n'
+                      '    time.sleep(0.3)\n'
+                      '    open(sys.argv[1], "a").write(f"{start},{time.time()}\\n")\n')
+    scenario_cmds = {i: f'"{sys.executable}" "{script}" "{tmp_path / "writes.csv"}"' for i in range(1, 4)}
+    assert run_scenarios(scenario_cmds, log_dir=str(tmp_path / 'log'), n_workers=3, max_writers=1) == {1: 0, 2: 0, 3: 0}
+    writes = pd.read_csv(tmp_path / 'writes.csv', names=['start', 'end']).sort_values('start')
+    # one write at a time
+    assert (writes['start'].iloc[1:].values >= writes['end'].iloc[:-1].values).all()
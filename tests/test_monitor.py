@@ -0,0 +1,54 @@
+import os
+import time
+
+import pandas as pd
+
+from monitor import format_progress, get_progress, get_scenario_states
+from render_scenarios import SETTINGS_FNAME
+from run_manifest import insert_run
+from work_queue import claim, connect, init_queue
+
+TRAJECTORIES = 'simulation_1.emodl,ODE\nsampletimes,0,1,2\nS{0},10,9,8\nI{0},0,1,2\nS{1},10,9,7\nI{1},0,1,3\n'
+
+
+def make_experiment(exp_dir, n_scenario=3):
+    (exp_dir / 'simulations').mkdir()
+    (exp_dir / 'trajectories').mkdir()
+    pd.DataFrame({'scen_num': range(1, n_scenario + 1)}).to_csv(exp_dir / 'sampled_parameters.csv', index=False)
+    pd.DataFrame({'scen_num': range(1, n_scenario + 1), 'nruns': 2}).to_csv(
+        exp_dir / 'simulations' / SETTINGS_FNAME, index=False)
+    for scen_num in [1, 2]:
+        (exp_dir / 'trajectories' / f'trajectories_scen{scen_num}.csv').write_text(TRAJECTORIES)
+    (exp_dir / 'trajectories' / 'trajectories_scen3.csv').write_text(TRAJECTORIES[:-11])
+
+
+def test_get_scenario_states(tmp_path):
+    make_experiment(tmp_path, n_scenario=4)
+    (tmp_path / 'trajectories' / 'trajectories_scen2.csv').unlink()
+    (tmp_path / 'log').mkdir()
+    insert_run(str(tmp_path), {'step': 'simulation', 'scen_num': 2, 'start': 0, 'end': 1, 'exit_code': 1})
+    states = get_scenario_states(str(tmp_path)).set_index('scen_num')['state']
+    assert states.to_dict() == {1: 'done', 2: 'failed', 3: 'running', 4: 'pending'}
+
+    init_queue(str(tmp_path), [4])
+    claim(connect(str(tmp_path)), 'worker')
+    assert get_scenario_states(str(tmp_path)).set_index('scen_num')['state'][4] == 'running'
+
+
+def test_get_progress(tmp_path):
+    make_experiment(tmp_path)
+    (tmp_path / 'trajectories' / 'trajectories_scen3.csv').unlink()
+    now = time.time()
+    os.utime(tmp_path / 'sampled_parameters.csv', (now - 7200, now - 7200))
+    os.utime(tmp_path / 'trajectories' / 'trajectories_scen1.csv', (now - 3600, now - 3600))
+    os.utime(tmp_path / 'trajectories' / 'trajectories_scen2.csv', (now - 10800, now - 10800))
+
+    # scenario 2 is linked from the cache
+    progress = get_progress(str(tmp_path), now=now)
+    assert progress['done'] == 2 and progress['pending'] == 1
+    assert progress['per_hour'] == 0.5 and progress['eta'] == 7200
+    assert format_progress(progress, now=now).startswith('2/3 scenarios done, 0 running, 0 failed, 1 pending, '
+                                                         '0.5 scenarios/h, ETA 2:00:00')
+
+    (tmp_path / 'trajectories' / 'trajectories_scen3.csv').write_text(TRAJECTORIES)
+    assert format_progress(get_progress(str(tmp_path))).startswith('3/3 scenarios done')
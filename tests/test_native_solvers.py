@@ -0,0 +1,331 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from solvers.checkpoint import (read_warm_start, stitch_history, take_checkpoint, warm_start_emodl,
+                               write_checkpoint)
+from solvers.compiler import compile_emodl, compile_model
+from solvers.emodl_parser import parse_emodl
+from solvers.hybrid import simulate_hybrid
+from solvers.next_generation import NextGenerationMatrix, compute_Rt, screen_parameter_samples
+from solvers.next_reaction import DependencyGraph, IndexedPriorityQueue, simulate_nrm
+from solvers.ode_solver import simulate_ode
+from solvers.run_batch import run_batch
+from solvers.tau_leaping import simulate_tau_batch
+from solvers.trajectories import read_trajectories, write_trajectories
+from solvers.tune_step_size import tune_step_size, write_tuned_cfg
+
+SIR_EMODL = """
+; test model
+(import (rnrs) (emodl cmslib))
+(start-model "sir.emodl")
+(species S @speciesS@)
+(species I 10)
+(species R)
+(param Ki @Ki@)
+(param Kr (/ 1 7))
+(func N (+ S I R))
+(observe susceptible S)
+(observe infected I)
+(observe population N)
+(reaction infection (S) (I) (/ (* Ki S I) N))
+(reaction recovery (I) (R) (* Kr I))
+(time-event lockdown 20 ((Ki (* Ki 0.5))))
+(end-model)
+"""
+
+
+@pytest.fixture
+def sir_model():
+    return parse_emodl(SIR_EMODL)
+
+
+def test_parse_emodl(sir_model):
+    assert sir_model.species_names == ['S', 'I', 'R']
+    assert sir_model.observe_names == ['susceptible', 'infected', 'population']
+    assert sir_model.placeholders == ['Ki', 'speciesS']
+    np.testing.assert_array_equal(sir_model.stoichiometry(), [[-1, 0], [1, -1], [0, 1]])
+
+
+def test_parse_emodl_unknown_name():
+    with pytest.raises(ValueError, match="undefined names"):
+        parse_emodl("(species S 10)\n(reaction death (S) () (* Kd S))")
+
+
+def test_expressions_vectorized(sir_model):
+    env = sir_model.initial_params({'Ki': np.array([0.2, 0.4]), 'speciesS': 990})
+    x = sir_model.initial_state(env)
+    state = sir_model.state_env(env, x, 0)
+    np.testing.assert_allclose(sir_model.propensities(state)[0], [0.2 * 990 * 10 / 1000, 0.4 * 990 * 10 / 1000])
+
+
+def test_compile_model(sir_model):
+    compiled = compile_model(sir_model)
+    assert compiled.param_names == ['Ki', 'Kr']
+    np.testing.assert_array_equal(compiled.stoichiometry.toarray(), sir_model.stoichiometry())
+
+    env = sir_model.initial_params({'Ki': np.array([[0.2], [0.4]]), 'speciesS': 990})
+    x = sir_model.initial_state(env, (2, 3))
+    x[1] += np.arange(3)
+    state = sir_model.state_env(env, x, 0)
+    a = compiled.propensities(x, compiled.param_vector(env), 0)
+    assert a.shape == (2, 2, 3)
+    for expected, actual in zip(sir_model.propensities(state), a):
+        np.testing.assert_allclose(np.broadcast_to(expected, (2, 3)), actual)
+    np.testing.assert_allclose(compiled.observe(x, compiled.param_vector(env), 0)[2], [1000 + np.arange(3)] * 2)
+    np.testing.assert_array_equal(compiled.apply_stoichiometry(np.ones((2, 2, 3)))[:, 0, 0], [-1, 0, 1])
+
+
+def test_compile_emodl_cache(tmp_path, monkeypatch):
+    from solvers import compiler
+    monkeypatch.setattr(compiler, '_memory_cache', {})
+    compiled = compile_emodl(SIR_EMODL, cache_dir=str(tmp_path))
+    assert compile_emodl(SIR_EMODL) is compiled
+    assert len(list(tmp_path.glob('*.pkl'))) == 1
+    # a new process loads the pickled kernels from the cache directory
+    compiler._memory_cache.clear()
+    cached = compile_emodl(SIR_EMODL, cache_dir=str(tmp_path))
+    assert cached is not compiled
+    assert cached.source == compiled.source
+    x = np.array([990., 10., 0.])
+    np.testing.assert_allclose(cached.propensities(x, [np.float64(0.3), np.float64(0.1)], 0), [2.97, 1.])
+
+
+def test_simulate_ode(sir_model):
+    sampletimes, values = simulate_ode(sir_model, duration=100, samples=100,
+                                       placeholders={'Ki': 0.3, 'speciesS': 990})
+    assert values.shape == (100, 3)
+    np.testing.assert_allclose(values[:, 2], 1000, rtol=1e-5)
+    assert values[0, 1] == 10
+    assert np.all(np.diff(values[:, 0]) <= 1e-6)
+
+
+def test_write_trajectories_cms_layout(tmp_path):
+    fname = str(tmp_path / 'trajectories_scen1.csv')
+    values = np.arange(12).reshape((2, 3, 2))
+    write_trajectories(fname, [0, 1, 2], ['susceptible', 'infected'], values)
+
+    row_df = pd.read_csv(fname, skiprows=1)
+    df = row_df.set_index('sampletimes').transpose()
+    assert list(df.columns) == ['susceptible{0}', 'susceptible{1}', 'infected{0}', 'infected{1}']
+    np.testing.assert_array_equal(df['infected{1}'], [7, 9, 11])
+
+
+def test_indexed_priority_queue():
+    rng = np.random.default_rng(1)
+    times = rng.uniform(size=20)
+    queue = IndexedPriorityQueue(times)
+    for i, t in zip(rng.integers(20, size=50), rng.uniform(size=50)):
+        times[i] = t
+        queue.update(i, t)
+        assert queue.min() == (np.argmin(times), times.min())
+    queue.update(queue.min()[0], np.inf)
+    assert queue.min()[1] == np.sort(times)[1]
+
+
+def test_dependency_graph(sir_model):
+    graph = DependencyGraph(sir_model)
+    assert graph.changes[1] == [('I', -1), ('R', 1)]
+    assert graph.funcs[1] == ['N']
+    # both rates depend on I, recovery does not depend on S
+    assert graph.reactions == [[0, 1], [0, 1]]
+
+
+def test_simulate_nrm(sir_model):
+    sampletimes, values = simulate_nrm(sir_model, duration=50, samples=50, n_runs=5,
+                                       placeholders={'Ki': 0., 'speciesS': 990}, seed=1)
+    assert values.shape == (5, 50, 3)
+    np.testing.assert_array_equal(values[:, :, 2], 1000)
+    np.testing.assert_array_equal(values[:, :, 0], 990)
+    # mean recovery time of 7 days
+    assert np.all(np.diff(values[:, :, 1], axis=1) <= 0)
+    assert 2 < values[:, 7, 1].mean() < 6
+
+
+def test_simulate_tau_batch(sir_model):
+    sampletimes, values = simulate_tau_batch(sir_model, duration=60, samples=60, n_scenarios=3, n_runs=4,
+                                             placeholders={'Ki': np.array([0., 0.3, 0.6]), 'speciesS': 990},
+                                             tau=0.1, seed=1)
+    assert values.shape == (60, 3, 3, 4)
+    np.testing.assert_array_equal(values[:, 2], 1000)
+    assert values.min() >= 0
+    # without transmission only recoveries happen
+    np.testing.assert_array_equal(values[:, 0, 0], 990)
+    assert np.all(values[-1, 0, 2] < values[-1, 0, 1])
+
+
+def test_simulate_tau_batch_time_event_per_scenario():
+    model = parse_emodl("(species S 100)\n(species R)\n(param Kr 0)\n(observe recovered R)\n"
+                        "(reaction recovery (S) (R) (* Kr S))\n(time-event start @start@ ((Kr 100)))")
+    sampletimes, values = simulate_tau_batch(model, duration=10, samples=10, n_scenarios=2, n_runs=2,
+                                             placeholders={'start': np.array([2, 5])}, tau=0.5, seed=1)
+    np.testing.assert_array_equal(values[1, 0, 0], 0)
+    np.testing.assert_array_equal(values[3, 0, 0], 100)
+    np.testing.assert_array_equal(values[4, 0, 1], 0)
+    np.testing.assert_array_equal(values[6, 0, 1], 100)
+
+
+def test_simulate_hybrid_extinction():
+    model = parse_emodl("(species S 1000000)\n(species I)\n(species R)\n(param Ki 0.3)\n(func N (+ S I R))\n"
+                        "(observe infected I)\n(observe recovered R)\n"
+                        "(reaction infection (S) (I) (/ (* Ki S I) N))\n(reaction recovery (I) (R) (* 0.15 I))\n"
+                        "(time-event time_infection_import 5 ((I 1) (S (- S 1))))")
+    sampletimes, values = simulate_hybrid(model, duration=150, samples=150, n_runs=400, tau=0.1, seed=1)
+    np.testing.assert_array_equal(values[:5], 0)
+    final_size = values[-1, 1, 0]
+    # extinction probability of a single introduction is 1 / R0 = 0.5
+    assert 0.4 < np.mean(final_size < 100) < 0.6
+    # extinct runs stay integer, large outbreaks are close to the deterministic final size
+    np.testing.assert_array_equal(final_size[final_size < 100], np.round(final_size[final_size < 100]))
+    assert 7.5e5 < final_size[final_size >= 100].mean() < 8.2e5
+
+
+def test_reproduction_number_sir(sir_model):
+    ngm = NextGenerationMatrix(sir_model, pattern='infection')
+    assert ngm.infected_names == ['I']
+    Rt = compute_Rt(sir_model, {'Ki': np.array([0.2, 0.3, 0.4]), 'speciesS': 990}, times=[25, 0], pattern='infection')
+    np.testing.assert_allclose(Rt[:, 1], np.array([0.2, 0.3, 0.4]) * 7, rtol=1e-5)
+    # the lockdown at day 20 halves Ki
+    np.testing.assert_allclose(Rt[:, 0], Rt[:, 1] / 2, rtol=1e-5)
+
+
+def test_reproduction_number_seir_events_per_row():
+    model = parse_emodl("(species S 1000)\n(species E)\n(species As)\n(species Sym)\n(species R)\n"
+                        "(param Ki @Ki@)\n(func N (+ S E As Sym R))\n(observe infected (+ E As Sym))\n"
+                        "(reaction exposure (S) (E) (/ (* Ki S (+ (* 0.5 As) Sym)) N))\n"
+                        "(reaction infection_asymp (E) (As) (* 0.25 E))\n(reaction infection_symp (E) (Sym) (* 0.25 E))\n"
+                        "(reaction recovery_As (As) (R) (* 0.2 As))\n(reaction recovery_Sym (Sym) (R) (* 0.1 Sym))\n"
+                        "(time-event reduce @t1@ ((Ki (* Ki 0.5))))\n(time-event reset @t2@ ((Ki @Ki@)))")
+    ngm = NextGenerationMatrix(model)
+    assert ngm.infected_names == ['E', 'As', 'Sym']
+    df = pd.DataFrame({'scen_num': [1, 2, 3], 'Ki': [0.1, 0.2, 0.4], 't1': [10, 30, 10], 't2': [20, 20, 40]})
+    df, keep = screen_parameter_samples(df, model, band=(0.5, 2), times=[0, 15, 35])
+    # half of the infections are asymptomatic, infectious for 5 days at half the rate, the others for 10 days
+    R0 = df['Ki'] * (0.5 * 0.5 * 5 + 0.5 * 10)
+    np.testing.assert_allclose(df['Rt_0'], R0, rtol=1e-5)
+    # events are applied per row in order of their time
+    np.testing.assert_allclose(df['Rt_15'], R0 * [0.5, 1, 0.5], rtol=1e-5)
+    np.testing.assert_allclose(df['Rt_35'], R0 * [1, 0.5, 0.5], rtol=1e-5)
+    assert list(keep) == [False, True, False]
+    with pytest.raises(ValueError, match="Missing placeholders"):
+        screen_parameter_samples(df.drop(columns='t2'), model, band=(0.5, 2))
+
+
+def test_run_batch(tmp_path, sir_model, monkeypatch):
+    from solvers import compiler
+    monkeypatch.setattr(compiler, '_memory_cache', {})
+    (tmp_path / 'simulations').mkdir()
+    (tmp_path / 'sir.emodl').write_text(SIR_EMODL)
+    pd.DataFrame({'scen_num': [1, 2, 3], 'Ki': [0.1, 0.2, 0.3], 'speciesS': 990}).to_csv(
+        tmp_path / 'sampled_parameters.csv', index=False)
+    for scen_num in [1, 2, 3]:
+        cfg = {'duration': 20, 'runs': 2, 'samples': 20, 'solver': 'TAU-BATCH', 'prng_seed': scen_num,
+               'tau-batch': {'Tau': 0.1, 'batch_size': 2}}
+        (tmp_path / 'simulations' / f'model_{scen_num}.cfg').write_text(json.dumps(cfg))
+
+    fnames = run_batch(str(tmp_path), task_id=2, n_tasks=2)
+    assert [f.split('_')[-1] for f in fnames] == ['scen3.csv']
+    # the other tasks load the template emodl compiled by the first one
+    assert len(list((tmp_path / 'compiled').glob('*.pkl'))) == 1
+    fnames = run_batch(str(tmp_path))
+    assert len(fnames) == 3
+    df = pd.read_csv(fnames[0], skiprows=1).set_index('sampletimes').transpose()
+    assert list(df.columns) == ['susceptible{0}', 'susceptible{1}', 'infected{0}', 'infected{1}',
+                                'population{0}', 'population{1}']
+
+
+def test_read_trajectories(tmp_path):
+    values = np.arange(12).reshape(2, 3, 2)
+    write_trajectories(str(tmp_path / 'trajectories.csv'), [0, 1, 2], ['infected', 'deaths'], values)
+    sampletimes, channels, actual = read_trajectories(str(tmp_path / 'trajectories.csv'))
+    np.testing.assert_array_equal(sampletimes, [0, 1, 2])
+    assert channels == ['infected', 'deaths']
+    np.testing.assert_array_equal(actual, values)
+
+
+def test_write_tuned_cfg(tmp_path):
+    fname = write_tuned_cfg('cfg/model_B.cfg', 0.0005, str(tmp_path / 'model_B_tuned.cfg'))
+    text = open(fname).read()
+    assert '"Tau"  : 0.0005' in text
+    assert '@prng_seed@' in text
+    assert text.replace('0.0005', '0.001') == open('cfg/model_B.cfg').read()
+
+
+def test_tune_step_size(tmp_path):
+    (tmp_path / 'template.emodl').write_text(SIR_EMODL)
+    with pytest.raises(ValueError, match="template"):
+        tune_step_size(str(tmp_path / 'template.emodl'), 'cfg/model_TauBatch.cfg', tolerance=0.1)
+    (tmp_path / 'sir.emodl').write_text(SIR_EMODL.replace('@speciesS@', '100000').replace('(species I 10)', '(species I 1000)').replace('@Ki@', '0.3'))
+    results = tune_step_size(str(tmp_path / 'sir.emodl'), 'cfg/model_TauBatch.cfg', tolerance=0.1, grid=[0.1, 2],
+                             duration=40, samples=40, runs=50, channels=['infected'], workdir=str(tmp_path / 'tuning'))
+    assert list(results['step']) == [0.1, 2]
+    assert list(results['within_tolerance']) == [True, False]
+    assert (tmp_path / 'tuning' / 'step_size_tuning.csv').exists()
+
+
+def test_checkpoint_warm_start(tmp_path):
+    template = SIR_EMODL.replace('(observe population N)', '(observe recovered R)\n(observe I_channel I)').replace(
+        '(end-model)', '(time-event reopen @reopen@ ((Ki (* Ki 1.5))))\n(end-model)')
+    df = pd.DataFrame({'scen_num': [1, 2], 'Ki': [0.3, 0.4], 'speciesS': 990, 'reopen': 40,
+                       'startdate': ['2020-02-20', '2020-02-25']})
+    trajectories = []
+    for _, row in df.iterrows():
+        model = parse_emodl(template)
+        sampletimes, values = simulate_ode(model, 60, 60, placeholders=row[['Ki', 'speciesS', 'reopen']].to_dict())
+        trajectories.append(pd.DataFrame(values, columns=model.observe_names).assign(
+            time=sampletimes, run_num=0, scen_num=row['scen_num']))
+    trajectories = pd.concat(trajectories)
+
+    checkpoint = take_checkpoint(trajectories, df, parse_emodl(template), '2020-03-21')
+    assert list(checkpoint['checkpoint_time']) == [30, 25]
+    np.testing.assert_allclose(checkpoint['I'], trajectories.set_index(['scen_num', 'time'])['infected'][[(1, 30), (2, 25)]])
+    checkpoint.to_csv(tmp_path / 'checkpoint.csv', index=False)
+
+    warm_start = read_warm_start(tmp_path / 'checkpoint.csv')
+    assert list(warm_start['scen_num']) == [1, 2]
+    assert list(warm_start['startdate']) == ['2020-03-21'] * 2
+    for _, row in warm_start.iterrows():
+        text = warm_start_emodl(template, row)
+        assert '(param Ki ' + repr(row['Ki'] * 0.5) + ')' in text
+        t0 = row['checkpoint_time']
+        sampletimes, values = simulate_ode(parse_emodl(text), 60 - t0, 60 - t0)
+        expected = trajectories[trajectories['scen_num'] == row['checkpoint_scen_num']]
+        np.testing.assert_allclose(values[:, 1], expected['infected'].to_numpy()[t0:], rtol=1e-3, atol=1e-3)
+
+    with pytest.raises(ValueError, match="not observed"):
+        take_checkpoint(trajectories, df, parse_emodl(SIR_EMODL), '2020-03-21')
+
+
+def test_two_phase_stitch_history(tmp_path):
+    template = SIR_EMODL.replace('(observe population N)', '(observe recovered R)\n(observe I_channel I)')
+    history_dir, forecast_dir = tmp_path / 'phase_one', tmp_path / 'forecast'
+    history_dir.mkdir()
+    (history_dir / 'sir.emodl').write_text(template)
+    df = pd.DataFrame({'scen_num': [1, 2], 'Ki': [0.3, 0.4], 'speciesS': 990, 'startdate': '2020-02-20'})
+    df.to_csv(history_dir / 'sampled_parameters.csv', index=False)
+    for _, row in df.iterrows():
+        model = parse_emodl(template)
+        sampletimes, values = simulate_ode(model, 30, 30, placeholders=row[['Ki', 'speciesS']].to_dict())
+        write_trajectories(history_dir / 'trajectories' / f"trajectories_scen{row['scen_num']}.csv",
+                           sampletimes, model.observe_names, values)
+
+    # prune to the trajectory of the second scenario
+    fname = write_checkpoint(str(history_dir), '2020-03-11', traces=pd.DataFrame({'scen_num': [2], 'run_num': [0]}))
+    warm_start = read_warm_start(fname)
+    assert list(warm_start['checkpoint_scen_num']) == [2]
+    (forecast_dir / 'trajectories').mkdir(parents=True)
+    warm_start.to_csv(forecast_dir / 'sampled_parameters.csv', index=False)
+    row = warm_start.iloc[0]
+    model = parse_emodl(warm_start_emodl(template, row))
+    sampletimes, values = simulate_ode(model, 10, 10)
+    write_trajectories(forecast_dir / 'trajectories' / 'trajectories_scen1.csv', sampletimes, model.observe_names,
+                       np.stack([values, values]))
+
+    stitch_history(str(forecast_dir), str(history_dir))
+    sampletimes, channels, stitched = read_trajectories(forecast_dir / 'trajectories' / 'trajectories_scen1.csv')
+    np.testing.assert_allclose(sampletimes, np.arange(30))
+    _, _, history = read_trajectories(history_dir / 'trajectories' / 'trajectories_scen2.csv')
+    np.testing.assert_allclose(stitched, np.broadcast_to(history[0], stitched.shape), rtol=1e-3)
+    assert list(pd.read_csv(forecast_dir / 'sampled_parameters.csv')['startdate']) == ['2020-02-20']
@@ -0,0 +1,35 @@
+import pandas as pd
+
+from render_scenarios import SETTINGS_FNAME, render_cfg, render_scenario
+
+EMODL = """(species S @speciesS@)
+(param Ki @Ki@)
+(param time_to_infectious @time_to_infectious@)
+"""
+
+CFG = """{"duration" : @duration@, "runs" : @nruns@, "samples" : @monitoring_samples@, "prng_seed" : @prng_seed@,
+"output" : {"prefix" : "trajectories", "headers" : true}}"""
+
+
+def test_render_cfg():
+    cfg = render_cfg(CFG, 100, 50, 3, 'trajectories_scen2', prng_seed=42)
+    assert '"duration" : 100' in cfg and '"runs" : 3' in cfg and '"samples" : 50' in cfg
+    assert '"prng_seed" : 42' in cfg and '"prefix" : "trajectories_scen2"' in cfg
+
+
+def test_render_scenario(tmp_path):
+    (tmp_path / 'simulations').mkdir()
+    (tmp_path / 'template.emodl').write_text(EMODL)
+    (tmp_path / 'model_B.cfg').write_text(CFG)
+    pd.DataFrame({'scen_num': [1, 2], 'speciesS': [1000, 2000], 'Ki': [0.1, 0.2],
+                  'time_to_infectious': [3.771874163214711, 2.51505682734978]}).to_csv(
+        tmp_path / 'sampled_parameters.csv', index=False)
+    pd.DataFrame({'scen_num': [1, 2], 'emodl_template': 'template.emodl', 'cfg_template': 'model_B.cfg',
+                  'duration': 100, 'monitoring_samples': 100, 'nruns': 2, 'prng_seed': [11, 12],
+                  'trajectories': ['trajectories_scen1', 'trajectories_scen2']}).to_csv(
+        tmp_path / 'simulations' / SETTINGS_FNAME, index=False)
+
+    cfg_fname, emodl_fname = render_scenario(str(tmp_path), 2, str(tmp_path / 'node'))
+    assert open(emodl_fname).read() == "(species S 2000)\n(param Ki 0.2)\n(param time_to_infectious 2.51505682734978)\n"
+    assert '"prng_seed" : 12' in open(cfg_fname).read()
+    assert cfg_fname.endswith('model_2.cfg')
@@ -0,0 +1,48 @@
+from resource_sizing import (estimate_output_mb, format_time, max_concurrent_tasks, predict_resources, size_experiment,
+                             size_output)
+from run_manifest import connect, write_experiment
+
+SETTINGS = {'model': 'locale', 'observe_level': 'primary', 'duration': 560, 'cfg_template': 'model_B.cfg'}
+
+
+def write_manifest(exp_dir, walltimes, max_rss_mb, **settings):
+    exp_dir.mkdir()
+    write_experiment(str(exp_dir), nruns=3, **settings)
+    with connect(str(exp_dir)) as con:
+        con.executemany("INSERT INTO runs (step, job_id, start, end, exit_code, max_rss_mb, trajectory_bytes) "
+                        "VALUES (?, '1', ?, ?, 0, ?, ?)",
+                        [('simulation', 0, walltime, rss, 1024 ** 2) for walltime, rss in zip(walltimes, max_rss_mb)] +
+                        [('combine_and_trim.py', 100, 700, 20000, None), ('trace_selection.py', 700, 1300, 30000, None)])
+
+
+def test_format_time():
+    assert format_time(59) == '00:01:00'
+    assert format_time(3601) == '01:01:00'
+
+
+def test_predict_resources():
+    assert predict_resources([3600] * 4, [1024] * 4) is None
+    assert predict_resources([3600] * 5, [4096] * 5) == {'t': '01:30:00', 'memG': 6}
+
+
+def test_size_experiment(tmp_path):
+    write_manifest(tmp_path / 'exp1', [1200, 1800, 2400], [2048, 3000, 4096], **SETTINGS)
+    write_manifest(tmp_path / 'exp2', [1200, 1200, 1200], [2048, 2048, 2048], **SETTINGS)
+    write_manifest(tmp_path / 'exp3', [36000] * 5, [60000] * 5, **{**SETTINGS, 'observe_level': 'all'})
+
+    sim_resources, post_resources = size_experiment(str(tmp_path), **SETTINGS)
+    assert sim_resources['t'] == '00:57:00' and sim_resources['memG'] == 6
+    assert post_resources == {'t': '00:30:00', 'memG': 44}
+    assert size_experiment(str(tmp_path), **{**SETTINGS, 'duration': 300}) == (None, None)
+
+
+def test_size_output(tmp_path):
+    write_manifest(tmp_path / 'exp1', [1200] * 5, [2048] * 5, **SETTINGS)
+    assert size_output(str(tmp_path), **SETTINGS) == 1
+    assert size_output(str(tmp_path), **{**SETTINGS, 'duration': 300}) is None
+    assert max_concurrent_tasks(40, io_budget=200) == 300
+    assert max_concurrent_tasks(20000, io_budget=200) == 1
+
+    emodl = tmp_path / 'model.emodl'
+    emodl.write_text('(observe susceptible S)\n(observe infected I)\n')
+    assert estimate_output_mb(str(emodl), nruns=3, monitoring_samples=1023) * 1024 ** 2 == 2 * 3 * 1024 * 10
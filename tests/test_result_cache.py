@@ -0,0 +1,58 @@
+import os
+
+import pandas as pd
+
+from render_scenarios import SETTINGS_FNAME
+from result_cache import ResultCache, link_cached_scenarios, scenario_key, store_scenarios
+
+EMODL = "(species S 1000)\n(param Ki 0.1)\n"
+
+CFG = """{"duration" : @duration@, "runs" : @nruns@, "samples" : @monitoring_samples@, "prng_seed" : @prng_seed@,
+"output" : {"prefix" : "trajectories", "headers" : true}}"""
+
+
+def test_scenario_key():
+    key = scenario_key(EMODL, CFG, 100, 100, 2, prng_seed=11)
+    assert key == scenario_key(EMODL, CFG, 100, 100, 2, prng_seed=11)
+    assert key != scenario_key(EMODL, CFG, 100, 100, 2, prng_seed=12)
+    assert key != scenario_key(EMODL.replace('0.1', '0.2'), CFG, 100, 100, 2, prng_seed=11)
+
+
+def test_get_put(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    fname = tmp_path / 'trajectories_scen1.csv'
+    fname.write_text('time,S\n0,1000\n')
+    assert not cache.get('abc', str(tmp_path / 'linked.csv'))
+
+    cache.put('abc', str(fname))
+    assert cache.get('abc', str(tmp_path / 'linked.csv'))
+    assert (tmp_path / 'linked.csv').read_text() == 'time,S\n0,1000\n'
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_size_gb=25 / 1024 ** 3)
+    fname = tmp_path / 'trajectories.csv'
+    fname.write_text('x' * 10)
+    cache.put('old', str(fname))
+    cache.put('new', str(fname))
+    os.utime(cache.path('old'), (0, 0))
+    cache.put('newest', str(fname))
+    assert not os.path.exists(cache.path('old'))
+    assert os.path.exists(cache.path('new')) and os.path.exists(cache.path('newest'))
+
+
+def test_link_and_store_scenarios(tmp_path):
+    (tmp_path / 'simulations').mkdir()
+    (tmp_path / 'trajectories').mkdir()
+    pd.DataFrame({'scen_num': [1, 2], 'cache_key': ['key1', 'key2']}).to_csv(
+        tmp_path / 'simulations' / SETTINGS_FNAME, index=False)
+    cache = ResultCache(str(tmp_path / 'cache'))
+    trajectories_dir = str(tmp_path / 'trajectories')
+
+    assert link_cached_scenarios(str(tmp_path), trajectories_dir, cache) == []
+    (tmp_path / 'trajectories' / 'trajectories_scen2.csv').write_text('scen2')
+    store_scenarios(str(tmp_path), trajectories_dir, cache)
+    os.remove(tmp_path / 'trajectories' / 'trajectories_scen2.csv')
+
+    assert link_cached_scenarios(str(tmp_path), trajectories_dir, cache) == [2]
+    assert (tmp_path / 'trajectories' / 'trajectories_scen2.csv').read_text() == 'scen2'
@@ -6,7 +6,8 @@ import yamlordereddictloader
 import pandas as pd
 import pytest
 
-from runScenarios import add_config_parameter_column
+from runScenarios import add_config_parameter_column, select_scenario_cmds
+from simulation_helpers import get_scenario_cmds
 import runScenarios as rs
 
 yaml_load = partial(yaml.load, Loader=yamlordereddictloader.Loader)
@@ -175,3 +176,15 @@ def test_add_sampled_parameters_expand_age_error():
     df_in = pd.DataFrame({'sample_num': [1, 2]})
     with pytest.raises(ValueError, match="function_kwargs for myparam have 2 entries"):
         rs.add_parameters(df_in, "sampled_parameters", yaml_load(config), None, ['0', '42', '113'])
+
+
+def test_select_scenario_cmds(tmp_path):
+    (tmp_path / 'model_TauBatch.cfg').write_text('{"solver" : "TAU-BATCH"}')
+    (tmp_path / 'model_ODE.cfg').write_text('{"solver" : "ODE"}')
+    # the batch solver has no commands per scenario
+    batch_cmds = get_scenario_cmds(3, str(tmp_path), str(tmp_path), 'model_TauBatch.cfg', git_dir='/git')
+    assert select_scenario_cmds(batch_cmds, cached=[]) is None
+    assert select_scenario_cmds(batch_cmds, cached=[], incomplete={2: 'missing'}) is None
+    scenario_cmds = get_scenario_cmds(3, str(tmp_path), str(tmp_path), 'model_ODE.cfg', git_dir='/git')
+    assert list(select_scenario_cmds(scenario_cmds, cached=[2])) == [1, 3]
+    assert list(select_scenario_cmds(scenario_cmds, cached=[2], incomplete={2: 'missing', 3: 'truncated'})) == [3]
@@ -0,0 +1,54 @@
+import os
+import sqlite3
+import sys
+
+from run_manifest import MANIFEST_FNAME, connect, record, report_failures, report_stragglers, report_throughput
+from simulation_helpers import record_steps
+
+
+def test_record(tmp_path):
+    (tmp_path / 'trajectories').mkdir()
+    (tmp_path / 'trajectories' / 'trajectories_scen2.csv').write_text('time,S\n')
+
+    assert record(str(tmp_path), [sys.executable, '-c', 'pass'], scen_num=2) == 0
+    assert record(str(tmp_path), [sys.executable, '-c', 'import sys; sys.exit(3)'], step='trace_selection.py') == 3
+    assert record(str(tmp_path), [str(tmp_path / 'missing.bat')], step='missing.bat') == 127
+
+    rows = sqlite3.connect(tmp_path / MANIFEST_FNAME).execute(
+        'SELECT step, scen_num, exit_code, trajectory_bytes, end >= start FROM runs').fetchall()
+    assert rows == [('simulation', 2, 0, 7, 1), ('trace_selection.py', None, 3, None, 1),
+                    ('missing.bat', None, 127, None, 1)]
+
+
+def test_record_exit_status(tmp_path, monkeypatch):
+    # as on Python 3.7 of the NUCLUSTER environment
+    monkeypatch.delattr(os, 'waitstatus_to_exitcode', raising=False)
+    assert record(str(tmp_path), [sys.executable, '-c', 'import sys; sys.exit(3)']) == 3
+    assert record(str(tmp_path), [sys.executable, '-c', 'import os, signal; os.kill(os.getpid(), signal.SIGKILL)']) == -9
+
+
+def test_reports(tmp_path, capsys):
+    with connect(str(tmp_path)) as con:
+        con.executemany("INSERT INTO runs (step, scen_num, host, start, end, exit_code, trajectory_bytes) "
+                        "VALUES ('simulation', ?, ?, 0, ?, ?, 1048576)",
+                        [(1, 'qnode1', 10, 0), (2, 'qnode1', 12, 0), (3, 'qnode2', 11, 1), (4, 'qnode2', 60, 0)])
+    report_stragglers(con)
+    report_failures(con)
+    report_throughput(con)
+    out = capsys.readouterr().out
+    assert 'scen 4 on qnode2: 60s (5.2x)' in out and 'scen 2' not in out
+    assert 'simulation on qnode2: 1 of 2 failed' in out
+    assert '4 scenarios (4 total), 4 MB' in out
+
+
+def test_record_steps(tmp_path):
+    fname = tmp_path / 'run_postprocessing.sh'
+    fname.write_text('cd /git\npython combine_and_trim.py --exp_name "exp"\n\n'
+                     'cd /git/nucluster \npython /git/nucluster/cleanup.py --stem "exp"\n'
+                     'python /git/plotters/trace_selection.py --stem "exp"')
+    record_steps(str(fname), '/git', '/git/_temp/exp', '/out/exp')
+    lines = fname.read_text().split('\n')
+    assert lines[1] == 'python "/git/run_manifest.py" -d "/git/_temp/exp" --step combine_and_trim.py -- ' \
+                       'python combine_and_trim.py --exp_name "exp"'
+    assert lines[4].startswith('python "/git/run_manifest.py" -d "/out/exp" --step cleanup.py -- python')
+    assert lines[5].startswith('python "/git/run_manifest.py" -d "/out/exp" --step trace_selection.py -- python')
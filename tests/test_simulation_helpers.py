@@ -0,0 +1,138 @@
+import errno
+import os
+import subprocess
+
+import pytest
+
+from processing_helpers import select_region
+import simulation_helpers
+from simulation_helpers import (array_ranges, cleanup, generateSubmissionFile_quest, move_tree, pack_scenarios,
+                                scale_time, shell_header, stage_on_node)
+
+
+def test_array_ranges():
+    assert array_ranges([1, 2, 3, 5, 8, 9]) == '1-3,5,8-9'
+    assert array_ranges([]) == ''
+
+
+def test_scale_time():
+    assert scale_time('02:00:00', 3) == '06:00:00'
+    assert scale_time('00:45:00', 1.5) == '01:07:30'
+
+
+def test_shell_header_packed_tasks():
+    header = shell_header(job_name='test', arrayJob='#SBATCH --array=1-3\n', n_sequential=3)
+    if 'b1139' not in os.getcwd():
+        assert '#SBATCH -t 06:00:00\n' in header
+        assert '#SBATCH -p normal\n' in header
+        # 1000 scenarios on 10 workers
+        assert '#SBATCH -t 48:00:00\n' in shell_header(job_name='test', n_sequential=100)
+
+
+@pytest.mark.parametrize('task_cores', [1, 4])
+def test_pack_scenarios(tmp_path, task_cores):
+    script = tmp_path / 'run.sh'
+    script.write_text(pack_scenarios('echo ${i}', scen_num=25, scenarios_per_task=10, task_cores=task_cores))
+    scenarios = []
+    for task_id in range(1, 4):
+        out = subprocess.run(['bash', str(script)], env={**os.environ, 'SLURM_ARRAY_TASK_ID': str(task_id)},
+                             capture_output=True, text=True, check=True).stdout
+        scenarios += sorted(int(i) for i in out.split())
+    assert scenarios == list(range(1, 26))
+
+
+def test_select_region():
+    grp_list, grp_numbers = ['EMS-1', 'EMS-2', 'All'], [1, 2, 0]
+    assert select_region(grp_list, grp_numbers) == (grp_list, grp_numbers)
+    assert select_region(grp_list, grp_numbers, 0) == (['All'], [0])
+    assert select_region(grp_list, grp_numbers, 3) == ([], [])
+
+
+def test_shard_regions(tmp_path):
+    for folder in ['sh', 'trajectories']:
+        (tmp_path / folder).mkdir()
+    (tmp_path / 'simulation.emodl').write_text('')
+    generateSubmissionFile_quest(3, 'exp', 'spatial_EMS_experiment.yaml', str(tmp_path / 'trajectories'), '/git',
+                                 str(tmp_path), '/exe', '/out/exp', 'locale', shard_regions=[0, 1, 2, 3])
+
+    civis = (tmp_path / 'run_postprocessing_for_civis.sh').read_text()
+    assert 'sbatch --parsable --chdir=/out/exp --dependency=afterok:$SLURM_JOB_ID run_postprocessing_regions.sh' in civis
+    assert 'trace_selection.py' not in civis and 'cleanup.py' in civis
+    regions = (tmp_path / 'run_postprocessing_regions.sh').read_text()
+    assert '#SBATCH --array=0-3\n' in regions
+    assert 'data_comparison_spatial.py --stem "exp" --Location "NUCLUSTER" --region ${SLURM_ARRAY_TASK_ID}' in regions
+    reduce = (tmp_path / 'run_postprocessing_reduce.sh').read_text()
+    assert 'process_for_civis_EMSgrp.py --stem "exp" --Location "NUCLUSTER" --processStep combine_outputs' in reduce
+
+
+@pytest.mark.parametrize('scratch', [True, False])
+def test_stage_on_node(tmp_path, scratch):
+    for folder in ['simulations', 'trajectories', 'scratch', 'sh']:
+        (tmp_path / folder).mkdir()
+    (tmp_path / 'simulation.emodl').write_text('')
+    (tmp_path / 'simulations' / 'model_1.cfg').write_text('cfg')
+    (tmp_path / 'simulations' / 'simulation_1.emodl').write_text('emodl')
+    sim_dir = str(tmp_path / 'simulations')
+    # a simulation writing its trajectories into the working directory
+    cmd = stage_on_node(f'cat {sim_dir}/model_1.cfg {sim_dir}/simulation_1.emodl > trajectories_scen1.csv && pwd',
+                        sim_dir, '$TMPDIR/exp_scen1', str(tmp_path / 'trajectories'), 1)
+    env = {**os.environ, 'TMPDIR': str(tmp_path / 'scratch') if scratch else ''}
+    result = subprocess.run(['bash', '-c', cmd], cwd=tmp_path / 'trajectories', env=env, capture_output=True, text=True)
+    assert result.returncode == 0
+    assert result.stdout.split('\n')[-2] == str(tmp_path / ('scratch/exp_scen1' if scratch else 'trajectories'))
+    assert os.listdir(tmp_path / 'trajectories') == ['trajectories_scen1.csv']
+    assert (tmp_path / 'trajectories' / 'trajectories_scen1.csv').read_text() == 'cfgemodl'
+    assert os.listdir(tmp_path / 'scratch') == []
+
+    generateSubmissionFile_quest(3, 'exp', 'spatial_EMS_experiment.yaml', str(tmp_path / 'trajectories'), '/git',
+                                 str(tmp_path), '/exe', '/out/exp', 'locale', stage_scratch=True)
+    script = (tmp_path / 'trajectories' / 'runSimulations.sh').read_text()
+    assert '-B ${TMPDIR:-/tmp} ' in script and '-c $scratch/model_${SLURM_ARRAY_TASK_ID}.cfg' in script
+
+
+def test_max_concurrent(tmp_path):
+    for folder in ['sh', 'trajectories']:
+        (tmp_path / folder).mkdir()
+    (tmp_path / 'simulation.emodl').write_text('')
+    generateSubmissionFile_quest(5, 'exp', 'spatial_EMS_experiment.yaml', str(tmp_path / 'trajectories'), '/git',
+                                 str(tmp_path), '/exe', '/out/exp', 'locale', cached_scenarios=[3], max_concurrent=2)
+    assert '#SBATCH --array=1-2,4-5%2\n' in (tmp_path / 'trajectories' / 'runSimulations.sh').read_text()
+
+
+def make_exp_dir(exp_dir, scen_nums):
+    (exp_dir / 'trajectories').mkdir(parents=True)
+    for scen_num in scen_nums:
+        (exp_dir / 'trajectories' / f'trajectories_scen{scen_num}.csv').write_text(f'scen{scen_num}')
+
+
+def test_cleanup(tmp_path):
+    make_exp_dir(tmp_path / '_temp' / 'exp', [1, 2])
+    inode = os.stat(tmp_path / '_temp' / 'exp' / 'trajectories' / 'trajectories_scen1.csv').st_ino
+    cleanup(str(tmp_path / '_temp'), str(tmp_path / '_temp' / 'exp'), str(tmp_path / 'out' / 'exp'),
+            str(tmp_path / 'out' / 'exp' / '_plots'), delete_temp_dir=False)
+    assert not (tmp_path / '_temp' / 'exp').exists() and (tmp_path / 'out' / 'exp' / '_plots').exists()
+    # renamed, not copied
+    assert os.stat(tmp_path / 'out' / 'exp' / 'trajectories' / 'trajectories_scen1.csv').st_ino == inode
+
+    make_exp_dir(tmp_path / '_temp' / 'exp', [2, 3])
+    cleanup(str(tmp_path / '_temp'), str(tmp_path / '_temp' / 'exp'), str(tmp_path / 'out' / 'exp'),
+            str(tmp_path / 'out' / 'exp' / '_plots'), delete_temp_dir=False, overwrite=True)
+    assert sorted(os.listdir(tmp_path / 'out' / 'exp' / 'trajectories')) == [
+        f'trajectories_scen{scen_num}.csv' for scen_num in [1, 2, 3]]
+    assert not (tmp_path / '_temp' / 'exp').exists()
+
+
+def test_move_tree_other_filesystem(tmp_path, monkeypatch):
+    def rename(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(simulation_helpers.os, 'rename', rename)
+    make_exp_dir(tmp_path / 'src', range(20))
+    move_tree(str(tmp_path / 'src'), str(tmp_path / 'dst'))
+    assert not (tmp_path / 'src').exists()
+    assert (tmp_path / 'dst' / 'trajectories' / 'trajectories_scen19.csv').read_text() == 'scen19'
+
+    make_exp_dir(tmp_path / 'src', [1])
+    monkeypatch.setattr(simulation_helpers, 'file_checksum', lambda fname: fname)
+    with pytest.raises(OSError, match='Checksum'):
+        move_tree(str(tmp_path / 'src'), str(tmp_path / 'dst2'))
+    assert (tmp_path / 'src' / 'trajectories' / 'trajectories_scen1.csv').exists()
@@ -0,0 +1,46 @@
+import os
+
+from runScenarios import get_postprocessing_stages
+from stage_pipeline import STAGES_DIR, Stage, run_stages
+
+
+def make_stages(calls, fail=()):
+    def step(name):
+        calls.append(name)
+        return 1 if name in fail else 0
+    return [Stage('simulations', lambda: step('simulations'), inputs=['sampled_parameters.csv']),
+            Stage('combine', lambda: step('combine'), after=['simulations']),
+            Stage('rt', lambda: step('rt'), after=['combine']),
+            Stage('overflow', lambda: step('overflow'), after=['combine']),
+            Stage('copy', lambda: step('copy'), after=['rt', 'overflow'])]
+
+
+def test_run_stages(tmp_path):
+    exp_dirs = [str(tmp_path / 'simulation_output'), str(tmp_path)]
+    (tmp_path / 'sampled_parameters.csv').write_text('scen_num\n1\n')
+
+    calls = []
+    status = run_stages(make_stages(calls, fail=['rt']), exp_dirs)
+    assert status == {'simulations': 'done', 'combine': 'done', 'rt': 'failed', 'overflow': 'done', 'copy': 'blocked'}
+    assert sorted(os.listdir(tmp_path / STAGES_DIR)) == ['combine.json', 'overflow.json', 'simulations.json']
+
+    # restarts at the failed stage
+    calls = []
+    status = run_stages(make_stages(calls), exp_dirs, resume=True)
+    assert sorted(calls) == ['copy', 'rt'] and status['overflow'] == 'skipped'
+
+    # changed inputs make the stage and the stages after it stale
+    (tmp_path / 'sampled_parameters.csv').write_text('scen_num\n1\n2\n')
+    calls = []
+    run_stages(make_stages(calls), exp_dirs, resume=True)
+    assert len(calls) == 5
+
+
+def test_get_postprocessing_stages():
+    stages = get_postprocessing_stages('processForCivis', 'bat')
+    assert [stage.name for stage in stages if stage.after == ['cleanup']] == ['2_runDataComparison']
+    # the steps loading the ranked traces run after the trace selection
+    assert [stage.name for stage in stages if stage.after == ['1_runTraceSelection']] == [
+        '3_runProcessTrajectories', '5_runOverflowProbabilities', '6_runPrevalenceIFR', '7_runICUnonICU',
+        '8_runHospICUDeathsForecast']
+    assert get_postprocessing_stages(None, 'bat') == []
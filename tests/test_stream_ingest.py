@@ -0,0 +1,47 @@
+import os
+
+import pandas as pd
+
+import combine_and_trim
+from combine_and_trim import get_combined_fnames
+from render_scenarios import SETTINGS_FNAME
+from stream_ingest import finalize, ingest_completed
+
+
+def trajectories(scale):
+    return f'simulation.emodl,ODE\nsampletimes,0,1,2\nS{{0}},10,9,{8 * scale}\nI{{0}},0,1,{2 * scale}\n' \
+           f'S{{1}},10,9,{7 * scale}\nI{{1}},0,1,{3 * scale}\n'
+
+
+def make_experiment(exp_dir):
+    (exp_dir / 'simulations').mkdir()
+    (exp_dir / 'trajectories').mkdir()
+    pd.DataFrame({'scen_num': [1, 2, 3], 'sample_num': [0, 0, 1], 'startdate': '2020-02-20',
+                  'speciesS': 1000, 'initialAs': 10, 'Ki': [0.1, 0.2, 0.3]}).to_csv(
+        exp_dir / 'sampled_parameters.csv', index=False)
+    pd.DataFrame({'scen_num': [1, 2, 3], 'nruns': 2}).to_csv(exp_dir / 'simulations' / SETTINGS_FNAME, index=False)
+    for scen_num in [1, 2]:
+        (exp_dir / 'trajectories' / f'trajectories_scen{scen_num}.csv').write_text(trajectories(scen_num))
+    (exp_dir / 'trajectories' / 'trajectories_scen3.csv').write_text(trajectories(3)[:-11])
+
+
+def test_get_combined_fnames():
+    assert get_combined_fnames(3) == [('trajectoriesDat.csv', 0, 4)]
+    assert get_combined_fnames(3, 2) == [('trajectoriesDat_2.csv', 0, 2), ('trajectoriesDat_4.csv', 2, 4)]
+
+
+def test_finalize(tmp_path):
+    make_experiment(tmp_path)
+    assert ingest_completed(str(tmp_path), settle=0) == [3]
+    assert sorted(os.listdir(tmp_path / 'ingest')) == ['scen1.csv', 'scen2.csv', 'summary.csv']
+
+    (tmp_path / 'trajectories' / 'trajectories_scen3.csv').write_text(trajectories(3))
+    finalize(str(tmp_path))
+    assert pd.read_csv(tmp_path / 'ingest' / 'summary.csv')['scen_num'].tolist() == [1, 2, 3]
+
+    # same as combining all scenarios at once
+    combine_and_trim.exp_path = str(tmp_path)
+    combine_and_trim.trajectories_path = str(tmp_path / 'trajectories')
+    sampledf, _, _ = combine_and_trim.load_sampled_parameters(str(tmp_path))
+    combine_and_trim.combine_trajectories(sampledf, 0, 4, fname='combined.csv')
+    assert (tmp_path / 'trajectoriesDat.csv').read_text() == (tmp_path / 'combined.csv').read_text()
@@ -0,0 +1,77 @@
+import os
+
+import pandas as pd
+import pytest
+
+from render_scenarios import SETTINGS_FNAME, render_cfg
+from solvers.run_solver import run_solver
+from verify_scenarios import INCOMPLETE_FNAME, check_trajectories, get_rerun_script, verify_scenarios
+
+TRAJECTORIES = 'simulation_1.emodl,ODE\nsampletimes,0,1,2\nS{0},10,9,8\nI{0},0,1,2\nS{1},10,9,7\nI{1},0,1,3\n'
+
+
+@pytest.mark.parametrize('content, nruns, reason', [
+    (TRAJECTORIES, 2, None),
+    ('', 2, 'empty'),
+    (TRAJECTORIES[:-6], 2, 'truncated'),
+    (TRAJECTORIES[:-11], 2, 'truncated'),
+    (TRAJECTORIES, 3, 'truncated'),
+    ('simulation_1.emodl,ODE\nsampletimes,0,1,2\n', None, 'truncated'),
+])
+def test_check_trajectories(tmp_path, content, nruns, reason):
+    fname = tmp_path / 'trajectories_scen1.csv'
+    fname.write_text(content)
+    assert check_trajectories(str(fname), nruns) == reason
+    assert check_trajectories(str(tmp_path / 'trajectories_scen2.csv')) == 'missing'
+
+
+def test_verify_scenarios(tmp_path):
+    (tmp_path / 'simulations').mkdir()
+    (tmp_path / 'trajectories').mkdir()
+    pd.DataFrame({'scen_num': [1, 2, 3], 'nruns': 2}).to_csv(tmp_path / 'simulations' / SETTINGS_FNAME, index=False)
+    (tmp_path / 'trajectories' / 'trajectories_scen1.csv').write_text(TRAJECTORIES)
+    (tmp_path / 'trajectories' / 'trajectories_scen2.csv').write_text(TRAJECTORIES[:-6])
+
+    assert verify_scenarios(str(tmp_path)) == {2: 'truncated', 3: 'missing'}
+    assert not os.path.exists(tmp_path / 'trajectories' / 'trajectories_scen2.csv')
+    (tmp_path / 'trajectories' / 'trajectories_scen3.csv').write_text(TRAJECTORIES)
+    assert verify_scenarios(str(tmp_path)) == {2: 'missing'}
+    assert pd.read_csv(tmp_path / INCOMPLETE_FNAME)['attempt'].tolist() == [0, 0, 1]
+
+
+def test_verify_ode_scenario(tmp_path):
+    """The ODE solver writes a single run, whatever the runs of the experiment"""
+    for folder in ['simulations', 'trajectories']:
+        (tmp_path / folder).mkdir()
+    cfg_template = open(os.path.join('cfg', 'model_ODE.cfg')).read()
+    (tmp_path / 'model_ODE.cfg').write_text(cfg_template)
+    (tmp_path / 'simulations' / 'model_1.cfg').write_text(
+        render_cfg(cfg_template, 30, 31, 2, 'trajectories/trajectories_scen1'))
+    (tmp_path / 'simulations' / 'simulation_1.emodl').write_text(
+        '(import (rnrs) (emodl cmslib))\n(start-model "sir.emodl")\n(species S 990)\n(species I 10)\n(species R)\n'
+        '(observe susceptible S)\n(observe infected I)\n(reaction infection (S) (I) (/ (* 0.3 S I) 1000))\n'
+        '(reaction recovery (I) (R) (* 0.1 I))\n(end-model)\n')
+    pd.DataFrame({'scen_num': [1], 'cfg_template': 'model_ODE.cfg', 'nruns': 2}).to_csv(
+        tmp_path / 'simulations' / SETTINGS_FNAME, index=False)
+    run_solver(os.path.join('simulations', 'model_1.cfg'), os.path.join('simulations', 'simulation_1.emodl'),
+               workdir=str(tmp_path))
+    assert verify_scenarios(str(tmp_path)) == {}
+    assert (tmp_path / 'trajectories' / 'trajectories_scen1.csv').exists()
+
+
+def test_get_rerun_script():
+    script = '#SBATCH --array=1-25\n#SBATCH --error=log/arrayJob_%A_%a.err\n\nwine compartments.exe -c model_${SLURM_ARRAY_TASK_ID}.cfg'
+    assert get_rerun_script(script, [2, 3, 7], list(range(1, 26)), '/traj').startswith('#SBATCH --array=2-3,7\n')
+
+    packed = '#SBATCH --array=1-5\n\nfirst=$(( (${SLURM_ARRAY_TASK_ID} - 1) * 5 + 1 ))\n' \
+             'for i in $(seq ${first} ${last})\n  do\n    wine compartments.exe -c model_${i}.cfg\n  done\n'
+    rerun = get_rerun_script(packed, [2, 3, 17], list(range(1, 26)), '/traj')
+    assert rerun.startswith('#SBATCH --array=1,4\n')
+    assert '  do\n    if [ -e /traj/trajectories_scen${i}.csv ]; then continue; fi; wine' in rerun
+
+    batch = '#SBATCH --array=1-3\n\npython solvers/run_batch.py -d exp --task_id ${SLURM_ARRAY_TASK_ID} --n_tasks 3'
+    assert get_rerun_script(batch, [5], list(range(1, 10)), '/traj').startswith('#SBATCH --array=2\n')
+
+    # the limit of concurrent tasks is kept
+    assert get_rerun_script(script.replace('1-25', '1-25%4'), [2, 3, 7], list(range(1, 26)), '/traj').startswith(
+        '#SBATCH --array=2-3,7%4\n')
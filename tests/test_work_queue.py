@@ -0,0 +1,46 @@
+import sys
+import time
+
+from simulation_helpers import generateSubmissionFile_quest
+from verify_scenarios import get_rerun_script
+from work_queue import claim, connect, finish, get_status, get_worker_cmd, init_queue, parse_scen_nums, run_worker
+
+
+def test_claim(tmp_path):
+    init_queue(str(tmp_path), [1, 2])
+    con = connect(str(tmp_path))
+    assert claim(con, 'a') == 1
+    assert claim(con, 'b') == 2
+    assert claim(con, 'c') is None
+
+    # failed scenarios are retried, expired ones are claimed by other workers
+    finish(con, 1, 'a', exit_code=1, max_attempts=2)
+    con.execute("UPDATE scenarios SET heartbeat = ? WHERE scen_num = 2", (time.time() - 1000,))
+    assert claim(con, 'c', expire=600) == 1
+    assert claim(con, 'c', expire=600) == 2
+    finish(con, 2, 'b', exit_code=0)
+    assert get_status(str(tmp_path)) == {'running': 2}
+    finish(con, 1, 'c', exit_code=1, max_attempts=2)
+    finish(con, 2, 'c', exit_code=0)
+    assert get_status(str(tmp_path)) == {'done': 1, 'failed': 1}
+
+
+def test_run_worker(tmp_path):
+    init_queue(str(tmp_path), parse_scen_nums('1-3,5'))
+    cmd = f'{sys.executable} -c "import os; open(os.path.join(\'{tmp_path}\', os.environ[\'SCEN_NUM\']), \'w\')"'
+    assert run_worker(str(tmp_path), cmd, interval=0.01) == 4
+    assert get_status(str(tmp_path)) == {'done': 4}
+    assert all((tmp_path / str(scen_num)).exists() for scen_num in [1, 2, 3, 5])
+
+
+def test_queue_workers(tmp_path):
+    for folder in ['sh', 'trajectories']:
+        (tmp_path / folder).mkdir()
+    (tmp_path / 'simulation.emodl').write_text('')
+    generateSubmissionFile_quest(5, 'exp', 'spatial_EMS_experiment.yaml', str(tmp_path / 'trajectories'), '/git',
+                                 str(tmp_path), '/exe', '/out/exp', 'locale', cached_scenarios=[5], queue_workers=2)
+    script = (tmp_path / 'trajectories' / 'runSimulations.sh').read_text()
+    assert '#SBATCH --array=1-2\n' in script and '#SBATCH -t 04:00:00\n' in script
+    assert get_worker_cmd('/git', '/git/_temp/exp', '')[:-2] in script and '-c /git/_temp/exp/simulations/model_${SCEN_NUM}.cfg' in script
+    assert get_status(str(tmp_path)) == {'pending': 4}
+    assert '#SBATCH --array=1\n' in get_rerun_script(script, [3], [1, 2, 3, 4, 5], str(tmp_path / 'trajectories'))
@@ -0,0 +1,211 @@
+"""
+Verify that all scenarios of an experiment have been simulated before combining the trajectories.
+
+A trajectories_scen<scen_num>.csv is incomplete if it is missing, empty or truncated (rows with fewer values than
+the sample times, or not all runs written, i.e. a killed or timed-out array task). Incomplete files are removed and
+listed in <exp_dir>/incomplete_scenarios.csv, so only those scenarios are simulated again:
+- Local, runScenarios.py reruns them with the local executor (up to --max_resubmits times)
+- NUCLUSTER, the postprocessing job first runs
+
+python verify_scenarios.py -d _temp/<exp_name> --resubmit run_postprocessing.sh
+
+which submits trajectories/rerunSimulations.sh, an array job of the tasks with incomplete scenarios, resubmits the
+postprocessing job after it (singleton dependency) and exits with RESUBMITTED, so the trajectories are only combined
+once all scenarios are complete. After max_resubmits the remaining incomplete scenarios are reported and the
+postprocessing continues.
+"""
+import argparse
+import logging
+import os
+import re
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from render_scenarios import SETTINGS_FNAME
+from simulation_helpers import array_ranges
+from solvers.run_solver import is_deterministic_cfg
+from work_queue import QUEUE_FNAME, requeue
+
+log = logging.getLogger(__name__)
+
+INCOMPLETE_FNAME = 'incomplete_scenarios.csv'
+MAX_RESUBMITS = 2
+RESUBMITTED = 3
+
+
+def check_trajectories(fname, nruns=None):
+    """Returns None if the trajectories file is complete, otherwise 'missing', 'empty' or 'truncated'"""
+    if not os.path.exists(fname):
+        return 'missing'
+    if os.path.getsize(fname) == 0:
+        return 'empty'
+    n_values = None
+    rows_per_run = {}
+    with open(fname) as fin:
+        # header with the model name, followed by the sampletimes row
+        next(fin, None)
+        for line in fin:
+            if n_values is None:
+                n_values = line.count(',')
+                continue
+            if line.count(',') != n_values:
+                return 'truncated'
+            channel = line.split(',', 1)[0]
+            run_num = channel[channel.rfind('{') + 1:channel.rfind('}')]
+            rows_per_run[run_num] = rows_per_run.get(run_num, 0) + 1
+    if not rows_per_run or len(set(rows_per_run.values())) > 1:
+        return 'truncated'
+    if nruns is not None and len(rows_per_run) != nruns:
+        return 'truncated'
+    return None
+
+
+def get_scenario_settings(exp_dir):
+    """Scenario settings of an experiment, nruns is the number of runs expected in the trajectories"""
+    fname = os.path.join(exp_dir, 'simulations', SETTINGS_FNAME)
+    if os.path.exists(fname):
+        settings = pd.read_csv(fname)
+        if 'nruns' in settings and 'cfg_template' in settings:
+            # deterministic solvers write a single run (solvers/run_solver.run_ode)
+            deterministic = settings['cfg_template'].map(
+                lambda cfg: os.path.exists(os.path.join(exp_dir, cfg)) and is_deterministic_cfg(os.path.join(exp_dir, cfg)))
+            settings.loc[deterministic, 'nruns'] = 1
+        return settings
+    # experiments without scenario settings, the number of runs is not checked
+    return pd.read_csv(os.path.join(exp_dir, 'sampled_parameters.csv'), usecols=['scen_num'])
+
+
+def find_incomplete_scenarios(exp_dir, trajectories_dir=None):
+    """Incomplete trajectories files of an experiment
+
+    Returns
+    -------
+    incomplete : dict
+        'missing', 'empty' or 'truncated' per scen_num
+    """
+    trajectories_dir = trajectories_dir or os.path.join(exp_dir, 'trajectories')
+    incomplete = {}
+    for _, row in get_scenario_settings(exp_dir).iterrows():
+        nruns = int(row['nruns']) if 'nruns' in row else None
+        reason = check_trajectories(os.path.join(trajectories_dir, f"trajectories_scen{row['scen_num']}.csv"), nruns)
+        if reason is not None:
+            incomplete[int(row['scen_num'])] = reason
+    return incomplete
+
+
+def get_attempt(exp_dir):
+    """Number of times incomplete scenarios have been found before"""
+    fname = os.path.join(exp_dir, INCOMPLETE_FNAME)
+    if not os.path.exists(fname):
+        return 0
+    return int(pd.read_csv(fname)['attempt'].max()) + 1
+
+
+def verify_scenarios(exp_dir, trajectories_dir=None):
+    """Find, log and remove the incomplete trajectories files of an experiment, see find_incomplete_scenarios"""
+    trajectories_dir = trajectories_dir or os.path.join(exp_dir, 'trajectories')
+    incomplete = find_incomplete_scenarios(exp_dir, trajectories_dir)
+    if not incomplete:
+        log.info("All scenarios are complete")
+        return incomplete
+
+    attempt = get_attempt(exp_dir)
+    fname = os.path.join(exp_dir, INCOMPLETE_FNAME)
+    pd.DataFrame({'attempt': attempt, 'scen_num': list(incomplete.keys()), 'reason': list(incomplete.values())}).to_csv(
+        fname, mode='a', header=not os.path.exists(fname), index=False)
+    for scen_num in incomplete:
+        fname = os.path.join(trajectories_dir, f'trajectories_scen{scen_num}.csv')
+        if os.path.exists(fname):
+            os.remove(fname)
+    log.warning(f"{len(incomplete)} incomplete scenarios: {array_ranges(incomplete)}")
+    return incomplete
+
+
+def get_rerun_script(script, incomplete, scen_nums, trajectories_dir):
+    """Array job of the tasks of runSimulations.sh that simulate the incomplete scenarios
+
+    Parameters
+    ----------
+    script : str
+        Content of runSimulations.sh, see simulation_helpers.generateSubmissionFile_quest
+    incomplete : iterable
+        Incomplete scen_nums
+    scen_nums : list
+        All scen_nums of the experiment, in the order of sampled_parameters.csv
+    """
+    n_tasks = re.search(r'--n_tasks (\d+)', script)
+    scenarios_per_task = re.search(r'\* (\d+) \+ 1 \)\)', script)
+    n_workers = re.search(r'#SBATCH --array=1-(\d+)(%\d+)?\n', script)
+    if 'work_queue.py' in script and n_workers is not None:
+        # workers of the queue, in which the incomplete scenarios are pending again, see resubmit_incomplete
+        tasks = range(1, min(int(n_workers.group(1)), len(incomplete)) + 1)
+    elif n_tasks is not None:
+        # batch solver, see solvers/run_batch.py
+        splits = np.array_split(np.array(scen_nums), int(n_tasks.group(1)))
+        tasks = [i + 1 for i, split in enumerate(splits) if set(split) & set(incomplete)]
+    elif scenarios_per_task is not None:
+        tasks = sorted({(scen_num - 1) // int(scenarios_per_task.group(1)) + 1 for scen_num in incomplete})
+        if 'then continue; fi' not in script:
+            # only the incomplete scenarios of each task
+            script = script.replace('  do\n    ', f'  do\n    if [ -e {trajectories_dir}/trajectories_scen${{i}}.csv ]; '
+                                                  f'then continue; fi; ', 1)
+    else:
+        tasks = incomplete
+    # keeps the limit of concurrent tasks (%N)
+    return re.sub(r'#SBATCH --array=[^%\n]*', f'#SBATCH --array={array_ranges(tasks)}', script, count=1)
+
+
+def resubmit_incomplete(exp_dir, incomplete, postprocessing_script):
+    """Submit trajectories/rerunSimulations.sh followed by the postprocessing script"""
+    trajectories_dir = os.path.join(exp_dir, 'trajectories')
+    with open(os.path.join(trajectories_dir, 'runSimulations.sh')) as fin:
+        script = fin.read()
+    scen_nums = get_scenario_settings(exp_dir)['scen_num'].tolist()
+    if os.path.exists(os.path.join(exp_dir, QUEUE_FNAME)):
+        requeue(exp_dir, incomplete)
+    with open(os.path.join(trajectories_dir, 'rerunSimulations.sh'), 'w') as fout:
+        fout.write(get_rerun_script(script, incomplete, scen_nums, trajectories_dir))
+    subprocess.run(['sbatch', 'rerunSimulations.sh'], cwd=trajectories_dir, check=True)
+    subprocess.run(['sbatch', '--dependency=singleton', postprocessing_script], cwd=exp_dir, check=True)
+    log.info(f"Resubmitted {len(incomplete)} scenarios and {postprocessing_script}")
+
+
+def parse_args():
+    description = "Verify the trajectories of an experiment and resubmit incomplete scenarios"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-d",
+        "--exp_dir",
+        type=str,
+        help="Experiment folder with trajectories/ and simulations/scenario_settings.csv",
+        required=True
+    )
+    parser.add_argument(
+        "--resubmit",
+        type=str,
+        help="NUCLUSTER: postprocessing script to resubmit after the incomplete scenarios, i.e. run_postprocessing.sh",
+        default=None
+    )
+    parser.add_argument(
+        "--max_resubmits",
+        type=int,
+        help="Number of times incomplete scenarios are resubmitted before the postprocessing continues without them",
+        default=MAX_RESUBMITS
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="INFO")
+    args = parse_args()
+    attempt = get_attempt(args.exp_dir)
+    incomplete = verify_scenarios(args.exp_dir)
+    if incomplete and args.resubmit is not None:
+        if attempt < args.max_resubmits:
+            resubmit_incomplete(args.exp_dir, incomplete, args.resubmit)
+            sys.exit(RESUBMITTED)
+        log.error(f"Scenarios still incomplete after {args.max_resubmits} resubmissions, "
+                  f"see {os.path.join(args.exp_dir, INCOMPLETE_FNAME)}")
@@ -0,0 +1,227 @@
+"""
+Experiment-local SQLite queue of scenarios, pulled by any number of workers (runScenarios.py --queue_workers).
+
+Instead of one array task per scenario, each worker (NUCLUSTER array task or local process) claims the next pending
+scenario, runs it and claims the next one until no scenario is pending, so fast nodes take on more scenarios and one
+slow node does not hold up the others. While a scenario runs, its worker updates the heartbeat of the scenario;
+scenarios whose heartbeat has expired (i.e. of killed or timed-out workers) are pending again for the other workers.
+Failed scenarios are retried up to max_attempts times.
+
+python work_queue.py -d _temp/<exp_name> --init 1-100
+python work_queue.py -d _temp/<exp_name> --worker --cmd '<command of scenario ${SCEN_NUM}>'
+python work_queue.py -d _temp/<exp_name> --status
+
+The command runs in a shell with the scenario number in the environment variable SCEN_NUM.
+"""
+import argparse
+import logging
+import os
+import socket
+import sqlite3
+import subprocess
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+QUEUE_FNAME = 'queue.sqlite'
+HEARTBEAT_SECONDS = 60
+EXPIRE_SECONDS = 600
+MAX_ATTEMPTS = 2
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS scenarios (
+    scen_num INTEGER PRIMARY KEY, state TEXT, worker TEXT, attempts INTEGER, heartbeat REAL, exit_code INTEGER)"""
+
+
+def connect(exp_dir, timeout=300):
+    con = sqlite3.connect(os.path.join(exp_dir, QUEUE_FNAME), timeout=timeout, isolation_level=None)
+    con.execute(SCHEMA)
+    return con
+
+
+def transaction(con, func):
+    """Run func(con) in an exclusive transaction, so that a scenario is claimed by one worker only"""
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        result = func(con)
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+    return result
+
+
+def init_queue(exp_dir, scen_nums):
+    """Add scenarios as pending, scenarios already in the queue are kept"""
+    con = connect(exp_dir)
+    transaction(con, lambda con: con.executemany(
+        "INSERT OR IGNORE INTO scenarios (scen_num, state, attempts) VALUES (?, 'pending', 0)",
+        [(int(scen_num),) for scen_num in scen_nums]))
+    con.close()
+
+
+def requeue(exp_dir, scen_nums):
+    """Set scenarios pending again, i.e. incomplete scenarios resubmitted by verify_scenarios.py"""
+    init_queue(exp_dir, scen_nums)
+    con = connect(exp_dir)
+    transaction(con, lambda con: con.executemany(
+        "UPDATE scenarios SET state = 'pending', attempts = 0, worker = NULL WHERE scen_num = ?",
+        [(int(scen_num),) for scen_num in scen_nums]))
+    con.close()
+
+
+def claim(con, worker, expire=EXPIRE_SECONDS):
+    """Claim the next pending scenario, after setting scenarios with an expired heartbeat pending again
+
+    Returns
+    -------
+    scen_num : int
+        None if no scenario is pending
+    """
+    def _claim(con):
+        now = time.time()
+        expired = con.execute("UPDATE scenarios SET state = 'pending' WHERE state = 'running' AND heartbeat < ?",
+                              (now - expire,)).rowcount
+        if expired:
+            log.warning(f"{expired} scenarios with expired heartbeat are pending again")
+        row = con.execute("SELECT scen_num FROM scenarios WHERE state = 'pending' ORDER BY scen_num LIMIT 1").fetchone()
+        if row is None:
+            return None
+        con.execute("UPDATE scenarios SET state = 'running', worker = ?, attempts = attempts + 1, heartbeat = ? "
+                    "WHERE scen_num = ?", (worker, now, row[0]))
+        return row[0]
+    return transaction(con, _claim)
+
+
+def finish(con, scen_num, worker, exit_code, max_attempts=MAX_ATTEMPTS):
+    """Set a claimed scenario done, or pending again if it failed less than max_attempts times"""
+    transaction(con, lambda con: con.execute(
+        "UPDATE scenarios SET state = CASE WHEN ? = 0 THEN 'done' WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+        "exit_code = ? WHERE scen_num = ? AND worker = ?", (exit_code, max_attempts, exit_code, scen_num, worker)))
+
+
+def keep_alive(exp_dir, scen_num, worker, stop, interval=HEARTBEAT_SECONDS):
+    """Update the heartbeat of a running scenario every interval seconds until stop is set"""
+    con = connect(exp_dir)
+    while not stop.wait(interval):
+        try:
+            con.execute("UPDATE scenarios SET heartbeat = ? WHERE scen_num = ? AND worker = ?",
+                        (time.time(), scen_num, worker))
+        except sqlite3.OperationalError as e:
+            log.warning(f"Heartbeat of scenario {scen_num} not updated: {e}")
+    con.close()
+
+
+def get_worker_name():
+    task_id = os.environ.get('SLURM_ARRAY_TASK_ID')
+    return f'{socket.gethostname()}:{os.getpid()}' + (f':task{task_id}' if task_id else '')
+
+
+def run_worker(exp_dir, cmd, worker=None, max_attempts=MAX_ATTEMPTS, expire=EXPIRE_SECONDS,
+               interval=HEARTBEAT_SECONDS):
+    """Run the command for claimed scenarios until no scenario is pending
+
+    Returns
+    -------
+    n_done : int
+        Number of scenarios run by this worker
+    """
+    worker = worker or get_worker_name()
+    con = connect(exp_dir)
+    n_done = 0
+    while True:
+        scen_num = claim(con, worker, expire)
+        if scen_num is None:
+            break
+        log.info(f"Worker {worker} runs scenario {scen_num}")
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_alive, args=(exp_dir, scen_num, worker, stop, interval), daemon=True)
+        heartbeat.start()
+        try:
+            exit_code = subprocess.call(cmd, shell=True, env={**os.environ, 'SCEN_NUM': str(scen_num)})
+        finally:
+            stop.set()
+            heartbeat.join()
+        if exit_code != 0:
+            log.warning(f"Scenario {scen_num} failed with exit code {exit_code}")
+        finish(con, scen_num, worker, exit_code, max_attempts)
+        n_done += 1
+    con.close()
+    log.info(f"Worker {worker} done after {n_done} scenarios, no scenario pending")
+    return n_done
+
+
+def get_status(exp_dir):
+    """Number of scenarios per state"""
+    con = connect(exp_dir)
+    counts = dict(con.execute("SELECT state, COUNT(*) FROM scenarios GROUP BY state").fetchall())
+    con.close()
+    return counts
+
+
+def get_worker_cmd(git_dir, exp_dir, cmd):
+    """Shell command starting a worker for a scenario command with ${SCEN_NUM}"""
+    cmd = cmd.replace("'", "'\\''")
+    return f'python {git_dir}/work_queue.py -d {exp_dir} --worker --cmd \'{cmd}\''
+
+
+def parse_scen_nums(spec):
+    """Scenarios of a Slurm style specification, i.e. '1-3,5' -> [1, 2, 3, 5]"""
+    scen_nums = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        scen_nums += list(range(int(first), int(last or first) + 1))
+    return scen_nums
+
+
+def parse_args():
+    description = "Queue of the scenarios of an experiment, pulled by workers"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "-d",
+        "--exp_dir",
+        type=str,
+        help="Experiment folder of the queue",
+        required=True
+    )
+    parser.add_argument(
+        "--init",
+        type=str,
+        help="Add these scenarios to the queue, i.e. 1-100",
+        default=None
+    )
+    parser.add_argument(
+        "--worker",
+        action='store_true',
+        help="Run --cmd for pending scenarios until none is pending",
+    )
+    parser.add_argument(
+        "--cmd",
+        type=str,
+        help="Shell command of a scenario, with the scenario number in ${SCEN_NUM}",
+        default=None
+    )
+    parser.add_argument(
+        "--max_attempts",
+        type=int,
+        help="Times a failed scenario is run",
+        default=MAX_ATTEMPTS
+    )
+    parser.add_argument(
+        "--status",
+        action='store_true',
+        help="Print the number of scenarios per state",
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level="INFO")
+    args = parse_args()
+    if args.init is not None:
+        init_queue(args.exp_dir, parse_scen_nums(args.init))
+    if args.worker:
+        run_worker(args.exp_dir, args.cmd, max_attempts=args.max_attempts)
+    if args.status:
+        for state, count in sorted(get_status(args.exp_dir).items()):
+            print(f"{state}: {count}")